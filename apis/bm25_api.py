@@ -1,15 +1,111 @@
-from typing import Any, Dict, List, Optional
-
-from fastapi import FastAPI, HTTPException
+import asyncio
+import json
+import os
+import zlib
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
 from langchain_core.documents import Document
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 
+from retrievers.bm25_index import BM25Index
 from retrievers.bm25_retriever import PABM25Retriever
+from retrievers.reranker import DEFAULT_RERANK_MODEL, PACrossEncoderReranker
+from retrievers.sharded_bm25_retriever import ShardedBM25Retriever
+from retrievers.utils import BoundedExecutor, ExecutorOverloaded
+
+# Directory the index is loaded from at startup and saved to on shutdown.
+BM25_INDEX_PATH = os.environ.get("BM25_INDEX_PATH")
+# Number of shard processes the corpus is partitioned across, 1 for a single
+# in-process index.
+BM25_SHARDS = int(os.environ.get("BM25_SHARDS", "1"))
+# JSON object of BM25Index parameters for a new index, e.g.
+# {"variant": "bm25plus", "field_weights": {"title": 3.0}, "quantize": true}.
+# A saved index keeps the parameters it was built with.
+BM25_PARAMS = json.loads(os.environ.get("BM25_PARAMS", "{}"))
+
+# Cross-encoder used by searches with rerank=true, loaded on the first such
+# search. RERANK_CANDIDATES documents are recalled by BM25 and reranked;
+# RERANK_DEADLINE_MS bounds the reranking time, unscored candidates keeping
+# their BM25 order.
+RERANK_MODEL = os.environ.get("RERANK_MODEL", DEFAULT_RERANK_MODEL)
+RERANK_CANDIDATES = int(os.environ.get("RERANK_CANDIDATES", "50"))
+RERANK_DEADLINE_MS = os.environ.get("RERANK_DEADLINE_MS")
+# Reranking runs on RERANK_WORKERS dedicated threads with at most RERANK_QUEUE
+# more reranks waiting; reranked searches beyond that are answered with 503.
+RERANK_WORKERS = int(os.environ.get("RERANK_WORKERS", "2"))
+RERANK_QUEUE = int(os.environ.get("RERANK_QUEUE", "16"))
+
+# Searches run on BM25_SEARCH_WORKERS dedicated threads with at most
+# BM25_SEARCH_QUEUE more waiting; searches beyond that are answered with 503.
+BM25_SEARCH_WORKERS = int(os.environ.get("BM25_SEARCH_WORKERS", "4"))
+BM25_SEARCH_QUEUE = int(os.environ.get("BM25_SEARCH_QUEUE", "64"))
+
+# Longest NDJSON line accepted by the bulk endpoint, so a body without
+# newlines cannot be buffered whole.
+MAX_NDJSON_LINE_BYTES = 16 * 1024 * 1024
+# Most bytes inflated from a gzip body at a time, so a highly compressed chunk
+# cannot expand in memory all at once.
+INFLATE_CHUNK_BYTES = 1024 * 1024
+# Most documents accepted by one bulk upload. The documents and their tokens
+# are held in memory until the upload is committed, so this bounds its memory.
+BM25_BULK_MAX_DOCS = int(os.environ.get("BM25_BULK_MAX_DOCS", "1000000"))
+
+
+def load_retriever() -> Union[PABM25Retriever, ShardedBM25Retriever]:
+    saved = BM25_INDEX_PATH and os.path.exists(BM25_INDEX_PATH)
+    executor = {
+        "async_workers": BM25_SEARCH_WORKERS,
+        "async_queue_size": BM25_SEARCH_QUEUE,
+    }
+    if BM25_SHARDS > 1:
+        if saved:
+            return ShardedBM25Retriever.load(BM25_INDEX_PATH, **executor)
+        return ShardedBM25Retriever(
+            n_shards=BM25_SHARDS, bm25_params=BM25_PARAMS, **executor
+        )
+    if saved:
+        return PABM25Retriever.load(BM25_INDEX_PATH, **executor)
+    return PABM25Retriever(vectorizer=BM25Index(**BM25_PARAMS), **executor)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    if BM25_INDEX_PATH:
+        retriever.save(BM25_INDEX_PATH)
+    if isinstance(retriever, ShardedBM25Retriever):
+        retriever.close()
+    rerank_executor.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
-app = FastAPI()
 
-documents_store: Dict[str, Document] = {}
-retriever = PABM25Retriever.from_documents([])
+@app.exception_handler(ExecutorOverloaded)
+async def overloaded_handler(request: Request, exc: ExecutorOverloaded):
+    """
+    Shed load when the search or rerank queue is full, rather than queueing
+    without bound.
+    """
+    return JSONResponse(
+        status_code=503,
+        content={"detail": f"Queue full: {exc}"},
+        headers={"Retry-After": "1"},
+    )
+
+
+retriever = load_retriever()
+reranker = PACrossEncoderReranker(
+    model_name=RERANK_MODEL,
+    max_candidates=RERANK_CANDIDATES,
+    deadline=float(RERANK_DEADLINE_MS) / 1000 if RERANK_DEADLINE_MS else None,
+    lazy_load=True,
+)
+rerank_executor = BoundedExecutor(RERANK_WORKERS, RERANK_QUEUE, name="rerank")
 
 
 class DocumentInput(BaseModel):
@@ -26,12 +122,34 @@ class DocumentsInput(BaseModel):
     documents: List[DocumentInput]
 
 
+class BulkItemResult(BaseModel):
+    """Outcome of one line of a bulk upload."""
+
+    line: int
+    """ 1-based line number in the uploaded NDJSON."""
+    id: Optional[str] = None
+    status: str
+    """ `ok` if the document was indexed, else `error`."""
+    detail: Optional[str] = None
+
+
+class BulkResponse(BaseModel):
+    """Model for bulk upload response."""
+
+    added: int
+    failed: int
+    results: List[BulkItemResult]
+
+
 class SearchResponseItem(BaseModel):
     """Single search result item."""
 
     id: Optional[str]
     page_content: str
     metadata: Dict[str, Any]
+    rerank_score: Optional[float] = None
+    """ Cross-encoder score, for reranked searches; `None` if the deadline
+    passed before the document was scored."""
 
 
 class SearchResponse(BaseModel):
@@ -40,14 +158,25 @@ class SearchResponse(BaseModel):
     results: List[SearchResponseItem]
 
 
-def rebuild_retriever():
-    """
-    Rebuild the BM25 retriever based on the current documents store.
-    This function should be called whenever documents are added or removed.
-    """
-    global retriever
-    all_docs = list(documents_store.values())
-    retriever = PABM25Retriever.from_documents(all_docs)
+class BatchSearchQuery(BaseModel):
+    """Single query of a batch search."""
+
+    query: str
+    k: Optional[int] = None
+    filter: Optional[Dict[str, Any]] = None
+    rerank: bool = False
+
+
+class BatchSearchInput(BaseModel):
+    """Model for searching many queries at once."""
+
+    queries: List[BatchSearchQuery] = Field(max_length=10_000)
+
+
+class BatchSearchResponse(BaseModel):
+    """Model for batch search response, one entry per query in order."""
+
+    results: List[SearchResponse]
 
 
 @app.get("/")
@@ -55,8 +184,12 @@ async def health():
     return {"status": "ok"}
 
 
+# Handlers that tokenize or score are plain functions so FastAPI runs them in
+# its worker threadpool instead of blocking the event loop.
+
+
 @app.post("/api/v1/bm25/documents")
-async def add_documents(doc_list: DocumentsInput):
+def add_documents(doc_list: DocumentsInput):
     """
     Add multiple documents to the BM25 index. If an id is not provided,
     one will be generated automatically.
@@ -64,60 +197,206 @@ async def add_documents(doc_list: DocumentsInput):
     Args:
         doc_list (DocumentListInput): A list of documents to add.
     """
+    new_docs: Dict[str, Document] = {}
     for doc_input in doc_list.documents:
-        doc_id = doc_input.id or f"doc_{len(documents_store) + 1}"
-        if doc_id in documents_store:
+        doc_id = doc_input.id or f"doc_{retriever.n_docs + len(new_docs) + 1}"
+        if doc_id in retriever or doc_id in new_docs:
             raise HTTPException(
                 status_code=400, detail=f"Document with id {doc_id} already exists."
             )
-        new_doc = Document(
+        new_docs[doc_id] = Document(
             page_content=doc_input.page_content, metadata=doc_input.metadata, id=doc_id
         )
-        documents_store[doc_id] = new_doc
 
-    # Rebuild the retriever with updated docs
-    rebuild_retriever()
+    # Index only the new documents
+    try:
+        retriever.add_documents(new_docs.values())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {"message": "Documents added successfully."}
 
 
+async def _ndjson_lines(
+    request: Request, gzipped: bool
+) -> AsyncIterator[Tuple[int, bytes]]:
+    """Non-empty lines of a streamed NDJSON body with their line numbers."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+    buffer = b""
+    line_no = 0
+    async for data in request.stream():
+        while data:
+            if decompressor is None:
+                chunk, data = data, b""
+            else:
+                chunk = decompressor.decompress(data, INFLATE_CHUNK_BYTES)
+                data = decompressor.unconsumed_tail
+            *lines, buffer = (buffer + chunk).split(b"\n")
+            if len(buffer) > MAX_NDJSON_LINE_BYTES:
+                raise HTTPException(status_code=413, detail="NDJSON line too long.")
+            for line in lines:
+                line_no += 1
+                if line.strip():
+                    yield line_no, line
+    if decompressor is not None:
+        buffer += decompressor.flush()
+    for line in buffer.split(b"\n"):
+        line_no += 1
+        if line.strip():
+            yield line_no, line
+
+
+@app.post("/api/v1/bm25/documents/bulk", response_model=BulkResponse)
+async def bulk_add_documents(request: Request, chunk_size: int = 1000):
+    """
+    Add documents streamed as NDJSON, one `DocumentInput` object per line,
+    optionally gzip-compressed (`Content-Encoding: gzip`). The body is parsed
+    and tokenized in chunks as it arrives, then all valid documents are
+    committed to the index in chunks, searches being served in between, and
+    become searchable at once. Invalid lines and duplicate ids are
+    reported per line instead of failing the upload.
+
+    Until the commit, every document of the upload and its tokens stay in
+    memory, so uploads are limited to `BM25_BULK_MAX_DOCS` documents (413
+    beyond); split larger corpora into several uploads.
+
+    Args:
+        request (Request): The upload, e.g. `curl -H "Content-Encoding: gzip"
+            --data-binary @docs.ndjson.gz .../api/v1/bm25/documents/bulk`.
+        chunk_size (int): Number of documents tokenized, and committed, at a
+            time.
+    """
+    if chunk_size < 1:
+        raise HTTPException(status_code=400, detail="chunk_size must be positive.")
+    gzipped = request.headers.get("content-encoding", "").lower() == "gzip"
+
+    results: List[BulkItemResult] = []
+    pending: List[BulkItemResult] = []
+    docs: List[Document] = []
+    encoded: List[Any] = []
+    chunk: List[Document] = []
+    base = retriever.n_docs
+    try:
+        async for line_no, line in _ndjson_lines(request, gzipped):
+            try:
+                doc_input = DocumentInput.model_validate_json(line)
+            except ValidationError as e:
+                results.append(
+                    BulkItemResult(line=line_no, status="error", detail=str(e))
+                )
+                continue
+            if len(pending) >= BM25_BULK_MAX_DOCS:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"Upload has more than {BM25_BULK_MAX_DOCS} documents.",
+                )
+            doc_id = doc_input.id or f"doc_{base + len(pending) + 1}"
+            item = BulkItemResult(line=line_no, id=doc_id, status="ok")
+            results.append(item)
+            pending.append(item)
+            chunk.append(
+                Document(
+                    page_content=doc_input.page_content,
+                    metadata=doc_input.metadata,
+                    id=doc_id,
+                )
+            )
+            if len(chunk) >= chunk_size:
+                encoded.extend(
+                    await run_in_threadpool(retriever.encode_documents, chunk)
+                )
+                docs.extend(chunk)
+                chunk = []
+    except zlib.error as e:
+        raise HTTPException(status_code=400, detail=f"Invalid gzip body: {e}")
+    if chunk:
+        encoded.extend(await run_in_threadpool(retriever.encode_documents, chunk))
+        docs.extend(chunk)
+
+    errors = await run_in_threadpool(
+        retriever.commit_documents, docs, encoded, chunk_size=chunk_size
+    )
+    for item, error in zip(pending, errors):
+        if error is not None:
+            item.status, item.detail = "error", error
+    failed = sum(item.status == "error" for item in results)
+    return BulkResponse(added=len(results) - failed, failed=failed, results=results)
+
+
 @app.delete("/api/v1/bm25/documents/{doc_id}")
-async def delete_document(doc_id: str):
+def delete_document(doc_id: str):
     """
     Delete a document by its ID.
 
     Args:
         doc_id (str): The ID of the document to remove.
     """
-    if doc_id not in documents_store:
+    try:
+        retriever.delete_documents([doc_id])
+    except KeyError:
         raise HTTPException(status_code=404, detail="Document not found.")
-    del documents_store[doc_id]
-
-    # Rebuild the retriever after deletion
-    rebuild_retriever()
 
     return {"message": f"Document {doc_id} deleted successfully."}
 
 
+def rerank_results(
+    query: str, hits: List[Tuple[Document, float]], k: Optional[int]
+) -> SearchResponse:
+    """
+    Rerank BM25 candidates with the cross-encoder and keep the best k.
+    """
+    reranked = reranker.rerank(
+        query, [doc for doc, _ in hits], top_n=retriever.k if k is None else k
+    )
+    return SearchResponse(
+        results=[
+            SearchResponseItem(
+                id=doc.id,
+                page_content=doc.page_content,
+                metadata=doc.metadata,
+                rerank_score=score,
+            )
+            for doc, score in reranked
+        ]
+    )
+
+
 @app.get("/api/v1/bm25/search", response_model=SearchResponse)
-async def search_documents(query: str, k: Optional[int] = None):
+async def search_documents(
+    query: str,
+    k: Optional[int] = None,
+    filter: Optional[str] = None,
+    rerank: bool = False,
+):
     """
     Search for documents using the BM25 retriever.
 
     Args:
         query (str): The query string.
         k (int, optional): Number of documents to return. Defaults to retriever's k.
-    """
-    # If k is provided, temporarily adjust retriever's k, otherwise use the default.
-    original_k = retriever.k
-    if k is not None:
-        retriever.k = k
+        filter (str, optional): JSON metadata filter, e.g.
+            `{"source": "wiki", "lang": {"$in": ["zh", "en"]}, "year": {"$gte": 2020}}`.
+            Matching happens before the top k are selected.
+        rerank (bool, optional): Recall RERANK_CANDIDATES documents and return
+            the k best by cross-encoder score.
 
+    Raises:
+        HTTPException: 503 if the search or rerank queue is full.
+    """
     try:
-        results = retriever._get_relevant_documents(query)
-    finally:
-        # Restore original k
-        retriever.k = original_k
+        metadata_filter = json.loads(filter) if filter else None
+        if metadata_filter is not None and not isinstance(metadata_filter, dict):
+            raise ValueError("filter must be a JSON object.")
+        if rerank:
+            candidates = await retriever.asearch_with_scores(
+                query, k=RERANK_CANDIDATES, filter=metadata_filter
+            )
+        else:
+            results = await retriever.ainvoke(query, k=k, filter=metadata_filter)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid filter: {e}")
 
+    if rerank:
+        return await rerank_executor.run(rerank_results, query, candidates, k)
     response_items = [
         SearchResponseItem(
             id=doc.id, page_content=doc.page_content, metadata=doc.metadata
@@ -127,8 +406,61 @@ async def search_documents(query: str, k: Optional[int] = None):
     return SearchResponse(results=response_items)
 
 
+@app.post("/api/v1/bm25/search/batch", response_model=BatchSearchResponse)
+async def batch_search_documents(batch: BatchSearchInput):
+    """
+    Search many queries in one call. The queries are scored together in a
+    single pass over the index.
+
+    Args:
+        batch (BatchSearchInput): The queries, each with an optional k,
+            metadata filter and rerank flag.
+
+    Raises:
+        HTTPException: 503 if the search or rerank queue is full.
+    """
+    try:
+        hits = await retriever.abatch_search_with_scores(
+            [q.query for q in batch.queries],
+            [RERANK_CANDIDATES if q.rerank else q.k for q in batch.queries],
+            [q.filter for q in batch.queries],
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid filter: {e}")
+    to_rerank = [i for i, q in enumerate(batch.queries) if q.rerank]
+    # the reranks run side by side, each taking a rerank executor slot
+    scored = await asyncio.gather(
+        *(
+            rerank_executor.run(
+                rerank_results, batch.queries[i].query, hits[i], batch.queries[i].k
+            )
+            for i in to_rerank
+        )
+    )
+    reranked = dict(zip(to_rerank, scored))
+    return BatchSearchResponse(
+        results=[
+            (
+                reranked[i]
+                if q.rerank
+                else SearchResponse(
+                    results=[
+                        SearchResponseItem(
+                            id=doc.id,
+                            page_content=doc.page_content,
+                            metadata=doc.metadata,
+                        )
+                        for doc, _ in results
+                    ]
+                )
+            )
+            for i, (q, results) in enumerate(zip(batch.queries, hits))
+        ]
+    )
+
+
 @app.put("/api/v1/bm25/documents/{doc_id}")
-async def update_document(doc_id: str, doc_input: DocumentInput):
+def update_document(doc_id: str, doc_input: DocumentInput):
     """
     Update an existing document by its ID.
 
@@ -139,15 +471,53 @@ async def update_document(doc_id: str, doc_input: DocumentInput):
     Raises:
         HTTPException: If the document doesn't exist.
     """
-    if doc_id not in documents_store:
-        raise HTTPException(status_code=404, detail="Document not found.")
-
     updated_doc = Document(
         page_content=doc_input.page_content, metadata=doc_input.metadata, id=doc_id
     )
-    documents_store[doc_id] = updated_doc
-
-    # Rebuild the retriever to reflect the updated document
-    rebuild_retriever()
+    try:
+        retriever.update_document(updated_doc)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Document not found.")
 
     return {"message": f"Document {doc_id} updated successfully."}
+
+
+@app.get("/api/v1/bm25/cache/stats")
+async def cache_stats():
+    """
+    Hit/miss counters of the retriever caches and the current index generation,
+    which every add, update and delete bumps, and of the rerank score cache.
+    """
+    return {**retriever.cache_stats(), "rerank": reranker.cache_stats()}
+
+
+@app.get("/api/v1/bm25/executor/stats")
+async def executor_stats():
+    """
+    Running, queued and rejected searches of the bounded search executor, and
+    likewise of the rerank executor under "rerank".
+    """
+    return {**retriever.executor_stats(), "rerank": rerank_executor.stats()}
+
+
+@app.post("/api/v1/bm25/index/save")
+def save_index():
+    """
+    Save the index to `BM25_INDEX_PATH` so it survives a restart.
+    """
+    if not BM25_INDEX_PATH:
+        raise HTTPException(status_code=400, detail="BM25_INDEX_PATH is not set.")
+    retriever.save(BM25_INDEX_PATH)
+    return {"message": f"Index saved to {BM25_INDEX_PATH}."}
+
+
+@app.post("/api/v1/bm25/index/reload")
+def reload_index():
+    """
+    Reload the index from `BM25_INDEX_PATH`. The new index is opened while
+    searches keep running on the current one, then swapped in.
+    """
+    if not BM25_INDEX_PATH or not os.path.exists(BM25_INDEX_PATH):
+        raise HTTPException(status_code=404, detail="No saved index found.")
+    retriever.reload(BM25_INDEX_PATH)
+    return {"message": f"Index reloaded from {BM25_INDEX_PATH}."}
@@ -1,20 +1,110 @@
-from typing import List
-
-from fastapi import FastAPI
+import asyncio
+import base64
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import List, Literal, Optional, Union
+
+import numpy as np
+from fastapi import FastAPI, Response
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 
-from embeddings.bge_embedding import PABgeEmbeddings
-
-app = FastAPI()
-
+from embeddings.bge_embedding import DEFAULT_BGE_MODEL, PABgeEmbeddings
+from embeddings.embedding_cache import EmbeddingCache
+from embeddings.micro_batcher import MicroBatcher
+
+# Model name or local path. The model is loaded lazily, so importing this module
+# is cheap; with EMBED_PRELOAD it is loaded in the background at startup (and
+# warmed up with EMBED_WARMUP), otherwise on the first request or the first
+# /ready probe, whichever comes first. /ready reports whether it is done.
+EMBED_MODEL_PATH = os.environ.get("EMBED_MODEL_PATH", DEFAULT_BGE_MODEL)
+EMBED_PRELOAD = os.environ.get("EMBED_PRELOAD", "1") == "1"
+EMBED_WARMUP = os.environ.get("EMBED_WARMUP", "1") == "1"
+# Worker processes, each loading its own copy of the model, that large document
+# requests are spread over, 0 to encode in the server process only.
+EMBED_WORKERS = int(os.environ.get("EMBED_WORKERS", "0"))
+# Concurrent requests are coalesced into batches of up to EMBED_MAX_BATCH_SIZE
+# texts, each text waiting at most EMBED_MAX_DELAY_MS for others to join it.
+# Document requests with more texts are encoded as one call of their own.
+EMBED_MAX_BATCH_SIZE = int(os.environ.get("EMBED_MAX_BATCH_SIZE", "64"))
+EMBED_MAX_DELAY_MS = float(os.environ.get("EMBED_MAX_DELAY_MS", "5"))
+# Embedding cache: memory tier size, and an optional SQLite file for the disk
+# tier that persists across restarts.
+EMBED_CACHE_MEMORY_MB = int(os.environ.get("EMBED_CACHE_MEMORY_MB", "256"))
+EMBED_CACHE_PATH = os.environ.get("EMBED_CACHE_PATH")
+
+embedding_cache = EmbeddingCache(EMBED_CACHE_MEMORY_MB * 1024 * 1024, EMBED_CACHE_PATH)
 bge = PABgeEmbeddings(
-    model_name="/Users/kevintao/Desktop/working/models/BAAI/bge-large-zh-v1.5"
+    model_name=EMBED_MODEL_PATH,
+    cache=embedding_cache,
+    lazy_load=True,
+    n_workers=EMBED_WORKERS,
+    # every request too large for the coalescer is spread over the workers
+    pool_chunk_size=EMBED_MAX_BATCH_SIZE,
+)
+load_error: Optional[str] = None
+loading: Optional[asyncio.Task] = None
+
+# The transformer runs on the batchers' worker threads, never on the event loop.
+query_batcher = MicroBatcher(
+    bge.embed_queries_array, EMBED_MAX_BATCH_SIZE, EMBED_MAX_DELAY_MS / 1000
 )
+document_batcher = MicroBatcher(
+    bge.embed_documents_array, EMBED_MAX_BATCH_SIZE, EMBED_MAX_DELAY_MS / 1000
+)
+# Large document requests are length-bucketed as a whole, one at a time.
+bulk_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed-bulk")
+
+
+async def load_model():
+    """
+    Load (and warm up) the model on a worker thread, off the event loop.
+    """
+    global load_error
+    try:
+        await asyncio.to_thread(bge.warmup if EMBED_WARMUP else bge.load)
+    except Exception as e:
+        load_error = repr(e)
+
+
+def start_loading():
+    """
+    Start loading the model in the background, unless already started.
+    """
+    global loading
+    if loading is None:
+        loading = asyncio.create_task(load_model())
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if EMBED_PRELOAD:
+        start_loading()
+    yield
+    if loading is not None and not loading.done():
+        loading.cancel()
+    query_batcher.close()
+    document_batcher.close()
+    bulk_executor.shutdown()
+    bge.close()
+    embedding_cache.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+# How embeddings are returned: JSON numbers, a base64 string in JSON, or the
+# raw little-endian bytes as application/octet-stream with the shape and dtype
+# in the X-Embedding-Shape / X-Embedding-Dtype headers.
+EncodingFormat = Literal["float", "base64", "binary"]
 
 
 # Request model for embedding documents
 class DocumentsRequest(BaseModel):
     texts: List[str]
+    encoding_format: EncodingFormat = "float"
+    dtype: Literal["float32", "float16"] = "float32"
 
 
 # Response model for embedding documents
@@ -25,6 +115,8 @@ class DocumentsResponse(BaseModel):
 # Request model for embedding a query
 class QueryRequest(BaseModel):
     text: str
+    encoding_format: EncodingFormat = "float"
+    dtype: Literal["float32", "float16"] = "float32"
 
 
 # Response model for embedding a query
@@ -32,39 +124,122 @@ class QueryResponse(BaseModel):
     embedding: List[float]
 
 
+# Response model for base64 encoded embeddings
+class EncodedEmbeddingResponse(BaseModel):
+    data: str
+    shape: List[int]
+    dtype: str
+
+
+def encode_embeddings(
+    embeddings: np.ndarray, encoding_format: str, dtype: str
+) -> Union[EncodedEmbeddingResponse, Response]:
+    """
+    Serialize an embedding array as little-endian `dtype`, either base64 in JSON
+    or as a raw binary body.
+    """
+    data = embeddings.astype(np.dtype(dtype).newbyteorder("<"), copy=False).tobytes()
+    if encoding_format == "binary":
+        return Response(
+            content=data,
+            media_type="application/octet-stream",
+            headers={
+                "X-Embedding-Shape": ",".join(map(str, embeddings.shape)),
+                "X-Embedding-Dtype": dtype,
+            },
+        )
+    return EncodedEmbeddingResponse(
+        data=base64.b64encode(data).decode("ascii"),
+        shape=list(embeddings.shape),
+        dtype=dtype,
+    )
+
+
 @app.get("/")
 async def health():
+    """
+    Liveness: the process is up and serving, whether or not the model is loaded.
+    """
     return {"status": "ok"}
 
 
-@app.post("/api/v1/bge/embed/documents", response_model=DocumentsResponse)
+@app.get("/ready")
+async def ready():
+    """
+    Readiness: the model is loaded, and warmed up if EMBED_WARMUP is set.
+    Answers 503 until then, or if loading failed. Without EMBED_PRELOAD the
+    first probe starts loading the model.
+    """
+    start_loading()
+    if load_error is not None:
+        return JSONResponse(
+            status_code=503, content={"status": "failed", "error": load_error}
+        )
+    if not bge.loaded or (EMBED_WARMUP and not bge.warm):
+        return JSONResponse(status_code=503, content={"status": "loading"})
+    return {"status": "ready", "model": bge.model_name}
+
+
+@app.post(
+    "/api/v1/bge/embed/documents",
+    response_model=Union[DocumentsResponse, EncodedEmbeddingResponse],
+)
 async def embed_documents(request: DocumentsRequest):
     """
     Embed a list of documents into vector embeddings using the PABgeEmbeddings class.
 
     Args:
-        request (DocumentsRequest): A request containing a list of texts to embed.
+        request (DocumentsRequest): A request containing a list of texts to embed,
+            and optionally the `encoding_format` ("float", "base64" or "binary")
+            and `dtype` ("float32" or "float16") of the embeddings.
 
     Returns:
-        DocumentsResponse: A response containing a list of vector embeddings.
+        DocumentsResponse: A response containing a list of vector embeddings,
+            or the (len(texts), dim) array encoded as requested.
     """
-    embeddings = bge.embed_documents(request.texts)
-    return DocumentsResponse(embeddings=embeddings)
-
-
-@app.post("/api/v1/bge/embed/query", response_model=QueryResponse)
+    if len(request.texts) > EMBED_MAX_BATCH_SIZE:
+        embeddings = await asyncio.wrap_future(
+            bulk_executor.submit(bge.embed_documents_array, request.texts)
+        )
+    elif request.texts:
+        futures = document_batcher.submit_many(request.texts)
+        embeddings = np.stack(await asyncio.gather(*map(asyncio.wrap_future, futures)))
+    else:
+        # finds the dimension, which may need the model loaded: off the loop
+        embeddings = await asyncio.to_thread(bge.embed_documents_array, [])
+    if request.encoding_format == "float":
+        return DocumentsResponse(embeddings=embeddings.astype(request.dtype).tolist())
+    return encode_embeddings(embeddings, request.encoding_format, request.dtype)
+
+
+@app.post(
+    "/api/v1/bge/embed/query",
+    response_model=Union[QueryResponse, EncodedEmbeddingResponse],
+)
 async def embed_query(request: QueryRequest):
     """
     Embed a single query text into a vector embedding using the PABgeEmbeddings class.
 
     Args:
-        request (QueryRequest): A request containing a single query text.
+        request (QueryRequest): A request containing a single query text, and
+            optionally the `encoding_format` and `dtype` as for documents.
 
     Returns:
-        QueryResponse: A response containing the query's vector embedding.
+        QueryResponse: A response containing the query's vector embedding,
+            or the (dim,) array encoded as requested.
+    """
+    embedding = await asyncio.wrap_future(query_batcher.submit(request.text))
+    if request.encoding_format == "float":
+        return QueryResponse(embedding=embedding.astype(request.dtype).tolist())
+    return encode_embeddings(embedding, request.encoding_format, request.dtype)
+
+
+@app.get("/api/v1/bge/cache/stats")
+async def cache_stats():
+    """
+    Hit counters, hit rate and bytes used by the embedding cache tiers.
     """
-    embedding = bge.embed_query(request.text)
-    return QueryResponse(embedding=embedding)
+    return embedding_cache.stats()
 
 
 if __name__ == "__main__":
@@ -1,11 +1,26 @@
-from typing import Any, Dict, List, Optional
+import json
+import threading
+import time
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional
 
+import numpy as np
 from langchain_core.embeddings import Embeddings
-from pydantic import BaseModel, ConfigDict, Field
-from sentence_transformers.SentenceTransformer import SentenceTransformer
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr
+
+from embeddings.compression import EmbeddingCompressor
+from embeddings.embedding_cache import EmbeddingCache, embedding_key
+from embeddings.embedding_pool import EmbeddingPool
 
 DEFAULT_BGE_MODEL = "BAAI/bge-large-zh-v1.5"
 DEFAULT_QUERY_BGE_INSTRUCTION_ZH = "为这个句子生成表示以用于检索相关文章："
+# Texts of a few lengths, so that warmup exercises several sequence shapes.
+WARMUP_TEXTS = ["检索", "为这个句子生成表示以用于检索相关文章", "warmup " * 200]
+
+# model_kwargs handled here rather than by SentenceTransformer
+ACCELERATION_KWARGS = ("quantize", "torch_threads", "torch_interop_threads")
+# model_kwargs that do not change the embeddings, left out of the cache key
+PLACEMENT_KWARGS = ("device", "torch_threads", "torch_interop_threads")
 
 
 class PABgeEmbeddings(BaseModel, Embeddings):
@@ -24,6 +39,31 @@ class PABgeEmbeddings(BaseModel, Embeddings):
                 model_kwargs=model_kwargs,
                 encode_kwargs=encode_kwargs
             )
+
+    CPU acceleration is chosen via model_kwargs:
+
+    - ``backend="onnx"``: run on ONNX Runtime, exporting the model on first
+      load (needs ``sentence-transformers[onnx]``). A pre-quantized export is
+      picked by a nested ``model_kwargs={"file_name": "onnx/model_qint8_...onnx"}``.
+    - ``quantize="int8"``: dynamic int8 quantization of the linear layers of
+      the torch model.
+    - ``torch_threads`` / ``torch_interop_threads``: size of the torch intra-op
+      and inter-op thread pools.
+
+    `parity_check` reports the cosine drift of such a configuration against
+    the fp32 torch model.
+
+        .. code-block:: python
+
+            bge = PABgeEmbeddings(
+                model_name=model_name,
+                model_kwargs={"device": "cpu", "quantize": "int8", "torch_threads": 8},
+            )
+            bge.parity_check(sample_texts)
+
+    With ``lazy_load=True`` the model is loaded on first use (or by `load`),
+    so that constructing the embeddings object is cheap; `warmup` loads it and
+    runs a few encodings ahead of the first real request.
     """
 
     client: Any = None  #: :meta private:
@@ -42,32 +82,250 @@ class PABgeEmbeddings(BaseModel, Embeddings):
     """Instruction to use for embedding document."""
     show_progress: bool = False
     """Whether to show a progress bar."""
+    batch_tokens: int = 16384
+    """Max padded tokens per encoding batch, i.e. batch size times the token
+    count of its longest text. Texts are grouped by length so that short texts
+    are not padded to the length of long ones."""
+    cache: Optional[EmbeddingCache] = None
+    """Cache consulted before the model, keyed on the model, its settings and
+    the instruction-prefixed text; only misses are encoded."""
+    lazy_load: bool = False
+    """Defer loading the model until it is first needed."""
+    n_workers: int = 0
+    """Worker processes, each loading its own copy of the model (see
+    `EmbeddingPool`), that documents are encoded on, 0 to encode in this
+    process."""
+    pool_chunk_size: int = 256
+    """Max texts per worker task; inputs of at most this many texts are encoded
+    in this process."""
+    compressor: Optional[EmbeddingCompressor] = None
+    """Fitted dimension reduction applied to every embedding returned, and
+    quantization applied by the `*_quantized` methods. The cache holds the
+    uncompressed embeddings."""
+
+    _load_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _loaded: bool = PrivateAttr(default=False)
+    _warm: bool = PrivateAttr(default=False)
+    _pool: Optional[EmbeddingPool] = PrivateAttr(default=None)
+    _dimension: Optional[int] = PrivateAttr(default=None)
 
     def __init__(self, **kwargs: Any):
         """Initialize the sentence_transformer."""
         super().__init__(**kwargs)
 
         self.query_instruction = DEFAULT_QUERY_BGE_INSTRUCTION_ZH
-        self.client = SentenceTransformer(
-            self.model_name, cache_folder=self.cache_folder, **self.model_kwargs
-        )
+        if not self.lazy_load:
+            self.load()
+
+    model_config = ConfigDict(
+        extra="forbid", protected_namespaces=(), arbitrary_types_allowed=True
+    )
 
-    model_config = ConfigDict(extra="forbid", protected_namespaces=())
+    @property
+    def loaded(self) -> bool:
+        """Whether the model (and worker pool) is loaded."""
+        return self._loaded
+
+    @property
+    def warm(self) -> bool:
+        """Whether `warmup` has completed."""
+        return self._warm
+
+    def load(self) -> Any:
+        """Load the model unless already loaded; safe to call from several
+        threads, the model is loaded once.
+
+        Returns:
+            The SentenceTransformer model.
+        """
+        if self._loaded:
+            return self.client
+        with self._load_lock:
+            if not self._loaded:
+                self.client = self._load_client()
+                if self.n_workers:
+                    self._pool = EmbeddingPool(
+                        self, self.n_workers, self.pool_chunk_size
+                    )
+                self._loaded = True
+        return self.client
+
+    def close(self) -> None:
+        """Stop the worker processes, if any."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def warmup(self, texts: Optional[List[str]] = None) -> None:
+        """Load the model and encode a few texts, so that one-off costs (lazy
+        kernel and allocator initialization) are not paid by the first request.
+
+        Args:
+            texts: Texts to encode, by default `WARMUP_TEXTS`.
+        """
+        self.load()
+        self._encode_batched(texts or WARMUP_TEXTS)
+        self._warm = True
+
+    def _load_client(self) -> Any:
+        from sentence_transformers.SentenceTransformer import SentenceTransformer
+
+        model_kwargs = {
+            k: v for k, v in self.model_kwargs.items() if k not in ACCELERATION_KWARGS
+        }
+        _configure_torch_threads(
+            self.model_kwargs.get("torch_threads"),
+            self.model_kwargs.get("torch_interop_threads"),
+        )
+        client = SentenceTransformer(
+            self.model_name, cache_folder=self.cache_folder, **model_kwargs
+        )
+        quantize = self.model_kwargs.get("quantize")
+        if quantize:
+            _quantize_dynamic(client, quantize, model_kwargs)
+        return client
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         """Compute doc embeddings using a transformer model.
 
+        Texts are encoded in batches of similar length bounded by
+        `batch_tokens`, and the embeddings are returned in input order.
+
         Args:
             texts: The list of texts to embed.
 
         Returns:
             List of embeddings, one for each text.
         """
-        texts = [self.embed_instruction + t.replace("\n", " ") for t in texts]
-        embeddings = self.client.encode(
-            texts, show_progress_bar=self.show_progress, **self.encode_kwargs
+        return self.embed_documents_array(texts).tolist()
+
+    def embed_documents_array(self, texts: List[str]) -> np.ndarray:
+        """Compute doc embeddings as a float32 array of shape (len(texts), dim),
+        without converting them to Python floats.
+
+        Args:
+            texts: The list of texts to embed.
+
+        Returns:
+            Array of embeddings, one row for each text.
+        """
+        if not texts:
+            dim = self.compressor.dim if self.compressor is not None else None
+            return np.zeros((0, dim or self._model_dimension()), dtype=np.float32)
+        return next(self.iter_embed_documents_array(texts, window=len(texts)))
+
+    def iter_embed_documents(
+        self, texts: Iterable[str], window: int = 4096
+    ) -> Iterator[List[List[float]]]:
+        """Lazily compute doc embeddings, `window` texts at a time.
+
+        Only `window` texts and their embeddings are held at once, so corpora
+        of any size can be streamed through. Within a window, texts are
+        batched by length as in `embed_documents`.
+
+        Args:
+            texts: The texts to embed, e.g. a generator over a file.
+            window: Number of texts read, sorted and embedded together.
+
+        Returns:
+            Iterator over the embeddings of each window, in input order.
+        """
+        for embeddings in self.iter_embed_documents_array(texts, window):
+            yield embeddings.tolist()
+
+    def iter_embed_documents_array(
+        self, texts: Iterable[str], window: int = 4096
+    ) -> Iterator[np.ndarray]:
+        """Like `iter_embed_documents`, yielding a float32 array per window."""
+        texts = iter(texts)
+        while True:
+            chunk = [
+                self.embed_instruction + t.replace("\n", " ")
+                for t in islice(texts, window)
+            ]
+            if not chunk:
+                return
+            yield self._reduce(self._encode(chunk))
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        """Embed model inputs, serving cached ones from `cache`."""
+        if self.cache is None:
+            return self._encode_uncached(texts)
+        model_kwargs = {
+            k: v for k, v in self.model_kwargs.items() if k not in PLACEMENT_KWARGS
+        }
+        namespace = json.dumps(
+            [self.model_name, model_kwargs, self.encode_kwargs],
+            sort_keys=True,
+            default=str,
+        )
+        keys = [embedding_key(namespace, text) for text in texts]
+        cached = self.cache.get_many(keys)
+        # each distinct missing input is encoded once
+        missing: Dict[bytes, int] = {}
+        for i, vector in enumerate(cached):
+            if vector is None:
+                missing.setdefault(keys[i], i)
+        if missing:
+            fresh = self._encode_uncached([texts[i] for i in missing.values()])
+            self.cache.put_many(list(missing), fresh)
+            rows = dict(zip(missing, fresh))
+            cached = [rows[k] if v is None else v for k, v in zip(keys, cached)]
+        return np.stack(cached)
+
+    def _encode_uncached(self, texts: List[str]) -> np.ndarray:
+        """Embed model inputs on the worker pool if they fill several tasks."""
+        self.load()
+        if self._pool is not None and len(texts) > self.pool_chunk_size:
+            return self._pool.encode(texts)
+        return self._encode_batched(texts)
+
+    def _encode_batched(self, texts: List[str]) -> np.ndarray:
+        """Embed model inputs in length-bucketed batches, in input order. The
+        model must be loaded."""
+        embeddings: Optional[np.ndarray] = None
+        client = self.client
+        progress = None
+        if self.show_progress:
+            from tqdm.auto import tqdm
+
+            progress = tqdm(total=len(texts))
+        for batch in self._length_batches(texts):
+            encoded = client.encode(
+                [texts[i] for i in batch],
+                **{
+                    "show_progress_bar": False,
+                    **self.encode_kwargs,
+                    "batch_size": len(batch),
+                    "convert_to_numpy": True,
+                },
+            )
+            if embeddings is None:
+                embeddings = np.empty((len(texts), encoded.shape[1]), np.float32)
+            embeddings[batch] = encoded
+            if progress is not None:
+                progress.update(len(batch))
+        if progress is not None:
+            progress.close()
+        return embeddings
+
+    def _length_batches(self, texts: List[str]) -> Iterator[List[int]]:
+        """Positions of `texts` grouped into batches of similar token length,
+        longest first, each within `batch_tokens` once padded."""
+        client = self.client
+        tokenized = client.tokenizer(
+            texts, truncation=True, max_length=client.max_seq_length
         )
-        return embeddings.tolist()
+        lengths = np.array([len(ids) for ids in tokenized["input_ids"]])
+        batch: List[int] = []
+        for i in np.argsort(-lengths, kind="stable").tolist():
+            # sorted descending, so the batch's first text is its longest
+            if batch and (len(batch) + 1) * lengths[batch[0]] > self.batch_tokens:
+                yield batch
+                batch = []
+            batch.append(i)
+        if batch:
+            yield batch
 
     def embed_query(self, text: str) -> List[float]:
         """Compute query embeddings using a transformer model.
@@ -78,10 +336,147 @@ class PABgeEmbeddings(BaseModel, Embeddings):
         Returns:
             Embeddings for the text.
         """
-        text = text.replace("\n", " ")
-        embedding = self.client.encode(
-            self.query_instruction + text,
-            show_progress_bar=self.show_progress,
-            **self.encode_kwargs,
+        return self.embed_query_array(text).tolist()
+
+    def embed_queries_array(self, texts: List[str]) -> np.ndarray:
+        """Compute embeddings of many queries in one batch, as a float32 array
+        of shape (len(texts), dim).
+
+        Args:
+            texts: The queries to embed.
+
+        Returns:
+            Array of embeddings, one row for each query.
+        """
+        if not texts:
+            return self.embed_documents_array([])
+        return self._reduce(
+            self._encode([self.query_instruction + t.replace("\n", " ") for t in texts])
         )
-        return embedding.tolist()
+
+    def embed_query_array(self, text: str) -> np.ndarray:
+        """Compute a query embedding as a float32 array of shape (dim,).
+
+        Args:
+            text: The text to embed.
+
+        Returns:
+            Embedding for the text.
+        """
+        return self.embed_queries_array([text])[0]
+
+    def embed_documents_quantized(self, texts: List[str]) -> np.ndarray:
+        """Compute doc embeddings reduced and quantized by `compressor`, e.g.
+        int8 codes or packed bits to store.
+
+        Args:
+            texts: The list of texts to embed.
+
+        Returns:
+            Array of codes, one row for each text.
+        """
+        if self.compressor is None:
+            raise ValueError("embed_documents_quantized needs a compressor.")
+        if not texts:
+            dim = self._model_dimension()
+            return self.compressor.quantize(np.zeros((0, dim), dtype=np.float32))
+        inputs = [self.embed_instruction + t.replace("\n", " ") for t in texts]
+        return self.compressor.quantize(self._encode(inputs))
+
+    def _model_dimension(self) -> int:
+        """Size of the model's embeddings, taken from a fitted compressor or
+        from the model, loading it once if needed."""
+        if self.compressor is not None and "input_dim" in self.compressor.params:
+            return int(self.compressor.params["input_dim"])
+        if self._dimension is None:
+            self._dimension = self.load().get_sentence_embedding_dimension()
+        return self._dimension
+
+    def _reduce(self, embeddings: np.ndarray) -> np.ndarray:
+        if self.compressor is None:
+            return embeddings
+        return self.compressor.reduce(embeddings)
+
+    def parity_check(
+        self,
+        texts: List[str],
+        baseline: Optional["PABgeEmbeddings"] = None,
+    ) -> Dict[str, float]:
+        """Compare this model's document embeddings with an fp32 baseline.
+
+        Args:
+            texts: Sample texts, ideally drawn from the production corpus.
+            baseline: Reference model; by default the same model loaded with
+                the plain torch backend on CPU.
+
+        Returns:
+            Cosine similarity to the baseline (mean, min) and drift, i.e.
+            1 - cosine (mean, p99, max), plus the encoding time of both models.
+        """
+        if baseline is None:
+            baseline = PABgeEmbeddings(
+                model_name=self.model_name,
+                cache_folder=self.cache_folder,
+                model_kwargs={"device": "cpu"},
+                encode_kwargs=self.encode_kwargs,
+                batch_tokens=self.batch_tokens,
+                lazy_load=self.lazy_load,
+            )
+        inputs = [self.embed_instruction + t.replace("\n", " ") for t in texts]
+        self.load()
+        baseline.load()
+        # encode past the caches, so both sides are actually computed
+        start = time.perf_counter()
+        expected = baseline._encode_batched(inputs)
+        baseline_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        actual = self._encode_batched(inputs)
+        seconds = time.perf_counter() - start
+
+        cosine = np.sum(expected * actual, axis=1) / (
+            np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1)
+        )
+        drift = 1 - cosine
+        return {
+            "mean_cosine": float(cosine.mean()),
+            "min_cosine": float(cosine.min()),
+            "mean_drift": float(drift.mean()),
+            "p99_drift": float(np.percentile(drift, 99)),
+            "max_drift": float(drift.max()),
+            "baseline_seconds": baseline_seconds,
+            "seconds": seconds,
+            "speedup": baseline_seconds / seconds if seconds else float("inf"),
+        }
+
+
+def _configure_torch_threads(
+    threads: Optional[int], interop_threads: Optional[int]
+) -> None:
+    if not threads and not interop_threads:
+        return
+    import torch
+
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # only settable before the first inter-op parallel work in the process
+            pass
+
+
+def _quantize_dynamic(client: Any, quantize: str, model_kwargs: Dict[str, Any]) -> None:
+    """Replace the linear layers of a torch model by dynamically quantized ones."""
+    if quantize != "int8":
+        raise ValueError(f"Unsupported quantization {quantize!r}, expected 'int8'")
+    if model_kwargs.get("backend", "torch") != "torch":
+        raise ValueError(
+            "quantize='int8' applies to the torch backend; for ONNX select a "
+            "quantized export with model_kwargs={'file_name': ...}."
+        )
+    import torch
+
+    torch.ao.quantization.quantize_dynamic(
+        client, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+    )
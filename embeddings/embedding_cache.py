@@ -0,0 +1,160 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+
+def embedding_key(namespace: str, text: str) -> bytes:
+    """Cache key of a model input. Whitespace runs are collapsed, since the
+    tokenizer splits on them anyway."""
+    normalized = " ".join(text.split())
+    data = f"{namespace}\0{normalized}".encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class EmbeddingCache:
+    """Content-addressed embedding cache with a memory tier and a disk tier.
+
+    Embeddings are stored as float32 under a hash of the model and its input
+    (see `embedding_key`). The memory tier is an LRU bounded by
+    `max_memory_bytes`; with a `path`, every embedding is also written to a
+    SQLite database there, which survives restarts and can be shared by
+    processes. Disk hits are promoted to memory.
+
+    Example:
+        .. code-block:: python
+
+            cache = EmbeddingCache(path="/data/bge_cache.sqlite")
+            bge = PABgeEmbeddings(model_name=model_name, cache=cache)
+    """
+
+    def __init__(
+        self, max_memory_bytes: int = 256 * 1024 * 1024, path: Optional[str] = None
+    ):
+        """
+        Args:
+            max_memory_bytes: Size bound of the in-memory tier, 0 to disable it.
+            path: SQLite file of the disk tier, `None` for memory only.
+        """
+        self.max_memory_bytes = max_memory_bytes
+        self.path = path
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key BLOB PRIMARY KEY, vector BLOB NOT NULL)"
+            )
+            self._db.commit()
+
+    def get_many(self, keys: Sequence[bytes]) -> List[Optional[np.ndarray]]:
+        """Embeddings of `keys`, `None` for those not cached."""
+        found: List[Optional[np.ndarray]] = [None] * len(keys)
+        with self._lock:
+            missing = []
+            for i, key in enumerate(keys):
+                vector = self._memory.get(key)
+                if vector is None:
+                    missing.append(i)
+                else:
+                    self._memory.move_to_end(key)
+                    found[i] = vector
+            self.memory_hits += len(keys) - len(missing)
+            if missing and self._db is not None:
+                on_disk = self._read([keys[i] for i in missing])
+                for i in missing:
+                    vector = on_disk.get(keys[i])
+                    if vector is not None:
+                        found[i] = vector
+                        self._remember(keys[i], vector)
+                        self.disk_hits += 1
+            self.misses += sum(v is None for v in found)
+        return found
+
+    def put_many(self, keys: Sequence[bytes], embeddings: np.ndarray) -> None:
+        """Store one embedding (row of `embeddings`) per key."""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        with self._lock:
+            for key, vector in zip(keys, embeddings):
+                self._remember(key, vector.copy())
+            if self._db is not None:
+                with self._db:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO embeddings VALUES (?, ?)",
+                        [(k, v.tobytes()) for k, v in zip(keys, embeddings)],
+                    )
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit counters, hit rate and bytes used by each tier."""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            hits = self.memory_hits + self.disk_hits
+            stats = {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+            }
+            if self._db is not None:
+                (page_count,) = self._db.execute("PRAGMA page_count").fetchone()
+                (page_size,) = self._db.execute("PRAGMA page_size").fetchone()
+                (entries,) = self._db.execute(
+                    "SELECT COUNT(*) FROM embeddings"
+                ).fetchone()
+                stats["disk_entries"] = entries
+                stats["disk_bytes"] = page_count * page_size
+            return stats
+
+    def clear(self) -> None:
+        """Drop every cached embedding from both tiers."""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            if self._db is not None:
+                with self._db:
+                    self._db.execute("DELETE FROM embeddings")
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _read(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        found = {}
+        # stay below SQLite's limit on bound parameters per statement
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            rows = self._db.execute(
+                "SELECT key, vector FROM embeddings WHERE key IN "
+                f"({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for key, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=np.float32)
+        return found
+
+    def _remember(self, key: bytes, vector: np.ndarray) -> None:
+        if vector.nbytes > self.max_memory_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= previous.nbytes
+        self._memory[key] = vector
+        self._memory_bytes += vector.nbytes
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted.nbytes
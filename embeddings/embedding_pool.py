@@ -0,0 +1,120 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Set
+
+import numpy as np
+
+# model_kwargs sizing torch's thread pools, replaced in workers by their cores
+_THREAD_KWARGS = ("torch_threads", "torch_interop_threads")
+
+# The embeddings object of a worker process, loaded by its initializer.
+_embeddings: Any = None
+
+
+def _init_worker(
+    cores: "multiprocessing.Queue", cls: type, settings: Dict[str, Any]
+) -> None:
+    """Pin a fresh worker to its own core set, load its copy of the model and
+    size torch's thread pool to the core set."""
+    global _embeddings
+    worker_cores: Set[int] = cores.get()
+    if worker_cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, worker_cores)
+    model_kwargs = {
+        k: v for k, v in settings["model_kwargs"].items() if k not in _THREAD_KWARGS
+    }
+    if worker_cores:
+        model_kwargs["torch_threads"] = len(worker_cores)
+    _embeddings = cls(**{**settings, "model_kwargs": model_kwargs})
+
+
+def _encode_chunk(texts: List[str]) -> np.ndarray:
+    return _embeddings._encode_batched(texts)
+
+
+def _ping(_: int) -> int:
+    return os.getpid()
+
+
+def split_cores(
+    n_workers: int, cores: Optional[Sequence[int]] = None
+) -> List[Set[int]]:
+    """Split the usable cores into `n_workers` disjoint, near-equal sets."""
+    if cores is None:
+        if hasattr(os, "sched_getaffinity"):
+            cores = sorted(os.sched_getaffinity(0))
+        else:
+            cores = list(range(os.cpu_count() or 1))
+    if n_workers > len(cores):
+        raise ValueError(f"{n_workers} workers for only {len(cores)} cores.")
+    return [set(cores[i::n_workers]) for i in range(n_workers)]
+
+
+class EmbeddingPool:
+    """Worker processes embedding texts in parallel, one model per worker.
+
+    Workers are started with the spawn method, so the pool can be created at
+    any time, e.g. from a thread of a server already running torch: forking
+    such a process could deadlock a child on a lock or OpenMP thread pool it
+    inherited mid-use. Each worker loads the model itself with the settings of
+    the parent's embeddings, so memory for the weights grows with the number
+    of workers. Each worker is pinned to a disjoint set of cores, with torch
+    using one thread per core of its set. Large inputs are cut into chunks
+    that the workers encode in parallel.
+
+    Example:
+        .. code-block:: python
+
+            bge = PABgeEmbeddings(model_name=model_name, n_workers=4)
+            embeddings = bge.embed_documents_array(corpus)
+    """
+
+    def __init__(
+        self,
+        embeddings: Any,
+        n_workers: int,
+        chunk_size: int = 256,
+        cores: Optional[Sequence[int]] = None,
+    ):
+        """
+        Args:
+            embeddings: `PABgeEmbeddings` whose model settings the workers use.
+            n_workers: Number of worker processes.
+            chunk_size: Number of texts sent to a worker at a time.
+            cores: Cores to spread the workers over, by default all the cores
+                this process may run on.
+        """
+        self.n_workers = n_workers
+        self.chunk_size = chunk_size
+        core_sets = split_cores(n_workers, cores)
+        context = multiprocessing.get_context("spawn")
+        queue = context.Queue()
+        for worker_cores in core_sets:
+            queue.put(worker_cores)
+
+        settings = {
+            "model_name": embeddings.model_name,
+            "cache_folder": embeddings.cache_folder,
+            "model_kwargs": embeddings.model_kwargs,
+            "encode_kwargs": embeddings.encode_kwargs,
+            "batch_tokens": embeddings.batch_tokens,
+        }
+        self._executor = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(queue, type(embeddings), settings),
+        )
+        # start every worker now, so that their models are loaded up front
+        list(self._executor.map(_ping, range(n_workers)))
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Embed model inputs across the workers, in input order. Inputs of
+        fewer than `n_workers` chunks are split evenly over the workers."""
+        size = min(self.chunk_size, -(-len(texts) // self.n_workers))
+        chunks = [texts[i : i + size] for i in range(0, len(texts), size)]
+        return np.concatenate(list(self._executor.map(_encode_chunk, chunks)))
+
+    def close(self) -> None:
+        self._executor.shutdown()
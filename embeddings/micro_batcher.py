@@ -0,0 +1,104 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+class MicroBatcher:
+    """Coalesce texts submitted from many threads or requests into batches.
+
+    Texts are queued and a dedicated worker thread flushes them to `encode` as
+    one batch once `max_batch_size` texts are waiting or the oldest has waited
+    `max_delay` seconds, whichever comes first. Each submitter gets a future
+    resolved with its own row of the batch result.
+
+    Example:
+        .. code-block:: python
+
+            batcher = MicroBatcher(bge.embed_queries_array, max_delay=0.005)
+            embedding = batcher.submit("query").result()
+            # or, in a coroutine
+            embedding = await asyncio.wrap_future(batcher.submit("query"))
+    """
+
+    def __init__(
+        self,
+        encode: Callable[[List[str]], np.ndarray],
+        max_batch_size: int = 64,
+        max_delay: float = 0.005,
+    ):
+        """
+        Args:
+            encode: Function embedding a list of texts into one row each.
+            max_batch_size: Max number of texts per call to `encode`.
+            max_delay: Max seconds a text waits for others to batch with.
+        """
+        self.encode = encode
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._queue: "queue.Queue[Optional[Tuple[str, Future]]]" = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="micro-batcher", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, text: str) -> Future:
+        """Queue a text; the future resolves to its embedding."""
+        if self._closed:
+            raise RuntimeError("MicroBatcher is closed.")
+        future: Future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def submit_many(self, texts: Sequence[str]) -> List[Future]:
+        """Queue texts; they may be spread over several batches."""
+        return [self.submit(text) for text in texts]
+
+    def close(self) -> None:
+        """Flush the texts already queued and stop the worker thread."""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = (
+                        self._queue.get(timeout=timeout)
+                        if timeout > 0
+                        else self._queue.get_nowait()
+                    )
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+
+    def _flush(self, batch: List[Tuple[str, Future]]) -> None:
+        # callers that gave up (e.g. disconnected clients) are not encoded
+        batch = [(t, f) for t, f in batch if f.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            embeddings: Any = self.encode([text for text, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), embedding in zip(batch, embeddings):
+            future.set_result(embedding)
@@ -0,0 +1,918 @@
+import json
+import mmap
+import os
+import shutil
+from collections import Counter
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+import numpy as np
+from langchain_core.documents import Document
+
+from retrievers.metadata_index import MetadataIndex
+
+INDEX_FORMAT_VERSION = 2
+
+VARIANTS = ("okapi", "bm25l", "bm25plus")
+"""Term weighting functions supported by :class:`BM25Index`."""
+
+# Default lower bound added to the term frequency component by BM25L and BM25+.
+_DEFAULT_DELTA = {"okapi": 0.0, "bm25l": 0.5, "bm25plus": 1.0}
+
+# Quantized impacts take 255 levels of the variant's saturation limit, and are
+# recomputed once the average document length has drifted by more than this
+# fraction from the one they were computed with.
+_IMPACT_LEVELS = 255
+_IMPACT_AVGDL_TOLERANCE = 0.01
+
+# Upper bound on the (query, document) pairs scored at once by batch search;
+# larger queries are searched on their own with MaxScore. A block is scored as
+# a dense rows-by-slots matrix when that has at most four cells per pair, as
+# with queries of common terms, and by sorting its pairs otherwise.
+_BATCH_PAIRS = 1 << 21
+
+_EMPTY = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64))
+
+
+class CollectionStats(NamedTuple):
+    """Corpus-wide statistics to score with instead of the index's own, when the
+    index holds one shard of a larger corpus."""
+
+    idf: Dict[str, float]
+    """IDF of (at least) the query terms over the whole corpus."""
+    avgdl: float
+    """Average document length over the whole corpus."""
+
+
+class _Postings(NamedTuple):
+    """Postings of all terms in CSR layout, as written by :meth:`BM25Index.save`."""
+
+    offsets: np.ndarray
+    slots: np.ndarray
+    tfs: np.ndarray
+    max_tf: np.ndarray
+    impacts: Optional[np.ndarray]
+
+
+class _LazyList:
+    """List-like view that loads items on access and keeps writes in memory."""
+
+    def __init__(self, size: int, load: Callable[[int], Any]):
+        self._size = size
+        self._load = load
+        self._items: Dict[int, Any] = {}
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, i: int) -> Any:
+        try:
+            return self._items[i]
+        except KeyError:
+            return self._load(i)
+
+    def __setitem__(self, i: int, value: Any) -> None:
+        self._items[i] = value
+
+    def __iter__(self):
+        return (self[i] for i in range(self._size))
+
+    def append(self, value: Any) -> None:
+        self._items[self._size] = value
+        self._size += 1
+
+
+class BM25Index:
+    """Incrementally updatable BM25 inverted index.
+
+    Postings are kept per term as ``{slot: tf}``, so adding, updating or deleting
+    a document only touches the terms it contains. Document frequencies and
+    lengths are maintained in place; IDF and the average document length are
+    recomputed lazily on the first query after a write.
+
+    ``variant`` selects Okapi BM25 (as ``rank_bm25.BM25Okapi``), BM25L or BM25+;
+    the latter two lower-bound the term frequency component by ``delta`` so long
+    documents are not over-penalised. With ``field_weights`` the index scores
+    BM25F: occurrences in the given metadata fields (tokenized by the caller,
+    see :meth:`add`) count ``weight`` times towards the term frequency and the
+    document length, e.g. ``{"title": 3.0}``; ``page_content`` weighs 1 unless
+    listed.
+
+    With ``quantize``, the saturated term frequency of every posting is stored
+    as a byte, computed when the term is first searched after a write and
+    written by :meth:`save`, so scoring a posting is one multiply-add of a
+    small integer. Impacts are recomputed once the average document length has
+    drifted by more than 1% from the one they were computed with.
+
+    An index written with :meth:`save` can be reopened with :meth:`load`, which
+    memory-maps the postings and the document store instead of reading them.
+    Postings of a loaded term are only copied into memory once the term is
+    written to.
+    """
+
+    def __init__(
+        self,
+        k1: float = 1.5,
+        b: float = 0.75,
+        epsilon: float = 0.25,
+        variant: str = "okapi",
+        delta: Optional[float] = None,
+        field_weights: Optional[Dict[str, float]] = None,
+        quantize: bool = False,
+    ):
+        if variant not in VARIANTS:
+            raise ValueError(f"Unknown BM25 variant {variant!r}, expected {VARIANTS}")
+        if field_weights and min(field_weights.values()) <= 0:
+            raise ValueError("Field weights must be positive.")
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.variant = variant
+        self.delta = _DEFAULT_DELTA[variant] if delta is None else delta
+        if variant == "okapi":
+            self.delta = 0.0
+        self.field_weights = field_weights or None
+        self.quantize = quantize
+
+        # term -> term id, term id -> {slot: tf}, term id -> document frequency.
+        # Postings are ``None`` while they are only in the loaded ``_base``.
+        self.vocab: Dict[str, int] = {}
+        self.postings: List[Optional[Dict[int, float]]] = []
+        self.df = np.zeros(0, dtype=np.int32)
+        self._base: Optional[_Postings] = None
+        # metadata filters, built from the documents on first use after a load
+        self._metadata: Optional[MetadataIndex] = MetadataIndex()
+
+        # slot -> document / distinct term ids / length, ``None`` for free slots
+        self.docs: Union[List[Optional[Document]], _LazyList] = []
+        self.doc_terms: Union[List[Optional[np.ndarray]], _LazyList] = []
+        self.doc_len = np.zeros(0, dtype=np.float64)
+        self.id_to_slot: Dict[str, int] = {}
+        self.free_slots: List[int] = []
+        # slots indexed but not yet returned by searches, see hide()
+        self.hidden: Set[int] = set()
+
+        self.n_docs = 0
+        self.total_len = 0
+        # bumped by every write, so results computed earlier can be recognised
+        self.generation = 0
+        self._idf: Optional[np.ndarray] = None
+        # term id -> postings as arrays, dropped whenever the term is touched
+        self._arrays: Dict[int, Tuple[np.ndarray, np.ndarray, float]] = {}
+        # term id -> (avgdl, quantized impacts), and the avgdl of _base.impacts
+        self._impacts: Dict[int, Tuple[float, np.ndarray]] = {}
+        self._base_avgdl = 0.0
+
+    @property
+    def params(self) -> Dict[str, Any]:
+        """Constructor arguments, as saved with the index."""
+        return {
+            "k1": self.k1,
+            "b": self.b,
+            "epsilon": self.epsilon,
+            "variant": self.variant,
+            "delta": self.delta,
+            "field_weights": self.field_weights,
+            "quantize": self.quantize,
+        }
+
+    def __len__(self) -> int:
+        return self.n_docs
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self.id_to_slot
+
+    @property
+    def avgdl(self) -> float:
+        return self.total_len / self.n_docs if self.n_docs else 0.0
+
+    def get(self, doc_id: str) -> Optional[Document]:
+        slot = self.id_to_slot.get(doc_id)
+        return None if slot is None else self.docs[slot]
+
+    def documents(self) -> List[Document]:
+        """Return the live, visible documents in slot order."""
+        return [
+            d
+            for slot, d in enumerate(self.docs)
+            if d is not None and slot not in self.hidden
+        ]
+
+    def hide(self, slots: Sequence[int]) -> None:
+        """Exclude indexed slots from searches until they are revealed, so that
+        documents added over several writes can be published at once. Hidden
+        documents still count towards the corpus statistics."""
+        self.hidden.update(slots)
+
+    def reveal(self, slots: Sequence[int]) -> None:
+        """Let searches return slots excluded by :meth:`hide`."""
+        self.hidden.difference_update(slots)
+        self.generation += 1
+
+    def encode(self, tokens: Sequence[str]) -> np.ndarray:
+        """Map tokens to term ids of the shared vocabulary, adding unseen terms."""
+        term_ids = np.empty(len(tokens), dtype=np.int32)
+        for i, term in enumerate(tokens):
+            tid = self.vocab.get(term)
+            term_ids[i] = self._add_term(term) if tid is None else tid
+        return term_ids
+
+    def add(
+        self,
+        doc: Document,
+        term_ids: np.ndarray,
+        fields: Optional[Dict[str, np.ndarray]] = None,
+    ) -> int:
+        """Index a single document from its :meth:`encode`-d tokens.
+
+        Args:
+            doc: The document.
+            term_ids: The encoded ``page_content``.
+            fields: The encoded metadata fields weighted by ``field_weights``;
+                ignored when the index has none.
+
+        Returns:
+            The slot of the document.
+
+        Raises:
+            ValueError: If a document with the same id is already indexed.
+        """
+        if doc.id is not None and doc.id in self.id_to_slot:
+            raise ValueError(f"Document with id {doc.id} already exists.")
+
+        slot = self._alloc_slot()
+        terms, tfs, length = self._term_frequencies(term_ids, fields)
+        for tid, tf in zip(terms.tolist(), tfs.tolist()):
+            self._mutable_postings(tid)[slot] = tf
+            self._forget(tid)
+        self.df[terms] += 1
+
+        self.docs[slot] = doc
+        if self._metadata is not None:
+            self._metadata.add(slot, doc.metadata)
+        self.doc_terms[slot] = terms.astype(np.int32)
+        self.doc_len[slot] = length
+        if doc.id is not None:
+            self.id_to_slot[doc.id] = slot
+        self.n_docs += 1
+        self.total_len += length
+        self.generation += 1
+        self._idf = None
+        return slot
+
+    def delete(self, doc_id: str) -> Document:
+        """Remove a document from the index.
+
+        Raises:
+            KeyError: If no document with that id is indexed.
+        """
+        slot = self.id_to_slot.pop(doc_id)
+        doc = self.docs[slot]
+        terms = self.doc_terms[slot]
+        for tid in terms.tolist():
+            del self._mutable_postings(tid)[slot]
+            self._forget(tid)
+        self.df[terms] -= 1
+
+        if self._metadata is not None:
+            self._metadata.remove(slot, doc.metadata)
+        self.n_docs -= 1
+        self.total_len -= self.doc_len[slot].item()
+        self.docs[slot] = None
+        self.doc_terms[slot] = None
+        self.doc_len[slot] = 0
+        self.free_slots.append(slot)
+        self.hidden.discard(slot)
+        self.generation += 1
+        self._idf = None
+        return doc
+
+    def update(
+        self,
+        doc: Document,
+        term_ids: np.ndarray,
+        fields: Optional[Dict[str, np.ndarray]] = None,
+    ) -> int:
+        """Replace the document that has the same id as ``doc``.
+
+        Raises:
+            KeyError: If no document with that id is indexed.
+        """
+        self.delete(doc.id)
+        return self.add(doc, term_ids, fields)
+
+    def get_scores(self, query: Sequence[str]) -> np.ndarray:
+        """BM25 score of every slot for the tokenized query."""
+        scores = np.zeros(len(self.docs), dtype=np.float64)
+        idf = self._get_idf()
+        for tid, qtf in self._query_terms(query):
+            slots, tf, _ = self._term_arrays(tid)
+            impacts = self._term_impacts(tid, slots, tf, self.avgdl)
+            scores[slots] += qtf * idf[tid] * impacts
+        return scores
+
+    def search(
+        self,
+        query: Sequence[str],
+        k: int,
+        mask: Optional[np.ndarray] = None,
+        stats: Optional[CollectionStats] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Top ``k`` slots and their scores for the tokenized query, best first.
+
+        Only the postings of the query terms are walked. Terms are visited in
+        decreasing order of their score upper bound (MaxScore): once the bounds of
+        the terms left cannot lift an unseen document above the current k-th best
+        score, their postings are only probed for the existing candidates. Terms
+        with a negative weight (Okapi IDF floored below zero) may still lower
+        that k-th score, so the threshold is reduced by their bound first.
+        Documents matching no query term are never returned, and neither are
+        slots outside ``mask`` (see :meth:`filter_mask`), which is applied before
+        the top ``k`` are selected. With ``stats``, documents are scored against
+        corpus-wide IDF and average length, so scores of shards are comparable.
+        """
+        terms = self._query_terms(query)
+        if not terms or k <= 0:
+            return _EMPTY
+
+        mask = self._visible(mask)
+        idf, avgdl = self._scoring_stats(stats)
+        weights = [qtf * idf[tid] for tid, qtf in terms]
+        saturations = [self._max_saturation(self._term_arrays(t)[2]) for t, _ in terms]
+        bounds = [max(w, 0.0) * s for w, s in zip(weights, saturations)]
+        floors = [min(w, 0.0) * s for w, s in zip(weights, saturations)]
+        order = sorted(range(len(terms)), key=lambda i: -bounds[i])
+        best = 0.0
+        scores = np.zeros(len(self.docs), dtype=np.float64)
+        touched = np.zeros(len(self.docs), dtype=bool)
+        candidates: Optional[np.ndarray] = None
+
+        for n, i in enumerate(order):
+            slots, tf, _ = self._term_arrays(terms[i][0])
+            remaining = sum(bounds[j] for j in order[n + 1 :])
+            # the terms left can lower any score by at most -lowering
+            lowering = sum(floors[j] for j in order[n + 1 :])
+            if candidates is None or len(candidates) * 16 > len(slots):
+                # walking the whole list is cheaper than probing it
+                impacts = self._term_impacts(terms[i][0], slots, tf, avgdl)
+                scores[slots] += weights[i] * impacts
+                touched[slots] = True
+            else:
+                pos = np.searchsorted(slots, candidates)
+                hit = pos < len(slots)
+                hit[hit] = slots[pos[hit]] == candidates[hit]
+                matched = candidates[hit]
+                if self.quantize:
+                    impacts = self._term_impacts(terms[i][0], slots, tf, avgdl)
+                    impacts = impacts[pos[hit]]
+                else:
+                    impacts = self._saturate(tf[pos[hit]], matched, avgdl)
+                scores[matched] += weights[i] * impacts
+            if candidates is not None:
+                continue
+
+            best = max(best, scores[slots].max())
+            if remaining >= best:
+                continue
+            seen = np.flatnonzero(touched if mask is None else touched & mask)
+            if len(seen) <= k:
+                continue
+            threshold = np.partition(scores[seen], -k)[-k] + lowering
+            if remaining < threshold:
+                candidates = seen[scores[seen] + remaining >= threshold]
+
+        if candidates is None:
+            candidates = np.flatnonzero(touched if mask is None else touched & mask)
+        return _top_k(candidates, scores[candidates], k)
+
+    def search_batch(
+        self,
+        queries: Sequence[Sequence[str]],
+        ks: Sequence[int],
+        masks: Optional[Sequence[Optional[np.ndarray]]] = None,
+        stats: Optional[CollectionStats] = None,
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Top ``ks[i]`` slots and scores for each tokenized query, best first.
+
+        The queries are scored together as a sparse query-by-term weight matrix
+        times the term-by-document impact matrix: each distinct term's postings
+        are read and saturated once for all queries containing it, and the top
+        ``k`` of every query are selected in one vectorized pass. Queries are
+        processed in blocks that bound the number of (query, document) pairs;
+        a query with more pairs than a block holds goes through :meth:`search`.
+        ``masks`` optionally restricts each query and ``stats`` overrides the
+        scoring statistics, both as in :meth:`search`.
+        """
+        masks = masks or [None] * len(queries)
+        results: List[Tuple[np.ndarray, np.ndarray]] = [_EMPTY] * len(queries)
+        if not self.n_docs:
+            return results
+        if self.hidden:
+            masks = [self._visible(mask) for mask in masks]
+        idf, avgdl = self._scoring_stats(stats)
+        term_cols: Dict[int, int] = {}
+        batched: List[Tuple[int, List[Tuple[int, int]], int]] = []
+        for i, query in enumerate(queries):
+            terms = self._query_terms(query)
+            size = int(sum(self.df[tid] for tid, _ in terms))
+            if size > _BATCH_PAIRS:
+                results[i] = self.search(query, ks[i], masks[i], stats)
+            elif terms:
+                cols = [(term_cols.setdefault(t, len(term_cols)), q) for t, q in terms]
+                batched.append((i, cols, size))
+
+        impacts = []
+        for tid in term_cols:
+            slots, tf, _ = self._term_arrays(tid)
+            impacts.append(
+                (slots, idf[tid] * self._term_impacts(tid, slots, tf, avgdl))
+            )
+
+        for block in _blocks(batched):
+            rows, slots, values = [], [], []
+            for row, (i, cols, _) in enumerate(block):
+                for col, qtf in cols:
+                    term_slots, impact = impacts[col]
+                    if masks[i] is not None:
+                        allowed = masks[i][term_slots]
+                        term_slots, impact = term_slots[allowed], impact[allowed]
+                    rows.append(np.full(len(term_slots), row, dtype=np.int64))
+                    slots.append(term_slots)
+                    values.append(qtf * impact)
+            hits = _top_k_rows(
+                _concat(rows, np.int64),
+                _concat(slots, np.int64),
+                _concat(values, np.float64),
+                np.asarray([ks[i] for i, _, _ in block], dtype=np.int64),
+                len(self.docs),
+            )
+            for (i, _, _), hit in zip(block, hits):
+                results[i] = hit
+        return results
+
+    def filter_mask(self, filter: Dict[str, Any]) -> np.ndarray:
+        """Boolean mask over slots of the documents whose metadata match
+        ``filter``; see :class:`MetadataIndex` for the syntax.
+
+        Raises:
+            ValueError: If the filter is malformed.
+        """
+        if self._metadata is None:
+            metadata = MetadataIndex()
+            for slot, doc in enumerate(self.docs):
+                if doc is not None:
+                    metadata.add(slot, doc.metadata)
+            self._metadata = metadata
+        return self._metadata.mask(filter, len(self.docs))
+
+    def get_top_n(self, query: Sequence[str], n: int = 4) -> List[Document]:
+        slots, _ = self.search(query, n)
+        return [self.docs[i] for i in slots]
+
+    def _query_terms(self, query: Sequence[str]) -> List[Tuple[int, int]]:
+        """(term id, query term frequency) of the query terms that are indexed."""
+        terms = []
+        for term, qtf in Counter(query).items():
+            tid = self.vocab.get(term)
+            if tid is not None and self.df[tid] > 0:
+                terms.append((tid, qtf))
+        return terms
+
+    def save(self, path: str) -> None:
+        """Write the index to the directory ``path``.
+
+        Postings and per-document term ids are stored as CSR NumPy arrays and
+        documents as JSON records addressed by an offsets array. The directory is
+        written next to ``path`` and swapped in once complete.
+        """
+        tmp, old = f"{path}.tmp-{os.getpid()}", f"{path}.old-{os.getpid()}"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        def save_array(name: str, array: np.ndarray) -> None:
+            np.save(os.path.join(tmp, f"{name}.npy"), array)
+
+        n_terms, n_slots = len(self.postings), len(self.docs)
+        terms = sorted(self.vocab, key=self.vocab.__getitem__)
+        with open(os.path.join(tmp, "vocab.bin"), "wb") as f:
+            f.write("".join(terms).encode("utf-8"))
+        save_array("vocab_offsets", _offsets([len(t) for t in terms]))
+
+        slots, tfs = [], []
+        max_tf = np.zeros(n_terms, dtype=np.float32)
+        for tid in range(n_terms):
+            if self.df[tid]:
+                term_slots, term_tfs, max_tf[tid] = self._term_arrays(tid)
+                slots.append(term_slots)
+                tfs.append(term_tfs)
+        all_slots, all_tfs = _concat(slots, np.int32), _concat(tfs, np.float32)
+        save_array("postings_offsets", _offsets(self.df[:n_terms]))
+        save_array("postings_slots", all_slots)
+        save_array("postings_tfs", all_tfs)
+        save_array("postings_max_tf", max_tf)
+        if self.quantize and self.n_docs:
+            impacts = self._saturate(all_tfs, all_slots, self.avgdl)
+            save_array("postings_impacts", self._quantize(impacts))
+        save_array("df", self.df[:n_terms])
+
+        doc_terms = [t if t is not None else np.zeros(0) for t in self.doc_terms]
+        save_array("doc_terms_offsets", _offsets([len(t) for t in doc_terms]))
+        save_array("doc_terms", _concat(doc_terms, np.int32))
+        save_array("doc_len", self.doc_len[:n_slots])
+
+        doc_sizes = []
+        with open(os.path.join(tmp, "docs.bin"), "wb") as f:
+            for doc in self.docs:
+                record = b"" if doc is None else _encode_document(doc)
+                f.write(record)
+                doc_sizes.append(len(record))
+        save_array("doc_offsets", _offsets(doc_sizes))
+
+        with open(os.path.join(tmp, "ids.json"), "w", encoding="utf-8") as f:
+            json.dump([None if d is None else d.id for d in self.docs], f)
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "version": INDEX_FORMAT_VERSION,
+                    "params": self.params,
+                    "n_docs": self.n_docs,
+                    "total_len": self.total_len,
+                    "impact_avgdl": self.avgdl,
+                    "n_terms": n_terms,
+                    "n_slots": n_slots,
+                },
+                f,
+            )
+
+        if os.path.exists(path):
+            os.rename(path, old)
+        os.rename(tmp, path)
+        shutil.rmtree(old, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path: str, memory_map: bool = True) -> "BM25Index":
+        """Open an index written by :meth:`save`.
+
+        Args:
+            path: Directory the index was saved to.
+            memory_map: Memory-map the arrays and the document store (copy on
+                write) instead of reading them, so startup does not depend on
+                the corpus size and workers share the page cache.
+
+        Raises:
+            ValueError: If the index was written in an unsupported format.
+        """
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["version"] > INDEX_FORMAT_VERSION:
+            raise ValueError(f"Unsupported BM25 index format: {meta['version']}")
+
+        def load_array(name: str) -> np.ndarray:
+            return np.load(
+                os.path.join(path, f"{name}.npy"), mmap_mode="c" if memory_map else None
+            )
+
+        index = cls(**meta["params"])
+        with open(os.path.join(path, "vocab.bin"), "rb") as f:
+            text = f.read().decode("utf-8")
+        bounds = np.load(os.path.join(path, "vocab_offsets.npy")).tolist()
+        index.vocab = {text[a:b]: i for i, (a, b) in enumerate(zip(bounds, bounds[1:]))}
+        index.postings = [None] * meta["n_terms"]
+        index._metadata = None
+        index._base = _Postings(
+            load_array("postings_offsets"),
+            load_array("postings_slots"),
+            load_array("postings_tfs"),
+            load_array("postings_max_tf"),
+            (
+                load_array("postings_impacts")
+                if os.path.exists(os.path.join(path, "postings_impacts.npy"))
+                else None
+            ),
+        )
+        index._base_avgdl = meta.get("impact_avgdl", 0.0)
+        index.df = load_array("df")
+
+        doc_terms = load_array("doc_terms")
+        doc_terms_offsets = load_array("doc_terms_offsets")
+        index.doc_terms = _LazyList(
+            meta["n_slots"],
+            lambda i: doc_terms[doc_terms_offsets[i] : doc_terms_offsets[i + 1]],
+        )
+        index.doc_len = load_array("doc_len")
+        if index.doc_len.dtype != np.float64:
+            # integer lengths of version 1 indexes
+            index.doc_len = index.doc_len.astype(np.float64)
+
+        store = _open_blob(os.path.join(path, "docs.bin"), memory_map)
+        doc_offsets = load_array("doc_offsets")
+        index.docs = _LazyList(
+            meta["n_slots"],
+            lambda i: _decode_document(store[doc_offsets[i] : doc_offsets[i + 1]]),
+        )
+        with open(os.path.join(path, "ids.json"), encoding="utf-8") as f:
+            ids = json.load(f)
+        index.id_to_slot = {i: slot for slot, i in enumerate(ids) if i is not None}
+        index.free_slots = np.flatnonzero(np.diff(doc_offsets) == 0).tolist()
+        index.n_docs = meta["n_docs"]
+        index.total_len = meta["total_len"]
+        return index
+
+    def _mutable_postings(self, tid: int) -> Dict[int, float]:
+        """In-memory postings of a term, copied out of ``_base`` on first write."""
+        postings = self.postings[tid]
+        if postings is None:
+            slots, tf, _ = self._term_arrays(tid)
+            postings = dict(zip(slots.tolist(), tf.tolist()))
+            self.postings[tid] = postings
+        return postings
+
+    def _term_arrays(self, tid: int) -> Tuple[np.ndarray, np.ndarray, float]:
+        """Slot-sorted postings of a term as arrays, plus its maximum tf."""
+        if self.postings[tid] is None:
+            start, end = self._base.offsets[tid], self._base.offsets[tid + 1]
+            return (
+                self._base.slots[start:end],
+                self._base.tfs[start:end],
+                float(self._base.max_tf[tid]),
+            )
+        arrays = self._arrays.get(tid)
+        if arrays is None:
+            postings = self.postings[tid]
+            slots = np.fromiter(postings.keys(), dtype=np.int64, count=len(postings))
+            tf = np.fromiter(postings.values(), dtype=np.float64, count=len(postings))
+            order = np.argsort(slots)
+            arrays = (slots[order], tf[order], float(tf.max()))
+            self._arrays[tid] = arrays
+        return arrays
+
+    def _saturate(self, tf: np.ndarray, slots: np.ndarray, avgdl: float) -> np.ndarray:
+        """Term frequency component of the variant for postings of the given slots."""
+        norm = 1 - self.b + self.b * self.doc_len[slots] / avgdl
+        if self.variant == "bm25l":
+            ctd = tf / norm + self.delta
+            return (self.k1 + 1) * ctd / (self.k1 + ctd)
+        return tf * (self.k1 + 1) / (tf + self.k1 * norm) + self.delta
+
+    def _max_saturation(self, max_tf: float) -> float:
+        """Upper bound of :meth:`_saturate` for any document length."""
+        if self.variant != "bm25l":
+            bound = max_tf * (self.k1 + 1) / (max_tf + self.k1 * (1 - self.b))
+            bound += self.delta
+        elif self.b < 1:
+            ctd = max_tf / (1 - self.b) + self.delta
+            bound = (self.k1 + 1) * ctd / (self.k1 + ctd)
+        else:
+            bound = self.k1 + 1
+        if self.quantize:
+            # rounding is monotonic, so the rounded bound bounds rounded impacts
+            step = self._impact_step()
+            bound = min(round(bound / step), _IMPACT_LEVELS) * step
+        return bound
+
+    def _term_impacts(
+        self, tid: int, slots: np.ndarray, tf: np.ndarray, avgdl: float
+    ) -> np.ndarray:
+        """:meth:`_saturate` of all postings of a term, read from the quantized
+        impacts when the index has them."""
+        if not self.quantize:
+            return self._saturate(tf, slots, avgdl)
+        if (
+            self.postings[tid] is None
+            and self._base.impacts is not None
+            and _close(self._base_avgdl, avgdl)
+        ):
+            start, end = self._base.offsets[tid], self._base.offsets[tid + 1]
+            quantized = self._base.impacts[start:end]
+        else:
+            cached = self._impacts.get(tid)
+            if cached is None or not _close(cached[0], avgdl):
+                cached = (avgdl, self._quantize(self._saturate(tf, slots, avgdl)))
+                self._impacts[tid] = cached
+            quantized = cached[1]
+        return quantized * self._impact_step()
+
+    def _impact_step(self) -> float:
+        """Saturation value of one quantization level."""
+        limit = self.k1 + 1 + (self.delta if self.variant == "bm25plus" else 0.0)
+        return limit / _IMPACT_LEVELS
+
+    def _quantize(self, saturation: np.ndarray) -> np.ndarray:
+        levels = np.rint(saturation / self._impact_step())
+        return np.minimum(levels, _IMPACT_LEVELS).astype(np.uint8)
+
+    def _term_frequencies(
+        self, term_ids: np.ndarray, fields: Optional[Dict[str, np.ndarray]]
+    ) -> Tuple[np.ndarray, np.ndarray, float]:
+        """Distinct terms of a document, their (field-weighted) frequencies and
+        the document length."""
+        if not self.field_weights:
+            terms, counts = np.unique(term_ids, return_counts=True)
+            return terms, counts, len(term_ids)
+        parts = [(term_ids, self.field_weights.get("page_content", 1.0))]
+        for field, ids in (fields or {}).items():
+            if field in self.field_weights and field != "page_content":
+                parts.append((ids, self.field_weights[field]))
+        ids = np.concatenate([np.asarray(i, dtype=np.int32) for i, _ in parts])
+        weights = np.concatenate([np.full(len(i), w) for i, w in parts])
+        terms, inverse = np.unique(ids, return_inverse=True)
+        return terms, np.bincount(inverse, weights=weights), float(weights.sum())
+
+    def _forget(self, tid: int) -> None:
+        """Drop the cached arrays of a term whose postings changed."""
+        self._arrays.pop(tid, None)
+        self._impacts.pop(tid, None)
+
+    def _get_idf(self) -> np.ndarray:
+        """IDF of every term id, see :func:`bm25_idf`."""
+        if self._idf is None:
+            self._idf = bm25_idf(self.df, self.n_docs, self.variant, self.epsilon)
+        return self._idf
+
+    def _scoring_stats(
+        self, stats: Optional[CollectionStats]
+    ) -> Tuple[Union[np.ndarray, Dict[int, float]], float]:
+        """IDF by term id and average document length to score a query with."""
+        if stats is None:
+            return self._get_idf(), self.avgdl
+        idf = {
+            self.vocab[term]: value
+            for term, value in stats.idf.items()
+            if term in self.vocab
+        }
+        return idf, stats.avgdl
+
+    def _add_term(self, term: str) -> int:
+        tid = len(self.postings)
+        self.vocab[term] = tid
+        self.postings.append({})
+        if tid >= len(self.df):
+            self.df = _grow(self.df, tid + 1)
+        return tid
+
+    def _visible(self, mask: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        """``mask`` with the hidden slots cleared."""
+        if not self.hidden:
+            return mask
+        visible = np.ones(len(self.docs), dtype=bool) if mask is None else mask.copy()
+        visible[list(self.hidden)] = False
+        return visible
+
+    def _alloc_slot(self) -> int:
+        if self.free_slots:
+            return self.free_slots.pop()
+        slot = len(self.docs)
+        self.docs.append(None)
+        self.doc_terms.append(None)
+        if slot >= len(self.doc_len):
+            self.doc_len = _grow(self.doc_len, slot + 1)
+        return slot
+
+
+def bm25_idf(
+    df: np.ndarray, n_docs: int, variant: str = "okapi", epsilon: float = 0.25
+) -> np.ndarray:
+    """IDF of every term from its document frequency, as in ``rank_bm25``.
+
+    Okapi IDF is negative for terms in more than half of the documents; those
+    are floored to ``epsilon`` times the average IDF of the terms present.
+    BM25L and BM25+ use IDFs that stay positive. Absent terms get 0.
+    """
+    df_float = df.astype(np.float64)
+    present = df > 0
+    idf = np.zeros(len(df), dtype=np.float64)
+    if variant == "okapi":
+        idf[present] = np.log(n_docs - df_float[present] + 0.5) - np.log(
+            df_float[present] + 0.5
+        )
+        average_idf = idf[present].mean() if present.any() else 0.0
+        idf[present & (idf < 0)] = epsilon * average_idf
+    elif variant == "bm25l":
+        idf[present] = np.log(n_docs + 1) - np.log(df_float[present] + 0.5)
+    else:
+        idf[present] = np.log(n_docs + 1) - np.log(df_float[present])
+    return idf
+
+
+def _close(built_avgdl: float, avgdl: float) -> bool:
+    """Whether impacts computed with ``built_avgdl`` are still valid at ``avgdl``."""
+    return abs(avgdl - built_avgdl) <= _IMPACT_AVGDL_TOLERANCE * avgdl
+
+
+def _grow(array: np.ndarray, min_size: int) -> np.ndarray:
+    """Return ``array`` zero-padded to at least ``min_size``, doubling capacity."""
+    size = max(min_size, 2 * len(array), 16)
+    grown = np.zeros(size, dtype=array.dtype)
+    grown[: len(array)] = array
+    return grown
+
+
+def _offsets(sizes: Sequence[int]) -> np.ndarray:
+    """CSR offsets for consecutive items of the given sizes."""
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    return offsets
+
+
+def _concat(arrays: List[np.ndarray], dtype: type) -> np.ndarray:
+    return np.concatenate(arrays).astype(dtype) if arrays else np.zeros(0, dtype)
+
+
+def _encode_document(doc: Document) -> bytes:
+    record = {"id": doc.id, "page_content": doc.page_content, "metadata": doc.metadata}
+    return json.dumps(record, ensure_ascii=False).encode("utf-8")
+
+
+def _decode_document(record: bytes) -> Optional[Document]:
+    return Document(**json.loads(bytes(record))) if record else None
+
+
+def _open_blob(path: str, memory_map: bool) -> Union[bytes, mmap.mmap]:
+    with open(path, "rb") as f:
+        if not memory_map or os.fstat(f.fileno()).st_size == 0:
+            return f.read()
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _blocks(
+    batched: List[Tuple[int, Any, int]],
+) -> Iterator[List[Tuple[int, Any, int]]]:
+    """Group (index, terms, size) entries so each group's sizes stay within
+    ``_BATCH_PAIRS``."""
+    block: List[Tuple[int, Any, int]] = []
+    pairs = 0
+    for entry in batched:
+        if block and pairs + entry[2] > _BATCH_PAIRS:
+            yield block
+            block, pairs = [], 0
+        block.append(entry)
+        pairs += entry[2]
+    if block:
+        yield block
+
+
+def _top_k_rows(
+    rows: np.ndarray,
+    slots: np.ndarray,
+    values: np.ndarray,
+    ks: np.ndarray,
+    n_slots: int,
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Sum (row, slot, value) triples and take the top ``ks[row]`` of every row.
+
+    Dense blocks are summed with ``bincount`` into a rows-by-slots matrix and
+    selected with a row-wise ``argpartition``; sparse blocks are deduplicated
+    and ranked with a sort over the touched pairs only.
+    """
+    keys = rows * n_slots + slots
+    if len(keys) * 4 >= len(ks) * n_slots:
+        size = len(ks) * n_slots
+        scores = np.bincount(keys, weights=values, minlength=size)
+        scores[np.bincount(keys, minlength=size) == 0] = -np.inf
+        scores = scores.reshape(len(ks), n_slots)
+        k_max = int(min(ks.max(initial=0), n_slots))
+        if k_max == 0:
+            return [_EMPTY for _ in ks]
+        top = np.argpartition(-scores, k_max - 1, axis=1)[:, :k_max]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        results = []
+        for row, k in enumerate(ks.tolist()):
+            hit = np.isfinite(top_scores[row, :k])
+            results.append((top[row, :k][hit], top_scores[row, :k][hit]))
+        return results
+
+    keys, inverse = np.unique(keys, return_inverse=True)
+    scores = np.bincount(inverse, weights=values, minlength=len(keys))
+    rows, slots = keys // n_slots, keys % n_slots
+    order = np.lexsort((-scores, rows))
+    rows, slots, scores = rows[order], slots[order], scores[order]
+    starts = np.searchsorted(rows, np.arange(len(ks) + 1))
+    keep = np.arange(len(rows)) - starts[rows] < ks[rows]
+    rows, slots, scores = rows[keep], slots[keep], scores[keep]
+    bounds = np.searchsorted(rows, np.arange(len(ks) + 1))
+    return [(slots[a:b], scores[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def _top_k(
+    slots: np.ndarray, scores: np.ndarray, k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Partially select the ``k`` best scores, then sort only those."""
+    if len(slots) > k:
+        part = np.argpartition(-scores, k - 1)[:k]
+        slots, scores = slots[part], scores[part]
+    order = np.argsort(-scores, kind="stable")
+    return slots[order], scores[order]
@@ -1,38 +1,120 @@
+from __future__ import annotations
+
+import json
+import os
 import re
-from typing import Any, Callable, Dict, Iterable, List, Optional
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, repeat
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import jieba
-from langchain_core.callbacks import CallbackManagerForRetrieverRun
+import numpy as np
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
 from langchain_core.documents import Document
 from langchain_core.retrievers import BaseRetriever
-from pydantic import ConfigDict, Field
-from rank_bm25 import BM25Okapi
+from pydantic import ConfigDict, Field, PrivateAttr
+
+from retrievers.bm25_index import BM25Index
+from retrievers.utils import BoundedExecutor, LRUCache, ReadWriteLock, content_hash
+
+# Custom jieba dictionary, loaded on the first Chinese text to tokenize.
+JIEBA_USER_DICT = os.environ.get(
+    "JIEBA_USER_DICT", os.path.join(os.path.dirname(__file__), "bm25_jiebadict.txt")
+)
+_jieba_lock = threading.Lock()
+_jieba_loaded = False
+
+CHINESE_PATTERN = re.compile(r"[\u4e00-\u9fff]")
 
-jieba.load_userdict("./bm25_jiebadict.txt")
+# Term ids of a document's page_content and, for BM25F, of its weighted fields.
+EncodedDocument = Tuple[np.ndarray, Optional[Dict[str, np.ndarray]]]
+
+
+def load_jieba_dict() -> None:
+    """
+    Initialize jieba and load the custom dictionary, once per process. Called
+    lazily by the tokenizer; call it at startup to pay the cost up front.
+    """
+    global _jieba_loaded
+    if _jieba_loaded:
+        return
+    with _jieba_lock:
+        if not _jieba_loaded:
+            jieba.initialize()
+            jieba.load_userdict(JIEBA_USER_DICT)
+            _jieba_loaded = True
 
 
 def default_preprocessing_func(text: str) -> List[str]:
     text = text.strip()
-    chinese_pattern = re.compile(r"[\u4e00-\u9fff]")
 
     # if the text contains Chinese characters, use jieba for tokenizer with custom dict
-    if chinese_pattern.search(text):
+    if CHINESE_PATTERN.search(text):
+        load_jieba_dict()
         return jieba.lcut(text)
     else:
         return text.split()
 
 
+def _tokenize_chunk(
+    texts: List[str], preprocess_func: Callable[[str], List[str]]
+) -> Tuple[List[str], List[np.ndarray]]:
+    """
+    Tokenize a chunk of texts in a worker process.
+
+    Tokens are numbered against a chunk-local vocabulary so that only the
+    distinct terms and compact id arrays travel back to the parent process.
+    """
+    local_vocab: Dict[str, int] = {}
+    encoded = []
+    for text in texts:
+        tokens = preprocess_func(text)
+        encoded.append(
+            np.fromiter(
+                (local_vocab.setdefault(t, len(local_vocab)) for t in tokens),
+                dtype=np.int32,
+                count=len(tokens),
+            )
+        )
+    return list(local_vocab), encoded
+
+
 class PABM25Retriever(BaseRetriever):
-    """`BM25` retriever without Elasticsearch."""
+    """`BM25` retriever without Elasticsearch.
 
-    vectorizer: Any = None
-    """ BM25 vectorizer."""
-    docs: List[Document] = Field(repr=False)
-    """ List of documents."""
+    Searches may run concurrently from many threads. Writes are applied under
+    a reader/writer lock, so a search always sees each write either fully or
+    not at all, and tokenization happens outside the lock.
+    """
+
+    vectorizer: BM25Index = Field(default_factory=BM25Index, repr=False)
+    """ Incremental BM25 index holding the documents."""
     k: int = 4
     """ Number of documents to return."""
     preprocess_func: Callable[[str], List[str]] = default_preprocessing_func
     """ Preprocessing function to use on the text before BM25 vectorization."""
+    token_cache_size: int = 100_000
+    """ Max number of tokenized texts kept, keyed by content hash."""
+    result_cache_size: int = 10_000
+    """ Max number of search results kept, 0 to disable result caching."""
+    result_cache_ttl: Optional[float] = 300.0
+    """ Seconds a cached search result is served for, `None` for no expiry."""
+    async_workers: int = 4
+    """ Threads running the searches awaited from coroutines (`ainvoke`,
+    `asearch_with_scores`, `abatch_search_with_scores`)."""
+    async_queue_size: int = 64
+    """ Awaited searches allowed to wait for a thread; beyond that they fail
+    at once with `ExecutorOverloaded`."""
+
+    _token_cache: LRUCache = PrivateAttr()
+    _query_cache: LRUCache = PrivateAttr()
+    _result_cache: LRUCache = PrivateAttr()
+    _executor: BoundedExecutor = PrivateAttr()
+    _lock: ReadWriteLock = PrivateAttr(default_factory=ReadWriteLock)
 
     model_config = ConfigDict(
         arbitrary_types_allowed=True,
@@ -46,6 +128,8 @@ class PABM25Retriever(BaseRetriever):
         ids: Optional[Iterable[str]] = None,
         bm25_params: Optional[Dict[str, Any]] = None,
         preprocess_func: Callable[[str], List[str]] = default_preprocessing_func,
+        n_jobs: int = 1,
+        chunk_size: int = 1000,
         **kwargs: Any,
     ) -> PABM25Retriever:  # type: ignore
         """
@@ -56,15 +140,15 @@ class PABM25Retriever(BaseRetriever):
             ids: A list of ids to associate with each text.
             bm25_params: Parameters to pass to the BM25 vectorizer.
             preprocess_func: A function to preprocess each text before vectorization.
+            n_jobs: Number of worker processes used for tokenization.
+            chunk_size: Number of texts sent to a worker at a time.
             **kwargs: Any other arguments to pass to the retriever.
 
         Returns:
             A BM25Retriever instance.
         """
 
-        texts_processed = [preprocess_func(t) for t in texts]
-        bm25_params = bm25_params or {}
-        vectorizer = BM25Okapi(texts_processed, **bm25_params)
+        texts = list(texts)
         metadatas = metadatas or ({} for _ in texts)
         if ids:
             docs = [
@@ -75,9 +159,13 @@ class PABM25Retriever(BaseRetriever):
             docs = [
                 Document(page_content=t, metadata=m) for t, m in zip(texts, metadatas)
             ]
-        return cls(
-            vectorizer=vectorizer, docs=docs, preprocess_func=preprocess_func, **kwargs
+        retriever = cls(
+            vectorizer=BM25Index(**(bm25_params or {})),
+            preprocess_func=preprocess_func,
+            **kwargs,
         )
+        retriever.add_documents(docs, n_jobs=n_jobs, chunk_size=chunk_size)
+        return retriever
 
     @classmethod
     def from_documents(
@@ -86,6 +174,8 @@ class PABM25Retriever(BaseRetriever):
         *,
         bm25_params: Optional[Dict[str, Any]] = None,
         preprocess_func: Callable[[str], List[str]] = default_preprocessing_func,
+        n_jobs: int = 1,
+        chunk_size: int = 1000,
         **kwargs: Any,
     ) -> PABM25Retriever:  # type: ignore
         """
@@ -94,26 +184,440 @@ class PABM25Retriever(BaseRetriever):
             documents: A list of Documents to vectorize.
             bm25_params: Parameters to pass to the BM25 vectorizer.
             preprocess_func: A function to preprocess each text before vectorization.
+            n_jobs: Number of worker processes used for tokenization.
+            chunk_size: Number of texts sent to a worker at a time.
             **kwargs: Any other arguments to pass to the retriever.
 
         Returns:
             A PABM25Retriever instance.
         """
-        texts, metadatas, ids = zip(
-            *((d.page_content, d.metadata, d.id) for d in documents)
-        )
+        texts, metadatas, ids = list(
+            zip(*((d.page_content, d.metadata, d.id) for d in documents))
+        ) or ((), (), ())
         return cls.from_texts(
             texts=texts,
             bm25_params=bm25_params,
             metadatas=metadatas,
             ids=ids,
             preprocess_func=preprocess_func,
+            n_jobs=n_jobs,
+            chunk_size=chunk_size,
             **kwargs,
         )
 
+    @classmethod
+    def load(
+        cls,
+        path: str,
+        *,
+        memory_map: bool = True,
+        preprocess_func: Callable[[str], List[str]] = default_preprocessing_func,
+        **kwargs: Any,
+    ) -> PABM25Retriever:
+        """
+        Open a PABM25Retriever from an index written by `save`.
+        Args:
+            path: Directory the index was saved to.
+            memory_map: Memory-map the index instead of reading it into memory.
+            preprocess_func: Must match the function the index was built with.
+            **kwargs: Any other arguments to pass to the retriever.
+
+        Returns:
+            A PABM25Retriever instance.
+        """
+        return cls(
+            vectorizer=BM25Index.load(path, memory_map=memory_map),
+            preprocess_func=preprocess_func,
+            **kwargs,
+        )
+
+    def save(self, path: str) -> None:
+        """
+        Save the index, including the documents, to the directory `path`.
+        Writes wait until the index is saved; searches do not.
+        """
+        with self._lock.read():
+            self.vectorizer.save(path)
+
+    def swap_index(self, vectorizer: BM25Index) -> None:
+        """
+        Atomically replace the index, e.g. with one built or loaded in the
+        background. Searches in flight finish on the old index.
+        """
+        with self._lock.write():
+            self.vectorizer = vectorizer
+            self._token_cache.clear()
+            self._result_cache.clear()
+
+    def reload(self, path: str, memory_map: bool = True) -> None:
+        """
+        Replace the index with the one saved at `path`. The new index is opened
+        while searches keep running on the current one, then swapped in.
+        """
+        self.swap_index(BM25Index.load(path, memory_map=memory_map))
+
+    def model_post_init(self, __context: Any) -> None:
+        super().model_post_init(__context)
+        self._token_cache = LRUCache(self.token_cache_size)
+        self._query_cache = LRUCache(self.result_cache_size)
+        self._result_cache = LRUCache(self.result_cache_size, self.result_cache_ttl)
+        self._executor = BoundedExecutor(
+            self.async_workers, self.async_queue_size, name="bm25-search"
+        )
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """Hit/miss counters of the token, query and result caches."""
+        return {
+            "generation": self.vectorizer.generation,
+            "tokens": self._token_cache.stats(),
+            "queries": self._query_cache.stats(),
+            "results": self._result_cache.stats(),
+        }
+
+    @property
+    def n_docs(self) -> int:
+        """Number of indexed documents."""
+        return len(self.vectorizer)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self.vectorizer
+
+    @property
+    def docs(self) -> List[Document]:
+        """List of indexed documents."""
+        with self._lock.read():
+            return self.vectorizer.documents()
+
+    def add_documents(
+        self, documents: Iterable[Document], *, n_jobs: int = 1, chunk_size: int = 1000
+    ) -> None:
+        """
+        Add documents to the index. Only the new documents are tokenized, and
+        texts tokenized before are served from the token cache.
+
+        Args:
+            documents: The documents to add.
+            n_jobs: Number of worker processes used to tokenize uncached texts.
+                `preprocess_func` must be picklable when this is greater than 1.
+            chunk_size: Number of texts sent to a worker at a time.
+
+        Raises:
+            ValueError: If a document id is already indexed.
+        """
+        documents = list(documents)
+        encoded = self._encode_many(
+            [doc.page_content for doc in documents], n_jobs, chunk_size
+        )
+        for start in range(0, len(documents), chunk_size):
+            batch = documents[start : start + chunk_size]
+            term_ids = list(islice(encoded, len(batch)))
+            fields = [self._encode_fields(doc) for doc in batch]
+            with self._lock.write():
+                for doc, ids, doc_fields in zip(batch, term_ids, fields):
+                    self.vectorizer.add(doc, ids, doc_fields)
+
+    def encode_documents(
+        self, documents: List[Document], *, n_jobs: int = 1, chunk_size: int = 1000
+    ) -> List[EncodedDocument]:
+        """
+        Tokenize documents into term ids for `commit_documents`, without
+        blocking searches. The ids are only valid until the next `swap_index`.
+
+        Args:
+            documents: The documents to tokenize.
+            n_jobs: Number of worker processes, as in `add_documents`.
+            chunk_size: Number of texts sent to a worker at a time.
+        """
+        texts = [doc.page_content for doc in documents]
+        return [
+            (term_ids, self._encode_fields(doc))
+            for doc, term_ids in zip(
+                documents, self._encode_many(texts, n_jobs, chunk_size)
+            )
+        ]
+
+    def commit_documents(
+        self,
+        documents: List[Document],
+        encoded: List[EncodedDocument],
+        *,
+        chunk_size: int = 1000,
+    ) -> List[Optional[str]]:
+        """
+        Add documents encoded by `encode_documents`, so that searches see
+        either none or all of them. They are indexed `chunk_size` at a time,
+        each chunk in its own short write with searches served in between,
+        hidden from results until the last chunk is in.
+
+        Returns:
+            Per document, `None` if it was added, else why it was rejected.
+        """
+        errors: List[Optional[str]] = []
+        added: List[Tuple[int, Document]] = []
+        try:
+            for start in range(0, len(documents), chunk_size):
+                batch = zip(
+                    documents[start : start + chunk_size],
+                    encoded[start : start + chunk_size],
+                )
+                with self._lock.write():
+                    for doc, (ids, fields) in batch:
+                        try:
+                            slot = self.vectorizer.add(doc, ids, fields)
+                        except ValueError as e:
+                            errors.append(str(e))
+                            continue
+                        self.vectorizer.hide([slot])
+                        added.append((slot, doc))
+                        errors.append(None)
+        finally:
+            with self._lock.write():
+                # skip slots deleted meanwhile, and maybe reused by other writes
+                docs = self.vectorizer.docs
+                self.vectorizer.reveal([i for i, doc in added if docs[i] is doc])
+        return errors
+
+    def update_document(self, document: Document) -> None:
+        """
+        Replace the indexed document that has the same id as `document`.
+
+        Raises:
+            KeyError: If the document id is not indexed.
+        """
+        term_ids = self._encode(document.page_content)
+        fields = self._encode_fields(document)
+        with self._lock.write():
+            self.vectorizer.update(document, term_ids, fields)
+
+    def delete_documents(self, ids: Iterable[str]) -> None:
+        """
+        Remove documents from the index by id.
+
+        Raises:
+            KeyError: If a document id is not indexed.
+        """
+        ids = list(ids)
+        with self._lock.write():
+            missing = [i for i in ids if i not in self.vectorizer]
+            if missing:
+                raise KeyError(missing[0])
+            for doc_id in ids:
+                self.vectorizer.delete(doc_id)
+
+    def _encode(self, text: str) -> np.ndarray:
+        """Tokenize a text into term ids, skipping segmentation for cached texts."""
+        key = content_hash(text)
+        term_ids = self._token_cache.get(key)
+        if term_ids is None:
+            tokens = self.preprocess_func(text)
+            with self._lock.write():
+                term_ids = self.vectorizer.encode(tokens)
+            self._token_cache.put(key, term_ids)
+        return term_ids
+
+    def _encode_fields(self, doc: Document) -> Optional[Dict[str, np.ndarray]]:
+        """Term ids of the metadata fields the index weighs for BM25F."""
+        weights = self.vectorizer.field_weights
+        if not weights:
+            return None
+        return {
+            field: self._encode(str(doc.metadata[field]))
+            for field in weights
+            if field in doc.metadata
+        }
+
+    def _encode_many(
+        self, texts: List[str], n_jobs: int, chunk_size: int
+    ) -> Iterator[np.ndarray]:
+        """
+        Yield the term ids of `texts` in order, segmenting uncached texts in a
+        process pool. Chunks stream back as they finish and each chunk's local
+        vocabulary is merged into the index vocabulary in one pass.
+        """
+        if n_jobs <= 1 or len(texts) <= chunk_size:
+            for text in texts:
+                yield self._encode(text)
+            return
+
+        keys = [content_hash(t) for t in texts]
+        cached = {}
+        for i, key in enumerate(keys):
+            term_ids = self._token_cache.get(key)
+            if term_ids is not None:
+                cached[i] = term_ids
+        missing = [i for i in range(len(texts)) if i not in cached]
+        chunks = [
+            missing[i : i + chunk_size] for i in range(0, len(missing), chunk_size)
+        ]
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            shards = pool.map(
+                _tokenize_chunk,
+                ([texts[i] for i in chunk] for chunk in chunks),
+                repeat(self.preprocess_func),
+            )
+
+            def merged() -> Iterator[np.ndarray]:
+                for chunk, (terms, local_ids) in zip(chunks, shards):
+                    with self._lock.write():
+                        mapping = self.vectorizer.encode(terms)
+                    for i, ids in zip(chunk, local_ids):
+                        term_ids = mapping[ids]
+                        self._token_cache.put(keys[i], term_ids)
+                        yield term_ids
+
+            fresh = merged()
+            for i in range(len(texts)):
+                yield cached[i] if i in cached else next(fresh)
+
+    def _query_tokens(self, query: str) -> Tuple[str, ...]:
+        """
+        Segment a query into sorted tokens. BM25 ignores term order, so the
+        sorted tokens identify the query for the result cache.
+        """
+        tokens = self._query_cache.get(query)
+        if tokens is None:
+            tokens = tuple(sorted(self.preprocess_func(query)))
+            self._query_cache.put(query, tokens)
+        return tokens
+
+    def search_with_scores(
+        self,
+        query: str,
+        k: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> List[Tuple[Document, float]]:
+        """
+        Search the index and return documents with their BM25 scores.
+        Results are cached until the index changes or `result_cache_ttl`
+        elapses.
+
+        Args:
+            query: The query string.
+            k: Number of documents to return. Defaults to `self.k`.
+            filter: Metadata filter, applied before the top k are selected, e.g.
+                `{"source": "wiki", "year": {"$gte": 2020}}`. Supports equality,
+                `$eq`, `$in`, `$gt`, `$gte`, `$lt` and `$lte`.
+
+        Raises:
+            ValueError: If the filter is malformed.
+        """
+        k = self.k if k is None else k
+        tokens = self._query_tokens(query)
+        filter_key = json.dumps(filter, sort_keys=True) if filter else None
+        with self._lock.read():
+            key = (self.vectorizer.generation, tokens, k, filter_key)
+            hits = self._result_cache.get(key)
+            if hits is None:
+                mask = self.vectorizer.filter_mask(filter) if filter else None
+                slots, scores = self.vectorizer.search(list(tokens), k, mask)
+                docs = [self.vectorizer.docs[i] for i in slots]
+                hits = list(zip(docs, scores.tolist()))
+                self._result_cache.put(key, hits)
+        return list(hits)
+
+    def batch_search_with_scores(
+        self,
+        queries: List[str],
+        ks: Optional[List[Optional[int]]] = None,
+        filters: Optional[List[Optional[Dict[str, Any]]]] = None,
+    ) -> List[List[Tuple[Document, float]]]:
+        """
+        Search many queries in one vectorized pass over the index.
+
+        Args:
+            queries: The query strings.
+            ks: Number of documents to return per query. `None` entries, or no
+                list at all, default to `self.k`.
+            filters: Metadata filter per query, as in `search_with_scores`.
+
+        Returns:
+            One list of (document, score) pairs per query.
+
+        Raises:
+            ValueError: If a filter is malformed.
+        """
+        ks = [self.k if k is None else k for k in (ks or [None] * len(queries))]
+        filters = filters or [None] * len(queries)
+        filter_keys = [json.dumps(f, sort_keys=True) if f else None for f in filters]
+        processed = [self._query_tokens(q) for q in queries]
+        with self._lock.read():
+            generation = self.vectorizer.generation
+            keys = [
+                (generation, tokens, k, fk)
+                for tokens, k, fk in zip(processed, ks, filter_keys)
+            ]
+            results = [self._result_cache.get(key) for key in keys]
+            todo = [i for i, hits in enumerate(results) if hits is None]
+            if todo:
+                masks: Dict[str, np.ndarray] = {}
+                for i in todo:
+                    if filter_keys[i] and filter_keys[i] not in masks:
+                        masks[filter_keys[i]] = self.vectorizer.filter_mask(filters[i])
+                hits = self.vectorizer.search_batch(
+                    [list(processed[i]) for i in todo],
+                    [ks[i] for i in todo],
+                    [masks[filter_keys[i]] if filter_keys[i] else None for i in todo],
+                )
+                for i, (slots, scores) in zip(todo, hits):
+                    results[i] = [
+                        (self.vectorizer.docs[j], s)
+                        for j, s in zip(slots, scores.tolist())
+                    ]
+                    self._result_cache.put(keys[i], results[i])
+        return [list(hits) for hits in results]
+
     def _get_relevant_documents(
-        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+        self,
+        query: str,
+        *,
+        run_manager: CallbackManagerForRetrieverRun,
+        k: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> List[Document]:
+        return [doc for doc, _ in self.search_with_scores(query, k=k, filter=filter)]
+
+    async def asearch_with_scores(
+        self,
+        query: str,
+        k: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> List[Tuple[Document, float]]:
+        """
+        `search_with_scores` on the retriever's bounded search threads, leaving
+        the event loop free.
+
+        Raises:
+            ExecutorOverloaded: If `async_queue_size` searches are already
+                waiting for a thread.
+        """
+        return await self._executor.run(self.search_with_scores, query, k, filter)
+
+    async def abatch_search_with_scores(
+        self,
+        queries: List[str],
+        ks: Optional[List[Optional[int]]] = None,
+        filters: Optional[List[Optional[Dict[str, Any]]]] = None,
+    ) -> List[List[Tuple[Document, float]]]:
+        """
+        `batch_search_with_scores` on the bounded search threads, as
+        `asearch_with_scores`.
+        """
+        return await self._executor.run(
+            self.batch_search_with_scores, queries, ks, filters
+        )
+
+    def executor_stats(self) -> Dict[str, Any]:
+        """Running, queued and rejected awaited searches."""
+        return self._executor.stats()
+
+    async def _aget_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: AsyncCallbackManagerForRetrieverRun,
+        k: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
     ) -> List[Document]:
-        processed_query = self.preprocess_func(query)
-        return_docs = self.vectorizer.get_top_n(processed_query, self.docs, n=self.k)
-        return return_docs
+        hits = await self.asearch_with_scores(query, k=k, filter=filter)
+        return [doc for doc, _ in hits]
@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Literal, NamedTuple, Optional, Tuple
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+from pydantic import ConfigDict, PrivateAttr
+
+from retrievers.metadata_index import matches
+from retrievers.utils import content_hash
+
+Hits = List[Tuple[Document, float]]
+
+
+class HybridResult(NamedTuple):
+    """Fused hits of a hybrid search and the time spent in each stage."""
+
+    hits: Hits
+    """Documents with their fused score, best first."""
+    timings: Dict[str, float]
+    """Seconds spent in the "sparse", "dense" and "fusion" stages, and in
+    total; the total is about the slower retrieval stage plus fusion."""
+
+
+class PAHybridRetriever(BaseRetriever):
+    """Hybrid retriever fusing BM25 and dense vector search.
+
+    The sparse retriever (e.g. `PABM25Retriever` or `ShardedBM25Retriever`)
+    and the dense vector store are queried concurrently, the dense stage on a
+    worker thread, so a search takes about as long as the slower of the two.
+    Their results are fused by reciprocal rank (RRF) or by a weighted sum of
+    min-max normalized scores, and merged by document id.
+
+    A metadata filter is applied by the sparse retriever itself and to the
+    dense hits by their `metadata`, with the same operators; the dense stage
+    then fetches `dense_fetch_factor` times more candidates to filter from.
+
+    Example:
+        .. code-block:: python
+
+            hybrid = PAHybridRetriever(sparse=bm25, dense=faiss_store, k=10)
+            docs = hybrid.invoke("query")
+            result = hybrid.search_with_timings("query")
+    """
+
+    sparse: Any
+    """ Sparse retriever with a `search_with_scores(query, k, filter)` method."""
+    dense: VectorStore
+    """ Vector store searched with `similarity_search_with_score`."""
+    k: int = 4
+    """ Number of documents to return."""
+    sparse_k: int = 50
+    """ Number of sparse candidates fused."""
+    dense_k: int = 50
+    """ Number of dense candidates fused."""
+    dense_fetch_factor: int = 4
+    """ With a filter, dense candidates fetched per candidate fused, as the
+    dense store is searched unfiltered and its hits are filtered afterwards."""
+    fusion: Literal["rrf", "weighted"] = "rrf"
+    """ "rrf" sums weight / (rrf_k + rank) over the stages; "weighted" sums
+    weight * score, with the scores of each stage min-max normalized."""
+    rrf_k: int = 60
+    """ Rank offset of RRF; larger values flatten the gap between ranks."""
+    sparse_weight: float = 0.5
+    """ Weight of the sparse stage in the fusion."""
+    dense_weight: float = 0.5
+    """ Weight of the dense stage in the fusion."""
+    max_workers: int = 8
+    """ Threads running dense searches, i.e. max concurrent hybrid searches
+    before dense stages queue."""
+
+    _executor: ThreadPoolExecutor = PrivateAttr()
+
+    model_config = ConfigDict(
+        arbitrary_types_allowed=True,
+    )
+
+    def model_post_init(self, __context: Any) -> None:
+        super().model_post_init(__context)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="hybrid-dense"
+        )
+
+    def close(self) -> None:
+        """Stop the dense search threads."""
+        self._executor.shutdown()
+
+    def search_with_scores(
+        self,
+        query: str,
+        k: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> Hits:
+        """
+        Search both stages and return documents with their fused scores.
+
+        Args:
+            query: The query string.
+            k: Number of documents to return. Defaults to `self.k`.
+            filter: Metadata filter applied to both stages, see
+                `PABM25Retriever.search_with_scores`.
+
+        Raises:
+            ValueError: If the filter is malformed.
+        """
+        return self.search_with_timings(query, k, filter).hits
+
+    def search_with_timings(
+        self,
+        query: str,
+        k: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> HybridResult:
+        """
+        Like `search_with_scores`, also reporting the latency of each stage.
+        """
+        k = self.k if k is None else k
+        start = time.perf_counter()
+        dense_future = self._executor.submit(self._dense_search, query, filter)
+        sparse_hits, sparse_seconds = self._sparse_search(query, filter)
+        dense_hits, dense_seconds = dense_future.result()
+
+        fusion_start = time.perf_counter()
+        hits = self.fuse(sparse_hits, dense_hits)[:k]
+        end = time.perf_counter()
+        return HybridResult(
+            hits,
+            {
+                "sparse": sparse_seconds,
+                "dense": dense_seconds,
+                "fusion": end - fusion_start,
+                "total": end - start,
+            },
+        )
+
+    def fuse(self, sparse_hits: Hits, dense_hits: Hits) -> Hits:
+        """
+        Fuse two ranked lists into one, merging documents by id.
+        """
+        scores: Dict[Any, float] = {}
+        docs: Dict[Any, Document] = {}
+        for hits, weight in (
+            (sparse_hits, self.sparse_weight),
+            (dense_hits, self.dense_weight),
+        ):
+            if self.fusion == "rrf":
+                contributions = [
+                    weight / (self.rrf_k + r) for r in range(1, len(hits) + 1)
+                ]
+            else:
+                contributions = [weight * s for s in _min_max([s for _, s in hits])]
+            seen = set()
+            for (doc, _), contribution in zip(hits, contributions):
+                key = _doc_key(doc)
+                # a stage listing a document twice counts its best rank only
+                if key in seen:
+                    continue
+                seen.add(key)
+                docs.setdefault(key, doc)
+                scores[key] = scores.get(key, 0.0) + contribution
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return [(docs[key], score) for key, score in ranked]
+
+    def _sparse_search(
+        self, query: str, filter: Optional[Dict[str, Any]]
+    ) -> Tuple[Hits, float]:
+        start = time.perf_counter()
+        if filter:
+            hits = self.sparse.search_with_scores(query, k=self.sparse_k, filter=filter)
+        else:
+            hits = self.sparse.search_with_scores(query, k=self.sparse_k)
+        return hits, time.perf_counter() - start
+
+    def _dense_search(
+        self, query: str, filter: Optional[Dict[str, Any]]
+    ) -> Tuple[Hits, float]:
+        start = time.perf_counter()
+        if filter:
+            hits = self.dense.similarity_search_with_score(
+                query, k=self.dense_k * self.dense_fetch_factor
+            )
+            hits = [(d, s) for d, s in hits if matches(filter, d.metadata)]
+            hits = hits[: self.dense_k]
+        else:
+            hits = self.dense.similarity_search_with_score(query, k=self.dense_k)
+        return hits, time.perf_counter() - start
+
+    def _get_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: CallbackManagerForRetrieverRun,
+        k: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> List[Document]:
+        return [doc for doc, _ in self.search_with_scores(query, k=k, filter=filter)]
+
+
+def _doc_key(doc: Document) -> Any:
+    """Identity of a document across stages: its id, else its content."""
+    return doc.id if doc.id is not None else content_hash(doc.page_content)
+
+
+def _min_max(scores: List[float]) -> List[float]:
+    """Scores scaled to [0, 1]; all 1 when they are equal."""
+    if not scores:
+        return []
+    low, high = min(scores), max(scores)
+    if high == low:
+        return [1.0] * len(scores)
+    return [(s - low) / (high - low) for s in scores]
@@ -0,0 +1,199 @@
+from collections import defaultdict
+from numbers import Real
+from typing import Any, Dict, Hashable, Iterator, Optional, Set, Tuple
+
+import numpy as np
+
+from retrievers.utils import LRUCache
+
+RANGE_OPERATORS = {"$gt", "$gte", "$lt", "$lte"}
+"""Numeric range operators, compared against the sorted index of a field."""
+
+# Bitmaps are only cached for values held by at least 1/_BITMAP_MIN_RATIO of
+# the slots; rarer values are cheaper to scatter into a fresh mask each time.
+_BITMAP_MIN_RATIO = 64
+
+
+class MetadataIndex:
+    """Per-field indexes over document metadata, for filtering searches.
+
+    Every metadata value maps to the set of slots holding it (list values are
+    indexed element-wise). The boolean bitmaps of common values are built on
+    first use and kept, up to ``bitmap_cache_size`` of them, until the value's
+    slots change. Numeric fields additionally get a
+    sorted (value, slot) index, rebuilt lazily after writes, for range filters.
+
+    Filters follow the usual vector store syntax, with fields combined by AND::
+
+        {"source": "wiki", "lang": {"$in": ["zh", "en"]}, "year": {"$gte": 2020}}
+    """
+
+    def __init__(self, bitmap_cache_size: int = 256):
+        self.values: Dict[str, Dict[Hashable, Set[int]]] = defaultdict(dict)
+        self._bitmaps = LRUCache(bitmap_cache_size)
+        self._sorted: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+
+    def add(self, slot: int, metadata: Dict[str, Any]) -> None:
+        for field, value in _items(metadata):
+            self.values[field].setdefault(value, set()).add(slot)
+            self._bitmaps.pop((field, value))
+            self._sorted.pop(field, None)
+
+    def remove(self, slot: int, metadata: Dict[str, Any]) -> None:
+        for field, value in _items(metadata):
+            slots = self.values[field].get(value)
+            if slots is None:
+                continue
+            slots.discard(slot)
+            if not slots:
+                del self.values[field][value]
+            self._bitmaps.pop((field, value))
+            self._sorted.pop(field, None)
+
+    def mask(self, filter: Dict[str, Any], size: int) -> np.ndarray:
+        """Boolean mask over ``size`` slots of the documents matching ``filter``.
+
+        Raises:
+            ValueError: If the filter uses an unsupported operator or operand.
+        """
+        mask = np.ones(size, dtype=bool)
+        for field, condition in filter.items():
+            if isinstance(condition, dict):
+                mask &= self._condition_mask(field, condition, size)
+            else:
+                mask &= self._bitmap(field, condition, size)
+        return mask
+
+    def _condition_mask(
+        self, field: str, condition: Dict[str, Any], size: int
+    ) -> np.ndarray:
+        mask = np.ones(size, dtype=bool)
+        bounds: Dict[str, float] = {}
+        for op, operand in condition.items():
+            if op == "$eq":
+                mask &= self._bitmap(field, operand, size)
+            elif op == "$in":
+                if not isinstance(operand, list):
+                    raise ValueError(f"$in expects a list, got {operand!r}")
+                matches = np.zeros(size, dtype=bool)
+                for value in operand:
+                    matches |= self._bitmap(field, value, size)
+                mask &= matches
+            elif op in RANGE_OPERATORS:
+                if not _is_number(operand):
+                    raise ValueError(f"{op} expects a number, got {operand!r}")
+                bounds[op] = operand
+            else:
+                raise ValueError(f"Unsupported filter operator: {op}")
+        if bounds:
+            mask &= self._range(field, bounds, size)
+        return mask
+
+    def _bitmap(self, field: str, value: Any, size: int) -> np.ndarray:
+        if not isinstance(value, Hashable):
+            raise ValueError(f"Cannot filter on unhashable value {value!r}")
+        bitmap = self._bitmaps.get((field, value))
+        if bitmap is None or len(bitmap) != size:
+            bitmap = np.zeros(size, dtype=bool)
+            slots = self.values.get(field, {}).get(value, ())
+            bitmap[np.fromiter(slots, dtype=np.int64, count=len(slots))] = True
+            if len(slots) * _BITMAP_MIN_RATIO >= size:
+                self._bitmaps.put((field, value), bitmap)
+        return bitmap
+
+    def _range(self, field: str, bounds: Dict[str, float], size: int) -> np.ndarray:
+        values, slots = self._sorted_index(field)
+        start, end = 0, len(values)
+        if "$gt" in bounds:
+            start = max(start, np.searchsorted(values, bounds["$gt"], side="right"))
+        if "$gte" in bounds:
+            start = max(start, np.searchsorted(values, bounds["$gte"], side="left"))
+        if "$lt" in bounds:
+            end = min(end, np.searchsorted(values, bounds["$lt"], side="left"))
+        if "$lte" in bounds:
+            end = min(end, np.searchsorted(values, bounds["$lte"], side="right"))
+        mask = np.zeros(size, dtype=bool)
+        mask[slots[start:end]] = True
+        return mask
+
+    def _sorted_index(self, field: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Numeric values of a field and their slots, sorted by value."""
+        index = self._sorted.get(field)
+        if index is None:
+            pairs = [
+                (value, slot)
+                for value, slots in self.values.get(field, {}).items()
+                if _is_number(value)
+                for slot in slots
+            ]
+            values = np.array([v for v, _ in pairs], dtype=np.float64)
+            slots = np.array([s for _, s in pairs], dtype=np.int64)
+            order = np.argsort(values, kind="stable")
+            index = (values[order], slots[order])
+            self._sorted[field] = index
+        return index
+
+
+def matches(filter: Dict[str, Any], metadata: Optional[Dict[str, Any]]) -> bool:
+    """Whether a document with ``metadata`` matches ``filter``, by the same rules
+    as `MetadataIndex.mask`; for filtering results that were not indexed.
+
+    Raises:
+        ValueError: If the filter uses an unsupported operator or operand.
+    """
+    values: Dict[str, Set[Hashable]] = defaultdict(set)
+    for field, value in _items(metadata):
+        values[field].add(value)
+    matched = True
+    for field, condition in filter.items():
+        present = values.get(field, set())
+        if not isinstance(condition, dict):
+            matched &= _contains(present, condition)
+            continue
+        bounds: Dict[str, float] = {}
+        for op, operand in condition.items():
+            if op == "$eq":
+                matched &= _contains(present, operand)
+            elif op == "$in":
+                if not isinstance(operand, list):
+                    raise ValueError(f"$in expects a list, got {operand!r}")
+                # evaluate every value, so that bad operands raise as in `mask`
+                matched &= any([_contains(present, value) for value in operand])
+            elif op in RANGE_OPERATORS:
+                if not _is_number(operand):
+                    raise ValueError(f"{op} expects a number, got {operand!r}")
+                bounds[op] = operand
+            else:
+                raise ValueError(f"Unsupported filter operator: {op}")
+        if bounds:
+            matched &= any(
+                _is_number(value) and _within(value, bounds) for value in present
+            )
+    return matched
+
+
+def _contains(values: Set[Hashable], value: Any) -> bool:
+    if not isinstance(value, Hashable):
+        raise ValueError(f"Cannot filter on unhashable value {value!r}")
+    return value in values
+
+
+def _within(value: float, bounds: Dict[str, float]) -> bool:
+    return (
+        ("$gt" not in bounds or value > bounds["$gt"])
+        and ("$gte" not in bounds or value >= bounds["$gte"])
+        and ("$lt" not in bounds or value < bounds["$lt"])
+        and ("$lte" not in bounds or value <= bounds["$lte"])
+    )
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, Real) and not isinstance(value, bool)
+
+
+def _items(metadata: Optional[Dict[str, Any]]) -> Iterator[Tuple[str, Hashable]]:
+    """Indexable (field, value) pairs of a metadata dict."""
+    for field, value in (metadata or {}).items():
+        for item in value if isinstance(value, list) else (value,):
+            if isinstance(item, Hashable):
+                yield field, item
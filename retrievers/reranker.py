@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.callbacks import Callbacks
+from langchain_core.documents import BaseDocumentCompressor, Document
+from pydantic import ConfigDict, Field, PrivateAttr
+
+from retrievers.utils import LRUCache, content_hash
+
+DEFAULT_RERANK_MODEL = "BAAI/bge-reranker-base"
+
+
+class PACrossEncoderReranker(BaseDocumentCompressor):
+    """Cross-encoder reranker (bge-reranker style) for recalled candidates.
+
+    The first `max_candidates` documents of a recall list (e.g. from
+    `PABM25Retriever`) are scored jointly with the query. Pairs are grouped
+    into batches of similar token length bounded by `batch_tokens`, so short
+    passages are not padded to long ones, and pair scores are cached. With a
+    deadline, no batch is started once it has passed: batches holding the
+    best recalled candidates go first, and candidates left unscored keep their
+    recall order behind the scored ones.
+
+    Example:
+        .. code-block:: python
+
+            reranker = PACrossEncoderReranker(model_kwargs={"device": "cpu"})
+            candidates = bm25.invoke(query, k=50)
+            hits = reranker.rerank(query, candidates, top_n=5, deadline=0.2)
+    """
+
+    client: Any = None  #: :meta private:
+    model_name: str = DEFAULT_RERANK_MODEL
+    """ Model name or path of the cross-encoder."""
+    cache_folder: Optional[str] = None
+    """ Path to store models."""
+    model_kwargs: Dict[str, Any] = Field(default_factory=dict)
+    """ Keyword arguments to pass to the model, e.g. `device`."""
+    max_length: int = 512
+    """ Max tokens of a (query, passage) pair; longer pairs are truncated."""
+    top_n: int = 4
+    """ Number of documents to return."""
+    max_candidates: int = 50
+    """ Number of recalled documents scored, from the top of the recall list."""
+    batch_tokens: int = 8192
+    """ Max padded tokens per scoring batch."""
+    deadline: Optional[float] = None
+    """ Default seconds after which no new batch is scored, `None` for none."""
+    cache_size: int = 100_000
+    """ Max number of (query, passage) scores kept, 0 to disable caching."""
+    lazy_load: bool = False
+    """ Defer loading the model until it is first needed."""
+
+    _cache: LRUCache = PrivateAttr()
+    _load_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    model_config = ConfigDict(
+        arbitrary_types_allowed=True,
+        protected_namespaces=(),
+    )
+
+    def model_post_init(self, __context: Any) -> None:
+        super().model_post_init(__context)
+        self._cache = LRUCache(self.cache_size)
+        if not self.lazy_load:
+            self.load()
+
+    def load(self) -> Any:
+        """Load the model unless already loaded; the model is loaded once even
+        when called from several threads."""
+        if self.client is not None:
+            return self.client
+        with self._load_lock:
+            if self.client is None:
+                from sentence_transformers import CrossEncoder
+
+                self.client = CrossEncoder(
+                    self.model_name,
+                    max_length=self.max_length,
+                    cache_folder=self.cache_folder,
+                    **self.model_kwargs,
+                )
+        return self.client
+
+    def cache_stats(self) -> Dict[str, Any]:
+        return self._cache.stats()
+
+    def score(
+        self,
+        query: str,
+        passages: Sequence[str],
+        deadline: Optional[float] = None,
+    ) -> np.ndarray:
+        """
+        Relevance scores of the passages to the query, in input order.
+
+        Args:
+            query: The query string.
+            passages: Passages to score; earlier ones are scored first.
+            deadline: Seconds after which no new batch is started, by default
+                `self.deadline`.
+
+        Returns:
+            float32 scores, NaN for passages left unscored at the deadline.
+        """
+        start = time.perf_counter()
+        deadline = self.deadline if deadline is None else deadline
+        keys = [content_hash(f"{self.model_name}\0{query}\0{p}") for p in passages]
+        scores = np.full(len(passages), np.nan, dtype=np.float32)
+        missing = []
+        for i, key in enumerate(keys):
+            cached = self._cache.get(key)
+            if cached is None:
+                missing.append(i)
+            else:
+                scores[i] = cached
+        if not missing:
+            return scores
+
+        client = self.load()
+        for batch in self._length_batches(query, [passages[i] for i in missing]):
+            if deadline is not None and time.perf_counter() - start > deadline:
+                break
+            rows = [missing[i] for i in batch]
+            predicted = client.predict(
+                [(query, passages[i]) for i in rows],
+                batch_size=len(rows),
+                show_progress_bar=False,
+                convert_to_numpy=True,
+            )
+            scores[rows] = predicted
+            for i, value in zip(rows, predicted.tolist()):
+                self._cache.put(keys[i], value)
+        return scores
+
+    def rerank(
+        self,
+        query: str,
+        documents: Sequence[Document],
+        top_n: Optional[int] = None,
+        deadline: Optional[float] = None,
+    ) -> List[Tuple[Document, Optional[float]]]:
+        """
+        Rerank recalled documents by cross-encoder score.
+
+        Args:
+            query: The query string.
+            documents: Recalled documents, best first.
+            top_n: Number of documents to return, by default `self.top_n`.
+            deadline: Scoring deadline in seconds, see `score`.
+
+        Returns:
+            The best documents with their score, scored ones first; documents
+            left unscored at the deadline follow in recall order with `None`.
+        """
+        top_n = self.top_n if top_n is None else top_n
+        candidates = list(documents[: self.max_candidates])
+        scores = self.score(query, [d.page_content for d in candidates], deadline)
+        scored = np.flatnonzero(~np.isnan(scores))
+        order = scored[np.argsort(-scores[scored], kind="stable")].tolist()
+        order += np.flatnonzero(np.isnan(scores)).tolist()
+        return [
+            (candidates[i], None if np.isnan(scores[i]) else float(scores[i]))
+            for i in order[:top_n]
+        ]
+
+    def compress_documents(
+        self,
+        documents: Sequence[Document],
+        query: str,
+        callbacks: Optional[Callbacks] = None,
+    ) -> Sequence[Document]:
+        """
+        Rerank documents, returning copies with the score in the
+        `relevance_score` metadata field.
+        """
+        return [
+            Document(
+                id=doc.id,
+                page_content=doc.page_content,
+                metadata={**doc.metadata, "relevance_score": score},
+            )
+            for doc, score in self.rerank(query, documents)
+        ]
+
+    def _length_batches(self, query: str, passages: List[str]) -> Iterator[List[int]]:
+        """
+        Positions of `passages` in batches of similar (query, passage) token
+        length, each within `batch_tokens` once padded. Batches are yielded in
+        order of the earliest position they hold.
+        """
+        tokenized = self.client.tokenizer(
+            [query] * len(passages),
+            passages,
+            truncation=True,
+            max_length=self.max_length,
+        )
+        lengths = np.array([len(ids) for ids in tokenized["input_ids"]])
+        batches: List[List[int]] = []
+        batch: List[int] = []
+        for i in np.argsort(-lengths, kind="stable").tolist():
+            # sorted descending, so the batch's first pair is its longest
+            if batch and (len(batch) + 1) * lengths[batch[0]] > self.batch_tokens:
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return iter(sorted(batches, key=min))
@@ -0,0 +1,775 @@
+from __future__ import annotations
+
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import threading
+import uuid
+from collections import defaultdict
+from concurrent.futures import Future
+from itertools import chain, islice
+from operator import itemgetter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict, Field, PrivateAttr
+
+from retrievers.bm25_index import BM25Index, CollectionStats, bm25_idf
+from retrievers.bm25_retriever import default_preprocessing_func
+from retrievers.utils import BoundedExecutor, LRUCache, ReadWriteLock, content_hash
+
+# (distinct terms, length) of an indexed document, reported back to the parent
+# so it can keep the corpus-wide statistics.
+_Summary = Tuple[List[str], float]
+
+# Tokens of a document's content and of its BM25F metadata fields, produced by
+# its shard outside the parent's write lock.
+_Tokens = Tuple[List[str], Optional[Dict[str, List[str]]]]
+
+
+class _Shard:
+    """One partition of the corpus, served by a worker process."""
+
+    def __init__(
+        self,
+        bm25_params: Dict[str, Any],
+        preprocess_func: Callable[[str], List[str]],
+        path: Optional[str],
+    ):
+        self.index = BM25Index.load(path) if path else BM25Index(**bm25_params)
+        self.preprocess_func = preprocess_func
+        # term id -> term, to report documents' terms by name
+        self.terms: List[str] = list(self.index.vocab)
+        # commit id -> (slot, document) added by that commit, hidden until it ends
+        self.pending: Dict[str, List[Tuple[int, Document]]] = defaultdict(list)
+
+    def statistics(self) -> Tuple[List[str], np.ndarray, int, float]:
+        """Vocabulary, document frequencies, document count and total length."""
+        df = np.asarray(self.index.df[: len(self.terms)], dtype=np.int64)
+        return self.terms, df, self.index.n_docs, self.index.total_len
+
+    def tokenize(self, documents: List[Document]) -> List[_Tokens]:
+        return [
+            (self.preprocess_func(doc.page_content), self._tokenize_fields(doc))
+            for doc in documents
+        ]
+
+    def contains(self, doc_id: str) -> bool:
+        return doc_id in self.index
+
+    def add(
+        self,
+        documents: List[Document],
+        tokens: List[Optional[_Tokens]],
+        commit: Optional[str] = None,
+    ) -> List[Tuple[Optional[_Summary], Optional[str]]]:
+        """Index documents, tokenizing those without ``tokens``. Returns the
+        summary of each added document, or why it was rejected. Documents of a
+        ``commit`` are hidden from searches until it is revealed."""
+        results = []
+        for doc, doc_tokens in zip(documents, tokens):
+            if doc_tokens is None:
+                doc_tokens = self.tokenize([doc])[0]
+            content, fields = doc_tokens
+            try:
+                slot = self.index.add(
+                    doc, self._encode(content), self._encode_fields(fields)
+                )
+            except ValueError as e:
+                results.append((None, str(e)))
+                continue
+            if commit is not None:
+                self.index.hide([slot])
+                self.pending[commit].append((slot, doc))
+            results.append((self._summary(slot), None))
+        return results
+
+    def reveal(self, commit: str) -> None:
+        """Let searches return the documents added by ``commit``."""
+        # skip slots deleted meanwhile, and maybe reused by other writes
+        added = self.pending.pop(commit, [])
+        self.index.reveal([i for i, doc in added if self.index.docs[i] is doc])
+
+    def update(self, doc: Document, tokens: _Tokens) -> Tuple[_Summary, _Summary]:
+        """Replace a document. Returns the summaries of the old and new version."""
+        old = self._summary(self.index.id_to_slot[doc.id])
+        content, fields = tokens
+        slot = self.index.update(
+            doc, self._encode(content), self._encode_fields(fields)
+        )
+        return old, self._summary(slot)
+
+    def delete(self, ids: List[str]) -> List[_Summary]:
+        summaries = []
+        for doc_id in ids:
+            summaries.append(self._summary(self.index.id_to_slot[doc_id]))
+            self.index.delete(doc_id)
+        return summaries
+
+    def search(
+        self,
+        tokens: List[str],
+        k: int,
+        filter: Optional[Dict[str, Any]],
+        stats: CollectionStats,
+    ) -> List[Tuple[Document, float]]:
+        mask = self.index.filter_mask(filter) if filter else None
+        slots, scores = self.index.search(tokens, k, mask, stats)
+        return [(self.index.docs[i], s) for i, s in zip(slots, scores.tolist())]
+
+    def search_batch(
+        self,
+        queries: List[List[str]],
+        ks: List[int],
+        filters: List[Optional[Dict[str, Any]]],
+        stats: CollectionStats,
+    ) -> List[List[Tuple[Document, float]]]:
+        masks: Dict[str, np.ndarray] = {}
+        for f in filters:
+            key = json.dumps(f, sort_keys=True)
+            if f and key not in masks:
+                masks[key] = self.index.filter_mask(f)
+        hits = self.index.search_batch(
+            queries,
+            ks,
+            [masks[json.dumps(f, sort_keys=True)] if f else None for f in filters],
+            stats,
+        )
+        return [
+            [(self.index.docs[i], s) for i, s in zip(slots, scores.tolist())]
+            for slots, scores in hits
+        ]
+
+    def documents(self) -> List[Document]:
+        return self.index.documents()
+
+    def save(self, path: str) -> None:
+        self.index.save(path)
+
+    def _encode(self, tokens: List[str]) -> np.ndarray:
+        term_ids = self.index.encode(tokens)
+        self.terms.extend(islice(self.index.vocab, len(self.terms), None))
+        return term_ids
+
+    def _tokenize_fields(self, doc: Document) -> Optional[Dict[str, List[str]]]:
+        """Tokenized metadata fields of a document, for BM25F."""
+        weights = self.index.field_weights
+        if not weights:
+            return None
+        return {
+            field: self.preprocess_func(str(doc.metadata[field]))
+            for field in weights
+            if field in doc.metadata
+        }
+
+    def _encode_fields(
+        self, fields: Optional[Dict[str, List[str]]]
+    ) -> Optional[Dict[str, np.ndarray]]:
+        if fields is None:
+            return None
+        return {field: self._encode(tokens) for field, tokens in fields.items()}
+
+    def _summary(self, slot: int) -> _Summary:
+        terms = [self.terms[t] for t in self.index.doc_terms[slot].tolist()]
+        return terms, self.index.doc_len[slot].item()
+
+
+def _serve_shard(conn, bm25_params, preprocess_func, path) -> None:
+    """Worker process loop: run ``(request id, method, args)`` requests on a
+    shard and send back ``(request id, ok, result or exception)``."""
+    shard = _Shard(bm25_params, preprocess_func, path)
+    while True:
+        request = conn.recv()
+        if request is None:
+            return
+        request_id, method, args = request
+        try:
+            conn.send((request_id, True, getattr(shard, method)(*args)))
+        except Exception as e:
+            conn.send((request_id, False, e))
+
+
+class _ShardClient:
+    """Parent-side handle of a shard process.
+
+    Requests from any thread are pipelined over one pipe and answered through
+    futures, which a receiver thread resolves as the replies arrive.
+    """
+
+    def __init__(
+        self,
+        bm25_params: Dict[str, Any],
+        preprocess_func: Callable[[str], List[str]],
+        path: Optional[str] = None,
+    ):
+        # spawn rather than fork, the parent usually runs threads
+        context = multiprocessing.get_context("spawn")
+        self._conn, child = context.Pipe()
+        self.process = context.Process(
+            target=_serve_shard,
+            args=(child, bm25_params, preprocess_func, path),
+            daemon=True,
+        )
+        self.process.start()
+        child.close()
+        self._send_lock = threading.Lock()
+        self._pending: Dict[int, Future] = {}
+        self._ids = itertools.count()
+        self._closed = False
+        threading.Thread(target=self._receive, daemon=True).start()
+
+    def submit(self, method: str, *args: Any) -> Future:
+        future: Future = Future()
+        with self._send_lock:
+            if self._closed:
+                raise RuntimeError("BM25 shard process is not running.")
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+            self._conn.send((request_id, method, args))
+        return future
+
+    def close(self) -> None:
+        with self._send_lock:
+            if not self._closed:
+                self._closed = True
+                self._conn.send(None)
+        self.process.join()
+
+    def _receive(self) -> None:
+        while True:
+            try:
+                request_id, ok, result = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            future = self._pending.pop(request_id)
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+        with self._send_lock:
+            self._closed = True
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(RuntimeError("BM25 shard process exited."))
+
+
+class _GlobalStats:
+    """Document frequencies and lengths of the whole corpus, summed over the
+    shards, from which every shard is scored."""
+
+    def __init__(self, variant: str, epsilon: float):
+        self.variant = variant
+        self.epsilon = epsilon
+        self.vocab: Dict[str, int] = {}
+        self.df = np.zeros(0, dtype=np.int64)
+        self.n_docs = 0
+        self.total_len = 0
+        self._idf: Optional[np.ndarray] = None
+
+    def merge(
+        self, terms: List[str], df: np.ndarray, n_docs: int, total_len: float
+    ) -> None:
+        ids = self._term_ids(terms)
+        self.df[ids] += df
+        self.n_docs += n_docs
+        self.total_len += total_len
+        self._idf = None
+
+    def add(self, summary: _Summary, sign: int = 1) -> None:
+        terms, length = summary
+        ids = self._term_ids(terms)
+        self.df[ids] += sign
+        self.n_docs += sign
+        self.total_len += sign * length
+        self._idf = None
+
+    def collection_stats(self, terms: Iterable[str]) -> CollectionStats:
+        idf = self._idf
+        if idf is None:
+            df = self.df[: len(self.vocab)]
+            idf = bm25_idf(df, self.n_docs, self.variant, self.epsilon)
+            self._idf = idf
+        return CollectionStats(
+            idf={t: float(idf[self.vocab[t]]) for t in terms if t in self.vocab},
+            avgdl=self.total_len / self.n_docs if self.n_docs else 0.0,
+        )
+
+    def _term_ids(self, terms: List[str]) -> np.ndarray:
+        ids = np.fromiter(
+            (self.vocab.setdefault(t, len(self.vocab)) for t in terms),
+            dtype=np.int64,
+            count=len(terms),
+        )
+        if len(self.vocab) > len(self.df):
+            df = np.zeros(max(len(self.vocab), 2 * len(self.df)), dtype=np.int64)
+            df[: len(self.df)] = self.df
+            self.df = df
+        return ids
+
+
+class ShardedBM25Retriever(BaseRetriever):
+    """`BM25` retriever whose corpus is hash-partitioned by document id across
+    worker processes.
+
+    Each shard holds a `BM25Index` in its own process. Queries are tokenized
+    once, scattered to every shard together with the IDF and average document
+    length of the whole corpus, which the parent keeps up to date from the
+    writes, and the per-shard top k are merged. Scores are therefore the same
+    as those of a single index over all documents, while memory and scoring
+    work are spread over `n_shards` processes.
+
+    Call `close` to stop the shard processes.
+    """
+
+    n_shards: int = 4
+    """ Number of shard processes."""
+    k: int = 4
+    """ Number of documents to return."""
+    preprocess_func: Callable[[str], List[str]] = default_preprocessing_func
+    """ Preprocessing function to use on the text, must be picklable."""
+    bm25_params: Dict[str, Any] = Field(default_factory=dict)
+    """ Parameters of the BM25 index of every shard."""
+    index_path: Optional[str] = None
+    """ Directory of a sharded index written by `save` to open."""
+    result_cache_size: int = 10_000
+    """ Max number of search results kept, 0 to disable result caching."""
+    result_cache_ttl: Optional[float] = 300.0
+    """ Seconds a cached search result is served for, `None` for no expiry."""
+    async_workers: int = 4
+    """ Threads running the searches awaited from coroutines (`ainvoke`,
+    `asearch_with_scores`, `abatch_search_with_scores`)."""
+    async_queue_size: int = 64
+    """ Awaited searches allowed to wait for a thread; beyond that they fail
+    at once with `ExecutorOverloaded`."""
+
+    _shards: List[_ShardClient] = PrivateAttr(default_factory=list)
+    _stats: _GlobalStats = PrivateAttr()
+    _generation: int = PrivateAttr(default=0)
+    _lock: ReadWriteLock = PrivateAttr(default_factory=ReadWriteLock)
+    _query_cache: LRUCache = PrivateAttr()
+    _result_cache: LRUCache = PrivateAttr()
+    _executor: BoundedExecutor = PrivateAttr()
+
+    model_config = ConfigDict(
+        arbitrary_types_allowed=True,
+    )
+
+    @classmethod
+    def from_documents(
+        cls, documents: Iterable[Document], **kwargs: Any
+    ) -> ShardedBM25Retriever:  # type: ignore
+        """
+        Create a ShardedBM25Retriever from a list of Documents.
+        Args:
+            documents: A list of Documents to index. Documents are routed to
+                shards by id, so they should have one.
+            **kwargs: Any other arguments to pass to the retriever.
+
+        Returns:
+            A ShardedBM25Retriever instance.
+        """
+        retriever = cls(**kwargs)
+        retriever.add_documents(documents)
+        return retriever
+
+    @classmethod
+    def load(cls, path: str, **kwargs: Any) -> ShardedBM25Retriever:
+        """
+        Open a ShardedBM25Retriever from an index written by `save`. Each
+        shard process memory-maps its own part.
+        """
+        with open(os.path.join(path, "shards.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        return cls(
+            n_shards=meta["n_shards"],
+            bm25_params=meta["bm25_params"],
+            index_path=path,
+            **kwargs,
+        )
+
+    def model_post_init(self, __context: Any) -> None:
+        super().model_post_init(__context)
+        self._query_cache = LRUCache(self.result_cache_size)
+        self._result_cache = LRUCache(self.result_cache_size, self.result_cache_ttl)
+        self._executor = BoundedExecutor(
+            self.async_workers, self.async_queue_size, name="bm25-search"
+        )
+        self._shards, self._stats = self._start(self.index_path)
+
+    def _start(self, path: Optional[str]) -> Tuple[List[_ShardClient], _GlobalStats]:
+        """Start the shard processes, opening their parts of the index at `path`."""
+        shards = [
+            _ShardClient(
+                self.bm25_params,
+                self.preprocess_func,
+                os.path.join(path, f"shard-{i}") if path else None,
+            )
+            for i in range(self.n_shards)
+        ]
+        params = BM25Index(**self.bm25_params)
+        stats = _GlobalStats(params.variant, params.epsilon)
+        for future in [shard.submit("statistics") for shard in shards]:
+            stats.merge(*future.result())
+        return shards, stats
+
+    def close(self) -> None:
+        """Stop the shard processes."""
+        self._executor.shutdown()
+        for shard in self._shards:
+            shard.close()
+
+    def save(self, path: str) -> None:
+        """
+        Save every shard to `path/shard-<i>`. Writes wait until the index is
+        saved; searches do not.
+        """
+        os.makedirs(path, exist_ok=True)
+        with self._lock.read():
+            self._scatter(
+                [
+                    ("save", (os.path.join(path, f"shard-{i}"),))
+                    for i in range(self.n_shards)
+                ]
+            )
+        with open(os.path.join(path, "shards.json"), "w", encoding="utf-8") as f:
+            json.dump({"n_shards": self.n_shards, "bm25_params": self.bm25_params}, f)
+
+    def reload(self, path: str) -> None:
+        """
+        Replace the index with the one saved at `path`. The new shard processes
+        are started while searches keep running on the current ones.
+        """
+        with open(os.path.join(path, "shards.json"), encoding="utf-8") as f:
+            if json.load(f)["n_shards"] != self.n_shards:
+                raise ValueError("Saved index has a different number of shards.")
+        shards, stats = self._start(path)
+        with self._lock.write():
+            old, self._shards, self._stats = self._shards, shards, stats
+            self._generation += 1
+        for shard in old:
+            shard.close()
+
+    @property
+    def n_docs(self) -> int:
+        """Number of indexed documents."""
+        return self._stats.n_docs
+
+    def __contains__(self, doc_id: str) -> bool:
+        with self._lock.read():
+            return (
+                self._shards[self._shard_of(doc_id)].submit("contains", doc_id).result()
+            )
+
+    @property
+    def docs(self) -> List[Document]:
+        """List of indexed documents, gathered from all shards."""
+        with self._lock.read():
+            return list(chain(*self._scatter([("documents", ())] * self.n_shards)))
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """Hit/miss counters of the query and result caches."""
+        return {
+            "generation": self._generation,
+            "queries": self._query_cache.stats(),
+            "results": self._result_cache.stats(),
+        }
+
+    def add_documents(self, documents: Iterable[Document]) -> None:
+        """
+        Add documents to the index. Each shard tokenizes its own documents
+        before the index is locked for writing.
+
+        Raises:
+            ValueError: If a document id is already indexed. The other
+                documents are still added.
+        """
+        documents = list(documents)
+        errors = self.commit_documents(documents, self.encode_documents(documents))
+        for error in errors:
+            if error is not None:
+                raise ValueError(error)
+
+    def encode_documents(self, documents: List[Document]) -> List[_Tokens]:
+        """
+        Tokenize documents for `commit_documents` in the shard processes,
+        without blocking searches.
+        """
+        by_shard = self._partition(documents)
+        tokens = self._scatter(
+            [
+                ("tokenize", ([documents[j] for j in positions],))
+                for positions in by_shard.values()
+            ],
+            list(by_shard),
+        )
+        encoded: List[_Tokens] = [([], None) for _ in documents]
+        for positions, shard_tokens in zip(by_shard.values(), tokens):
+            for j, doc_tokens in zip(positions, shard_tokens):
+                encoded[j] = doc_tokens
+        return encoded
+
+    def commit_documents(
+        self,
+        documents: List[Document],
+        tokens: Sequence[Optional[_Tokens]],
+        *,
+        chunk_size: int = 1000,
+    ) -> List[Optional[str]]:
+        """
+        Add documents so that searches see either none or all of them.
+        Documents without `tokens` are tokenized by their shard while the index
+        is locked for writing, so pass those of `encode_documents`. Documents
+        are indexed `chunk_size` at a time, each chunk in its own short write
+        with searches served in between, hidden from results until the last
+        chunk is in.
+
+        Returns:
+            Per document, `None` if it was added, else why it was rejected.
+        """
+        commit = uuid.uuid4().hex
+        errors: List[Optional[str]] = [None] * len(documents)
+        try:
+            for start in range(0, len(documents), chunk_size):
+                chunk = documents[start : start + chunk_size]
+                by_shard = self._partition(chunk)
+                with self._lock.write():
+                    results = self._scatter(
+                        [
+                            (
+                                "add",
+                                (
+                                    [chunk[j] for j in positions],
+                                    [tokens[start + j] for j in positions],
+                                    commit,
+                                ),
+                            )
+                            for positions in by_shard.values()
+                        ],
+                        list(by_shard),
+                    )
+                    for positions, shard_results in zip(by_shard.values(), results):
+                        for j, (summary, error) in zip(positions, shard_results):
+                            if summary is not None:
+                                self._stats.add(summary)
+                            errors[start + j] = error
+                    self._generation += 1
+        finally:
+            with self._lock.write():
+                self._scatter([("reveal", (commit,))] * self.n_shards)
+                self._generation += 1
+        return errors
+
+    def update_document(self, document: Document) -> None:
+        """
+        Replace the indexed document that has the same id as `document`.
+
+        Raises:
+            KeyError: If the document id is not indexed.
+        """
+        shard = self._shards[self._shard_of(document.id)]
+        (tokens,) = shard.submit("tokenize", [document]).result()
+        with self._lock.write():
+            old, new = shard.submit("update", document, tokens).result()
+            self._stats.add(old, -1)
+            self._stats.add(new)
+            self._generation += 1
+
+    def delete_documents(self, ids: Iterable[str]) -> None:
+        """
+        Remove documents from the index by id.
+
+        Raises:
+            KeyError: If a document id is not indexed.
+        """
+        ids = list(ids)
+        by_shard: Dict[int, List[str]] = defaultdict(list)
+        for doc_id in ids:
+            by_shard[self._shard_of(doc_id)].append(doc_id)
+        with self._lock.write():
+            found = [
+                self._shards[self._shard_of(doc_id)].submit("contains", doc_id)
+                for doc_id in ids
+            ]
+            missing = [i for i, f in zip(ids, found) if not f.result()]
+            if missing:
+                raise KeyError(missing[0])
+            summaries = self._scatter(
+                [("delete", (shard_ids,)) for shard_ids in by_shard.values()],
+                list(by_shard),
+            )
+            for summary in chain(*summaries):
+                self._stats.add(summary, -1)
+            self._generation += 1
+
+    def _query_tokens(self, query: str) -> Tuple[str, ...]:
+        """Segment a query into sorted tokens, see `PABM25Retriever`."""
+        tokens = self._query_cache.get(query)
+        if tokens is None:
+            tokens = tuple(sorted(self.preprocess_func(query)))
+            self._query_cache.put(query, tokens)
+        return tokens
+
+    def search_with_scores(
+        self,
+        query: str,
+        k: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> List[Tuple[Document, float]]:
+        """
+        Search all shards and return the best documents with their BM25 scores.
+
+        Args:
+            query: The query string.
+            k: Number of documents to return. Defaults to `self.k`.
+            filter: Metadata filter, as in `PABM25Retriever.search_with_scores`.
+
+        Raises:
+            ValueError: If the filter is malformed.
+        """
+        k = self.k if k is None else k
+        tokens = self._query_tokens(query)
+        filter_key = json.dumps(filter, sort_keys=True) if filter else None
+        with self._lock.read():
+            key = (self._generation, tokens, k, filter_key)
+            hits = self._result_cache.get(key)
+            if hits is None:
+                stats = self._stats.collection_stats(tokens)
+                shard_hits = self._scatter(
+                    [("search", (list(tokens), k, filter, stats))] * self.n_shards
+                )
+                hits = _merge(shard_hits, k)
+                self._result_cache.put(key, hits)
+        return list(hits)
+
+    def batch_search_with_scores(
+        self,
+        queries: List[str],
+        ks: Optional[List[Optional[int]]] = None,
+        filters: Optional[List[Optional[Dict[str, Any]]]] = None,
+    ) -> List[List[Tuple[Document, float]]]:
+        """
+        Search many queries at once, each shard scoring them in one vectorized
+        pass. Arguments are as in `PABM25Retriever.batch_search_with_scores`.
+        """
+        ks = [self.k if k is None else k for k in (ks or [None] * len(queries))]
+        filters = filters or [None] * len(queries)
+        filter_keys = [json.dumps(f, sort_keys=True) if f else None for f in filters]
+        processed = [self._query_tokens(q) for q in queries]
+        with self._lock.read():
+            keys = [
+                (self._generation, tokens, k, fk)
+                for tokens, k, fk in zip(processed, ks, filter_keys)
+            ]
+            results = [self._result_cache.get(key) for key in keys]
+            todo = [i for i, hits in enumerate(results) if hits is None]
+            if todo:
+                stats = self._stats.collection_stats(
+                    set(chain(*(processed[i] for i in todo)))
+                )
+                args = (
+                    [list(processed[i]) for i in todo],
+                    [ks[i] for i in todo],
+                    [filters[i] for i in todo],
+                    stats,
+                )
+                shard_hits = self._scatter([("search_batch", args)] * self.n_shards)
+                for n, i in enumerate(todo):
+                    results[i] = _merge([hits[n] for hits in shard_hits], ks[i])
+                    self._result_cache.put(keys[i], results[i])
+        return [list(hits) for hits in results]
+
+    def _get_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: CallbackManagerForRetrieverRun,
+        k: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> List[Document]:
+        return [doc for doc, _ in self.search_with_scores(query, k=k, filter=filter)]
+
+    async def asearch_with_scores(
+        self,
+        query: str,
+        k: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> List[Tuple[Document, float]]:
+        """
+        `search_with_scores` on the retriever's bounded search threads, leaving
+        the event loop free.
+
+        Raises:
+            ExecutorOverloaded: If `async_queue_size` searches are already
+                waiting for a thread.
+        """
+        return await self._executor.run(self.search_with_scores, query, k, filter)
+
+    async def abatch_search_with_scores(
+        self,
+        queries: List[str],
+        ks: Optional[List[Optional[int]]] = None,
+        filters: Optional[List[Optional[Dict[str, Any]]]] = None,
+    ) -> List[List[Tuple[Document, float]]]:
+        """
+        `batch_search_with_scores` on the bounded search threads, as
+        `asearch_with_scores`.
+        """
+        return await self._executor.run(
+            self.batch_search_with_scores, queries, ks, filters
+        )
+
+    def executor_stats(self) -> Dict[str, Any]:
+        """Running, queued and rejected awaited searches."""
+        return self._executor.stats()
+
+    async def _aget_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: AsyncCallbackManagerForRetrieverRun,
+        k: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> List[Document]:
+        hits = await self.asearch_with_scores(query, k=k, filter=filter)
+        return [doc for doc, _ in hits]
+
+    def _shard_of(self, key: str) -> int:
+        """Shard of a document, from a hash of its id that is stable across runs."""
+        return int.from_bytes(content_hash(key)[:8], "little") % self.n_shards
+
+    def _partition(self, documents: List[Document]) -> Dict[int, List[int]]:
+        """Positions of the documents by shard. Documents without an id are
+        placed by their content."""
+        by_shard: Dict[int, List[int]] = defaultdict(list)
+        for j, doc in enumerate(documents):
+            by_shard[self._shard_of(doc.id or doc.page_content)].append(j)
+        return by_shard
+
+    def _scatter(
+        self,
+        requests: List[Tuple[str, tuple]],
+        shard_ids: Optional[Sequence[int]] = None,
+    ) -> List[Any]:
+        """Send one request to each shard (all of them, or `shard_ids`), then
+        gather the replies in order. The shards work on them in parallel."""
+        shard_ids = range(self.n_shards) if shard_ids is None else shard_ids
+        futures = [
+            self._shards[i].submit(method, *args)
+            for i, (method, args) in zip(shard_ids, requests)
+        ]
+        return [future.result() for future in futures]
+
+
+def _merge(
+    shard_hits: List[List[Tuple[Document, float]]], k: int
+) -> List[Tuple[Document, float]]:
+    """Best ``k`` of the per-shard top-k lists, which are scored alike."""
+    return heapq.nlargest(k, chain(*shard_hits), key=itemgetter(1))
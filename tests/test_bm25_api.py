@@ -0,0 +1,92 @@
+import gzip
+import json
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from apis import bm25_api
+from retrievers.bm25_index import BM25Index
+from retrievers.bm25_retriever import PABM25Retriever
+from retrievers.utils import BoundedExecutor
+
+RERANK_SECONDS = 0.2
+
+
+def slow_rerank(query, hits, k):
+    time.sleep(RERANK_SECONDS)
+    return bm25_api.SearchResponse(results=[])
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(bm25_api, "rerank_results", slow_rerank)
+    return TestClient(bm25_api.app)
+
+
+def rerank_batch(n):
+    return {"queries": [{"query": f"query {i}", "rerank": True} for i in range(n)]}
+
+
+def test_batch_reranks_run_concurrently(client, monkeypatch):
+    monkeypatch.setattr(bm25_api, "rerank_executor", BoundedExecutor(3, 0))
+    start = time.perf_counter()
+    response = client.post("/api/v1/bm25/search/batch", json=rerank_batch(3))
+
+    assert response.status_code == 200
+    assert len(response.json()["results"]) == 3
+    assert time.perf_counter() - start < 2 * RERANK_SECONDS
+
+
+def test_rerank_beyond_queue_is_rejected(client, monkeypatch):
+    executor = BoundedExecutor(1, 1)
+    monkeypatch.setattr(bm25_api, "rerank_executor", executor)
+    response = client.post("/api/v1/bm25/search/batch", json=rerank_batch(3))
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert executor.stats()["rejected"] == 1
+    stats = client.get("/api/v1/bm25/executor/stats").json()
+    assert stats["rerank"]["rejected"] == 1
+
+
+@pytest.fixture
+def empty_retriever(monkeypatch):
+    retriever = PABM25Retriever(vectorizer=BM25Index(), preprocess_func=str.split)
+    monkeypatch.setattr(bm25_api, "retriever", retriever)
+    return retriever
+
+
+def ndjson(n):
+    return "".join(
+        json.dumps({"id": f"d{i}", "page_content": f"apple {i}"}) + "\n"
+        for i in range(n)
+    ).encode()
+
+
+def test_bulk_gzip_body_is_inflated_in_bounded_pieces(
+    client, empty_retriever, monkeypatch
+):
+    monkeypatch.setattr(bm25_api, "INFLATE_CHUNK_BYTES", 7)
+    response = client.post(
+        "/api/v1/bm25/documents/bulk",
+        content=gzip.compress(ndjson(50)),
+        headers={"Content-Encoding": "gzip"},
+    )
+    assert response.json()["added"] == 50
+    assert empty_retriever.n_docs == 50
+
+    monkeypatch.setattr(bm25_api, "MAX_NDJSON_LINE_BYTES", 1000)
+    response = client.post(
+        "/api/v1/bm25/documents/bulk",
+        content=gzip.compress(b"x" * 10**6),
+        headers={"Content-Encoding": "gzip"},
+    )
+    assert response.status_code == 413
+
+
+def test_bulk_upload_beyond_max_docs_is_rejected(client, empty_retriever, monkeypatch):
+    monkeypatch.setattr(bm25_api, "BM25_BULK_MAX_DOCS", 10)
+    response = client.post("/api/v1/bm25/documents/bulk", content=ndjson(11))
+    assert response.status_code == 413
+    assert empty_retriever.n_docs == 0
@@ -0,0 +1,65 @@
+import random
+
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+from rank_bm25 import BM25Okapi
+
+from retrievers.bm25_index import BM25Index
+
+VOCABULARY = ["a", "b", "c", "d", "e"]
+
+
+def random_corpus(rng, n_docs, vocabulary=VOCABULARY):
+    return [
+        [rng.choice(vocabulary) for _ in range(rng.randint(1, 8))]
+        for _ in range(n_docs)
+    ]
+
+
+def build_index(corpus, **kwargs):
+    index = BM25Index(**kwargs)
+    for i, tokens in enumerate(corpus):
+        index.add(
+            Document(id=str(i), page_content=" ".join(tokens)), index.encode(tokens)
+        )
+    return index
+
+
+def expected_top_k(corpus, query, k):
+    """Top k rank_bm25 scores among the documents holding a query term."""
+    scores = BM25Okapi(corpus).get_scores(query)
+    matching = [i for i, tokens in enumerate(corpus) if set(tokens) & set(query)]
+    return np.sort(scores[matching])[::-1][:k]
+
+
+def test_search_matches_rank_bm25_with_negative_idf():
+    # a tiny vocabulary makes most terms common, so their Okapi IDF is floored
+    # at a negative epsilon * average_idf and MaxScore must account for it
+    rng = random.Random(0)
+    for _ in range(100):
+        corpus = random_corpus(rng, rng.randint(20, 200))
+        index = build_index(corpus)
+        for _ in range(10):
+            query = [rng.choice(VOCABULARY) for _ in range(rng.randint(1, 5))]
+            k = rng.randint(1, 10)
+            _, scores = index.search(query, k)
+            np.testing.assert_allclose(scores, expected_top_k(corpus, query, k))
+
+
+@pytest.mark.parametrize("n_terms", [5, 500])
+def test_search_batch_matches_search(n_terms):
+    # common terms are scored as a dense matrix, rare ones as sorted pairs
+    rng = random.Random(n_terms)
+    vocabulary = [f"t{i}" for i in range(n_terms)]
+    corpus = random_corpus(rng, 500, vocabulary)
+    index = build_index(corpus)
+    queries = [rng.sample(vocabulary, rng.randint(1, 3)) for _ in range(50)]
+    ks = [rng.randint(1, 10) for _ in queries]
+    masks = [None if i % 2 else np.arange(500) % 3 > 0 for i in range(50)]
+    results = index.search_batch(queries, ks, masks)
+    for query, k, mask, (slots, scores) in zip(queries, ks, masks, results):
+        expected_slots, expected_scores = index.search(query, k, mask)
+        np.testing.assert_allclose(scores, expected_scores)
+        if mask is not None:
+            assert mask[slots].all()
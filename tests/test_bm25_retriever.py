@@ -0,0 +1,65 @@
+import threading
+
+from langchain_core.documents import Document
+
+from retrievers.bm25_index import BM25Index
+from retrievers.bm25_retriever import PABM25Retriever
+
+
+def make_retriever():
+    return PABM25Retriever(vectorizer=BM25Index(), preprocess_func=str.split)
+
+
+class GatedList(list):
+    """List whose slices past the first chunk wait for `go`, so a test can act
+    between two chunks of a commit."""
+
+    def __init__(self, items):
+        super().__init__(items)
+        self.paused = threading.Event()
+        self.go = threading.Event()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice) and index.start:
+            self.paused.set()
+            self.go.wait(5)
+        return super().__getitem__(index)
+
+
+def test_commit_serves_searches_between_chunks_and_publishes_at_once():
+    retriever = make_retriever()
+    retriever.add_documents([Document(id="old", page_content="apple pie")])
+    docs = [Document(id=f"new{i}", page_content=f"apple {i}") for i in range(4)]
+    encoded = GatedList(retriever.encode_documents(docs))
+
+    errors = []
+    commit = threading.Thread(
+        target=lambda: errors.extend(
+            retriever.commit_documents(docs, encoded, chunk_size=2)
+        )
+    )
+    commit.start()
+    assert encoded.paused.wait(5)
+    # the first chunk is indexed, yet the search neither blocks nor sees it
+    hits = retriever.search_with_scores("apple", k=10)
+    assert [doc.id for doc, _ in hits] == ["old"]
+    assert [doc.id for doc in retriever.docs] == ["old"]
+    encoded.go.set()
+    commit.join(5)
+
+    assert errors == [None] * 4
+    hits = retriever.search_with_scores("apple", k=10)
+    assert {doc.id for doc, _ in hits} == {"old", "new0", "new1", "new2", "new3"}
+
+
+def test_commit_reports_duplicates_and_reveals_the_rest():
+    retriever = make_retriever()
+    retriever.add_documents([Document(id="a", page_content="x")])
+    docs = [Document(id="a", page_content="x y"), Document(id="b", page_content="x")]
+    errors = retriever.commit_documents(
+        docs, retriever.encode_documents(docs), chunk_size=1
+    )
+
+    assert errors[0] is not None and errors[1] is None
+    hits = retriever.search_with_scores("x", k=10)
+    assert {doc.id for doc, _ in hits} == {"a", "b"}
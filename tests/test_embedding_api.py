@@ -0,0 +1,95 @@
+import asyncio
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+from apis import embedding_api
+from embeddings.embedding_pool import EmbeddingPool
+
+
+class FakeTokenizer:
+    def __call__(self, texts, truncation=True, max_length=512):
+        return {"input_ids": [[0] * min(len(t), max_length) for t in texts]}
+
+
+class FakeModel:
+    """Stand-in for a SentenceTransformer: embeds a text as (length, 1)."""
+
+    tokenizer = FakeTokenizer()
+    max_seq_length = 512
+
+    def encode(self, texts, **kwargs):
+        return np.array([[len(t), 1.0] for t in texts], dtype=np.float32)
+
+    def get_sentence_embedding_dimension(self):
+        return 2
+
+
+@pytest.fixture
+def pooled_bge(monkeypatch):
+    # a pool without worker processes, its chunks encoded in this process
+    bge = embedding_api.bge
+    pool = EmbeddingPool.__new__(EmbeddingPool)
+    pool.n_workers, pool.chunk_size = 2, bge.pool_chunk_size
+    monkeypatch.setattr(bge, "client", FakeModel())
+    monkeypatch.setattr(bge, "_loaded", True)
+    monkeypatch.setattr(bge, "_pool", pool)
+    return bge
+
+
+def test_large_document_request_reaches_pool(pooled_bge, monkeypatch):
+    calls = []
+
+    def encode(self, texts):
+        calls.append(len(texts))
+        return pooled_bge._encode_batched(texts)
+
+    monkeypatch.setattr(EmbeddingPool, "encode", encode)
+    texts = [
+        f"pooled document {i}" for i in range(3 * embedding_api.EMBED_MAX_BATCH_SIZE)
+    ]
+    response = TestClient(embedding_api.app).post(
+        "/api/v1/bge/embed/documents", json={"texts": texts}
+    )
+
+    assert response.status_code == 200
+    assert calls == [len(texts)]
+    assert response.json()["embeddings"] == [[float(len(t)), 1.0] for t in texts]
+
+
+def test_small_document_request_skips_pool(pooled_bge, monkeypatch):
+    calls = []
+    monkeypatch.setattr(EmbeddingPool, "encode", lambda self, texts: calls.append(1))
+    texts = [f"coalesced document {i}" for i in range(3)]
+    response = TestClient(embedding_api.app).post(
+        "/api/v1/bge/embed/documents", json={"texts": texts}
+    )
+
+    assert response.status_code == 200
+    assert calls == []
+    assert response.json()["embeddings"] == [[float(len(t)), 1.0] for t in texts]
+
+
+def test_empty_document_request_loads_model_off_event_loop(monkeypatch):
+    bge = embedding_api.bge
+    loaded_on_loop = []
+
+    def load(self):
+        try:
+            asyncio.get_running_loop()
+            loaded_on_loop.append(True)
+        except RuntimeError:
+            loaded_on_loop.append(False)
+        return FakeModel()
+
+    monkeypatch.setattr(type(bge), "load", load)
+    monkeypatch.setattr(bge, "_dimension", None)
+    response = TestClient(embedding_api.app).post(
+        "/api/v1/bge/embed/documents",
+        json={"texts": [], "encoding_format": "base64"},
+    )
+
+    assert response.status_code == 200
+    assert response.json()["shape"] == [0, 2]
+    assert loaded_on_loop == [False]
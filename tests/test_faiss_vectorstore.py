@@ -0,0 +1,65 @@
+import numpy as np
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from vectorstores.faiss import PAFaissVectorStore
+
+
+def make_store(n=200, **kwargs):
+    vectors = np.random.default_rng(0).normal(size=(n, 16)).astype(np.float32)
+    store = PAFaissVectorStore(DeterministicFakeEmbedding(size=16), "hnsw", **kwargs)
+    store.add_embeddings(
+        [f"text {i}" for i in range(n)], vectors, ids=[str(i) for i in range(n)]
+    )
+    return store, vectors
+
+
+def test_hnsw_rebuilds_once_deletions_pass_threshold():
+    store, vectors = make_store(compaction_threshold=0.25)
+    store.delete([str(i) for i in range(40)])
+    assert len(store._deleted) == 40
+    assert store.index.ntotal == 200
+
+    store.delete([str(i) for i in range(40, 50)])
+    assert not store._deleted
+    assert store.index.ntotal == 150
+    hits = store.similarity_search_with_score_by_vector(vectors[60].tolist(), k=1)
+    assert hits[0][0].id == "60"
+
+
+def test_hnsw_readds_count_as_deletions():
+    store, vectors = make_store(compaction_threshold=0.25)
+    ids = [str(i) for i in range(80)]
+    store.add_embeddings(ids, vectors[:80], ids=ids)
+    assert not store._deleted
+    assert store.index.ntotal == 200
+
+
+def test_hnsw_searches_skip_deleted_until_rebuild():
+    store, vectors = make_store(compaction_threshold=0.5)
+    store.delete(["7"])
+    hits = store.similarity_search_with_score_by_vector(vectors[7].tolist(), k=5)
+    assert "7" not in [doc.id for doc, _ in hits]
+    assert len(hits) == 5
+
+    store.delete([str(i) for i in range(200)])
+    assert store.index is None
+    assert store.similarity_search_by_vector(vectors[0].tolist(), k=1) == []
+
+
+def test_non_positive_k_returns_no_hits():
+    store, vectors = make_store(n=20)
+    assert store.batch_similarity_search_by_vector(vectors[:2].tolist(), k=0) == [
+        [],
+        [],
+    ]
+
+
+def test_save_after_deleting_everything_drops_old_index(tmp_path):
+    store, vectors = make_store(n=20)
+    store.save(str(tmp_path))
+    store.delete([str(i) for i in range(20)])
+    store.save(str(tmp_path))
+
+    loaded = PAFaissVectorStore.load(str(tmp_path), store.embedding)
+    assert loaded.index is None
+    assert loaded.similarity_search_by_vector(vectors[0].tolist(), k=1) == []
@@ -0,0 +1,71 @@
+import random
+
+import numpy as np
+import pytest
+
+from retrievers.metadata_index import MetadataIndex, matches
+
+FILTERS = [
+    {"source": "wiki"},
+    {"source": {"$eq": "news"}, "lang": "zh"},
+    {"lang": {"$in": ["zh", "en"]}},
+    {"tags": "b"},
+    {"year": {"$gte": 2018, "$lt": 2021}},
+    {"year": {"$gt": 2019}, "source": {"$in": ["wiki"]}},
+    {"score": {"$lte": 0.5}},
+    {"missing": "x"},
+    {},
+]
+
+
+def random_metadata(rng):
+    metadata = {
+        "source": rng.choice(["wiki", "news", "blog"]),
+        "lang": rng.choice(["zh", "en", "fr"]),
+        "tags": rng.sample(["a", "b", "c"], rng.randint(0, 2)),
+        "score": rng.random(),
+    }
+    if rng.random() < 0.8:
+        metadata["year"] = rng.choice([2016, 2018, 2019, 2020, 2021, "n/a"])
+    return metadata
+
+
+@pytest.mark.parametrize("filter", FILTERS)
+def test_matches_agrees_with_mask(filter):
+    rng = random.Random(0)
+    metadatas = [random_metadata(rng) for _ in range(300)]
+    index = MetadataIndex()
+    for slot, metadata in enumerate(metadatas):
+        index.add(slot, metadata)
+
+    expected = index.mask(filter, len(metadatas))
+    actual = np.array([matches(filter, m) for m in metadatas])
+    np.testing.assert_array_equal(actual, expected)
+
+
+@pytest.mark.parametrize(
+    "filter", [{"a": {"$ne": 1}}, {"a": {"$in": 1}}, {"a": {"$gt": "x"}}, {"a": [1]}]
+)
+def test_matches_rejects_malformed_filters(filter):
+    with pytest.raises(ValueError):
+        matches(filter, {"a": 1})
+
+
+def test_bitmap_cache_keeps_only_common_values():
+    index = MetadataIndex(bitmap_cache_size=2)
+    for slot in range(1000):
+        index.add(slot, {"id": slot, "parity": slot % 2, "tens": slot // 10 % 10})
+
+    for slot in range(0, 1000, 7):
+        mask = index.mask({"id": slot}, 1000)
+        assert np.flatnonzero(mask).tolist() == [slot]
+    assert len(index._bitmaps) == 0
+
+    for value in (0, 1):
+        assert index.mask({"parity": value}, 1000).sum() == 500
+    for value in range(10):
+        assert index.mask({"tens": value}, 1000).sum() == 100
+    assert len(index._bitmaps) == 2
+
+    index.remove(11, {"id": 11, "parity": 1, "tens": 1})
+    assert index.mask({"tens": 1}, 1000).sum() == 99
@@ -0,0 +1,424 @@
+from __future__ import annotations
+
+import json
+import os
+import struct
+import uuid
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from retrievers.utils import ReadWriteLock
+from vectorstores.utils import (
+    cosine_relevance,
+    embed_documents,
+    embed_queries,
+    normalize,
+)
+
+FILE_MAGIC = b"PAVECS01"
+# Offset alignment of the matrix in a saved file, so it can be memory-mapped
+# with aligned rows.
+_ALIGNMENT = 64
+
+
+class PABruteForceVectorStore(VectorStore):
+    """
+    Exact vector store in pure NumPy, scoring by cosine similarity.
+
+    Normalized embeddings live in one contiguous float32 (or float16, half
+    the memory) matrix. A batch of queries is scored against blocks of rows
+    with one matrix multiply per block, keeping a running top-k per query via
+    `argpartition`, so memory stays bounded by the block size however large
+    the collection. Suited to collections up to about a million vectors.
+
+    Deleted rows are tombstoned and skipped; once they make up
+    `compaction_threshold` of the matrix it is compacted. `save` writes a
+    single file, which `load` memory-maps, so a saved store opens instantly
+    and shares its pages between processes until it is written to.
+
+    Example:
+        .. code-block:: python
+
+            store = PABruteForceVectorStore.from_texts(texts, bge, dtype="float16")
+            store.save("/data/corpus.vecs")
+            store = PABruteForceVectorStore.load("/data/corpus.vecs", bge)
+            results = store.batch_similarity_search_by_vector(query_vectors, k=10)
+    """
+
+    def __init__(
+        self,
+        embedding: Embeddings,
+        dtype: str = "float32",
+        block_elements: int = 1 << 24,
+        compaction_threshold: float = 0.25,
+    ):
+        """
+        Args:
+            embedding: Embeddings of the texts and queries.
+            dtype: Storage type of the vectors, "float32" or "float16".
+            block_elements: Max scores computed per block, i.e. queries times
+                rows; bounds the temporary memory of a search.
+            compaction_threshold: Fraction of deleted rows that triggers a
+                compaction.
+        """
+        if dtype not in ("float32", "float16"):
+            raise ValueError(f"Unsupported dtype {dtype!r}")
+        self.embedding = embedding
+        self.dtype = np.dtype(dtype)
+        self.block_elements = block_elements
+        self.compaction_threshold = compaction_threshold
+        self._matrix: Optional[np.ndarray] = None
+        self._alive = np.zeros(0, dtype=bool)
+        self._size = 0
+        self._row_ids: List[Optional[str]] = []
+        self._rows: Dict[str, int] = {}
+        self._documents: Dict[str, Document] = {}
+        self._lock = ReadWriteLock()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        *,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> PABruteForceVectorStore:
+        """
+        Create a store from texts; kwargs are passed to the constructor.
+        """
+        store = cls(embedding, **kwargs)
+        store.add_texts(texts, metadatas, ids=ids)
+        return store
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        *,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        """
+        Embed and add texts. Texts whose id is already in the store replace
+        the stored document.
+        """
+        texts = list(texts)
+        vectors = embed_documents(self.embedding, texts)
+        return self.add_embeddings(texts, vectors, metadatas, ids=ids)
+
+    def add_embeddings(
+        self,
+        texts: List[str],
+        embeddings: np.ndarray,
+        metadatas: Optional[List[dict]] = None,
+        *,
+        ids: Optional[List[str]] = None,
+    ) -> List[str]:
+        """
+        Add texts with precomputed embeddings, one row per text.
+        """
+        if not texts:
+            return []
+        if ids is None:
+            ids = [str(uuid.uuid4()) for _ in texts]
+        if len(set(ids)) != len(ids):
+            raise ValueError("Duplicate ids in one call to add.")
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = normalize(embeddings).astype(self.dtype, copy=False)
+        with self._lock.write():
+            self._remove([doc_id for doc_id in ids if doc_id in self._documents])
+            start = self._size
+            self._reserve(start + len(ids), vectors.shape[1])
+            self._matrix[start : start + len(ids)] = vectors
+            self._alive[start : start + len(ids)] = True
+            self._size += len(ids)
+            for row, (doc_id, text, metadata) in enumerate(
+                zip(ids, texts, metadatas), start
+            ):
+                self._documents[doc_id] = Document(
+                    id=doc_id, page_content=text, metadata=metadata
+                )
+                self._rows[doc_id] = row
+                self._row_ids.append(doc_id)
+            self._maybe_compact()
+        return ids
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        """
+        Delete documents by id; unknown ids are ignored.
+        """
+        if ids is None:
+            raise ValueError("No ids provided to delete.")
+        with self._lock.write():
+            self._remove([doc_id for doc_id in ids if doc_id in self._documents])
+            self._maybe_compact()
+        return True
+
+    def get_by_ids(self, ids: Sequence[str], /) -> List[Document]:
+        return [self._documents[i] for i in ids if i in self._documents]
+
+    def compact(self) -> None:
+        """
+        Drop the rows of deleted documents from the matrix.
+        """
+        with self._lock.write():
+            self._compact()
+
+    def similarity_search(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        """
+        Documents most similar to the query, with their cosine similarity.
+        """
+        embedding = self.embedding.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k, **kwargs)
+
+    def similarity_search_by_vector(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        return [
+            doc
+            for doc, _ in self.similarity_search_with_score_by_vector(
+                embedding, k, **kwargs
+            )
+        ]
+
+    def similarity_search_with_score_by_vector(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        return self.batch_similarity_search_with_score_by_vector([embedding], k)[0]
+
+    def batch_similarity_search(
+        self, queries: List[str], k: int = 4, **kwargs: Any
+    ) -> List[List[Document]]:
+        """
+        Search for many queries at once, embedding them in one batch.
+        """
+        vectors = embed_queries(self.embedding, queries)
+        return self.batch_similarity_search_by_vector(vectors, k)
+
+    def batch_similarity_search_by_vector(
+        self, embeddings: Sequence[Sequence[float]], k: int = 4, **kwargs: Any
+    ) -> List[List[Document]]:
+        return [
+            [doc for doc, _ in results]
+            for results in self.batch_similarity_search_with_score_by_vector(
+                embeddings, k
+            )
+        ]
+
+    def batch_similarity_search_with_score_by_vector(
+        self, embeddings: Sequence[Sequence[float]], k: int = 4, **kwargs: Any
+    ) -> List[List[Tuple[Document, float]]]:
+        """
+        Exact top-k for many query vectors at once.
+
+        Args:
+            embeddings: Query vectors, one per row.
+            k: Number of documents per query.
+
+        Returns:
+            For each query, the documents and their cosine similarity, best
+            first.
+        """
+        if not len(embeddings):
+            return []
+        queries = normalize(embeddings)
+        with self._lock.read():
+            rows, scores = self._top_k(queries, min(k, len(self._documents)))
+            return [
+                [
+                    (self._documents[self._row_ids[row]], score)
+                    for row, score in zip(row_rows, row_scores)
+                ]
+                for row_rows, row_scores in zip(rows.tolist(), scores.tolist())
+            ]
+
+    def save(self, path: str) -> None:
+        """
+        Save the store to the single file `path`: a JSON header with the
+        documents, then the matrix of live rows. The file is replaced
+        atomically.
+        """
+        with self._lock.read():
+            live = np.flatnonzero(self._alive[: self._size])
+            header = {
+                "dtype": self.dtype.name,
+                "dim": 0 if self._matrix is None else self._matrix.shape[1],
+                "block_elements": self.block_elements,
+                "compaction_threshold": self.compaction_threshold,
+                "documents": [
+                    {
+                        "id": doc.id,
+                        "page_content": doc.page_content,
+                        "metadata": doc.metadata,
+                    }
+                    for doc in (self._documents[self._row_ids[r]] for r in live)
+                ],
+            }
+            data = json.dumps(header, ensure_ascii=False).encode("utf-8")
+            offset = _matrix_offset(len(data))
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(FILE_MAGIC)
+                f.write(struct.pack("<Q", len(data)))
+                f.write(data)
+                f.write(b"\0" * (offset - f.tell()))
+                if self._matrix is not None:
+                    # in blocks, to not copy a memory-mapped matrix at once
+                    for start in range(0, len(live), 65536):
+                        f.write(self._matrix[live[start : start + 65536]].tobytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(
+        cls, path: str, embedding: Embeddings, memory_map: bool = True
+    ) -> PABruteForceVectorStore:
+        """
+        Load a store saved by `save`. With `memory_map`, the matrix is mapped
+        read-only and only copied to memory when vectors are added.
+        """
+        with open(path, "rb") as f:
+            if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+                raise ValueError(f"{path} is not a saved vector store.")
+            (length,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(length).decode("utf-8"))
+        store = cls(
+            embedding,
+            dtype=header["dtype"],
+            block_elements=header["block_elements"],
+            compaction_threshold=header["compaction_threshold"],
+        )
+        n, dim = len(header["documents"]), header["dim"]
+        if n:
+            offset = _matrix_offset(length)
+            if memory_map:
+                matrix = np.memmap(
+                    path, dtype=store.dtype, mode="r", offset=offset, shape=(n, dim)
+                )
+            else:
+                matrix = np.fromfile(
+                    path, dtype=store.dtype, count=n * dim, offset=offset
+                ).reshape(n, dim)
+            store._matrix = matrix
+            store._alive = np.ones(n, dtype=bool)
+            store._size = n
+        for row, doc in enumerate(header["documents"]):
+            store._documents[doc["id"]] = Document(
+                id=doc["id"], page_content=doc["page_content"], metadata=doc["metadata"]
+            )
+            store._rows[doc["id"]] = row
+            store._row_ids.append(doc["id"])
+        return store
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        return cosine_relevance
+
+    def _top_k(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Rows and scores of the k best live rows per query, best first.
+        """
+        if k <= 0 or self._matrix is None:
+            empty = np.zeros((len(queries), 0))
+            return empty.astype(np.int64), empty.astype(np.float32)
+        if self._matrix.shape[1] != queries.shape[1]:
+            raise ValueError(
+                f"Query dimension {queries.shape[1]} does not match the store's "
+                f"{self._matrix.shape[1]}."
+            )
+        n_queries = len(queries)
+        block_rows = max(k, self.block_elements // n_queries)
+        best_rows = np.zeros((n_queries, 0), dtype=np.int64)
+        best_scores = np.zeros((n_queries, 0), dtype=np.float32)
+        for start in range(0, self._size, block_rows):
+            stop = min(start + block_rows, self._size)
+            block = self._matrix[start:stop]
+            if block.dtype != np.float32:
+                block = block.astype(np.float32)
+            scores = queries @ block.T
+            dead = ~self._alive[start:stop]
+            if dead.any():
+                scores[:, dead] = -np.inf
+            # merge the block's scores with the running top-k, then keep k
+            scores = np.concatenate([best_scores, scores], axis=1)
+            block_ids = np.broadcast_to(
+                np.arange(start, stop), (n_queries, stop - start)
+            )
+            rows = np.concatenate([best_rows, block_ids], axis=1)
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, top, axis=1)
+                rows = np.take_along_axis(rows, top, axis=1)
+            best_scores, best_rows = scores, rows
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        return best_rows, best_scores
+
+    def _reserve(self, size: int, dim: int) -> None:
+        """
+        Make room for `size` rows, doubling the capacity when full. A memory
+        mapped matrix is copied to memory here.
+        """
+        if self._matrix is not None and self._matrix.shape[1] != dim:
+            raise ValueError(
+                f"Embedding dimension {dim} does not match the store's "
+                f"{self._matrix.shape[1]}."
+            )
+        capacity = 0 if self._matrix is None else len(self._matrix)
+        if size <= capacity and not isinstance(self._matrix, np.memmap):
+            return
+        capacity = max(size, 2 * capacity, 1024)
+        matrix = np.empty((capacity, dim), dtype=self.dtype)
+        alive = np.zeros(capacity, dtype=bool)
+        if self._matrix is not None:
+            matrix[: self._size] = self._matrix[: self._size]
+            alive[: self._size] = self._alive[: self._size]
+        self._matrix, self._alive = matrix, alive
+
+    def _remove(self, ids: List[str]) -> None:
+        for doc_id in ids:
+            row = self._rows.pop(doc_id)
+            del self._documents[doc_id]
+            self._row_ids[row] = None
+            self._alive[row] = False
+
+    def _maybe_compact(self) -> None:
+        deleted = self._size - len(self._documents)
+        if deleted and deleted >= self.compaction_threshold * self._size:
+            self._compact()
+
+    def _compact(self) -> None:
+        if self._size == len(self._documents):
+            return
+        live = np.flatnonzero(self._alive[: self._size])
+        self._matrix = np.ascontiguousarray(self._matrix[live])
+        self._alive = np.ones(len(live), dtype=bool)
+        self._size = len(live)
+        self._row_ids = [self._row_ids[r] for r in live.tolist()]
+        self._rows = {doc_id: row for row, doc_id in enumerate(self._row_ids)}
+
+
+def _matrix_offset(header_length: int) -> int:
+    """Offset of the matrix in a saved file, after the magic, the header length
+    and the header, rounded up to `_ALIGNMENT`."""
+    end = len(FILE_MAGIC) + 8 + header_length
+    return -(-end // _ALIGNMENT) * _ALIGNMENT
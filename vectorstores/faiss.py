@@ -0,0 +1,479 @@
+from __future__ import annotations
+
+import json
+import math
+import os
+import uuid
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from retrievers.utils import ReadWriteLock
+from vectorstores.utils import (
+    cosine_relevance,
+    embed_documents,
+    embed_queries,
+    normalize,
+)
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+
+# Corpus sizes up to which each index type is picked by index_type="auto":
+# exact search while it is cheap, then HNSW for latency, IVF-Flat once the
+# graph gets too large to build, and IVF-PQ when float vectors no longer fit.
+AUTO_FLAT_MAX = 10_000
+AUTO_HNSW_MAX = 200_000
+AUTO_IVF_FLAT_MAX = 2_000_000
+
+# faiss' k-means wants this many training points per IVF list.
+_MIN_POINTS_PER_LIST = 39
+
+
+def choose_index_type(n_vectors: int) -> str:
+    """Index type for a corpus of `n_vectors`, as picked by index_type="auto"."""
+    if n_vectors <= AUTO_FLAT_MAX:
+        return "flat"
+    if n_vectors <= AUTO_HNSW_MAX:
+        return "hnsw"
+    if n_vectors <= AUTO_IVF_FLAT_MAX:
+        return "ivf_flat"
+    return "ivf_pq"
+
+
+class PAFaissVectorStore(VectorStore):
+    """
+    Vector store over a FAISS index, scoring by cosine similarity.
+
+    The index type is one of "flat" (exact), "ivf_flat", "ivf_pq" (inverted
+    lists, the latter with product-quantized vectors) and "hnsw" (graph), or
+    "auto" to choose by the size of the first batch added (see
+    `choose_index_type`). IVF indexes are trained on that first batch; call
+    `rebuild` to retrain or switch type once the corpus has grown.
+
+    Recall is traded for latency with `nprobe` (IVF lists visited) and
+    `ef_search` (HNSW candidate list size), set on the store or per search.
+    Documents are added and deleted by id; HNSW cannot remove vectors, so its
+    deleted ids are filtered out of searches until the next `rebuild`, which
+    runs by itself once they make up `compaction_threshold` of the index.
+
+    Example:
+        .. code-block:: python
+
+            store = PAFaissVectorStore.from_texts(texts, bge, index_type="auto")
+            docs = store.similarity_search("query", k=10, nprobe=32)
+            results = store.batch_similarity_search_by_vector(query_vectors, k=10)
+    """
+
+    def __init__(
+        self,
+        embedding: Embeddings,
+        index_type: str = "auto",
+        nlist: Optional[int] = None,
+        pq_m: Optional[int] = None,
+        hnsw_m: int = 32,
+        ef_construction: int = 200,
+        nprobe: int = 16,
+        ef_search: int = 64,
+        compaction_threshold: float = 0.25,
+    ):
+        """
+        Args:
+            embedding: Embeddings of the texts and queries.
+            index_type: "auto", "flat", "ivf_flat", "ivf_pq" or "hnsw".
+            nlist: Number of IVF lists, by default about 4 * sqrt(n).
+            pq_m: Number of PQ sub-quantizers (bytes per vector); it must
+                divide the dimension. By default the largest divisor <= 64.
+            hnsw_m: Neighbors per HNSW node.
+            ef_construction: HNSW candidate list size while building.
+            nprobe: Default number of IVF lists visited per search.
+            ef_search: Default HNSW candidate list size per search.
+            compaction_threshold: Fraction of deleted HNSW vectors that
+                triggers a rebuild.
+        """
+        if index_type != "auto" and index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index_type {index_type!r}")
+        self.embedding = embedding
+        self.index_type = index_type
+        self.nlist = nlist
+        self.pq_m = pq_m
+        self.hnsw_m = hnsw_m
+        self.ef_construction = ef_construction
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.compaction_threshold = compaction_threshold
+        self.index: Optional[faiss.Index] = None
+        self._documents: Dict[str, Document] = {}
+        self._labels: Dict[str, int] = {}
+        self._ids: Dict[int, str] = {}
+        self._deleted: set = set()
+        # excludes the deleted labels from searches, rebuilt on every deletion
+        self._selector: Optional[faiss.IDSelector] = None
+        self._next_label = 0
+        self._lock = ReadWriteLock()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        *,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> PAFaissVectorStore:
+        """
+        Create a store from texts; kwargs are passed to the constructor.
+        """
+        store = cls(embedding, **kwargs)
+        store.add_texts(texts, metadatas, ids=ids)
+        return store
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        *,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        """
+        Embed and add texts. Texts whose id is already in the store replace
+        the stored document.
+        """
+        texts = list(texts)
+        vectors = embed_documents(self.embedding, texts)
+        return self.add_embeddings(texts, vectors, metadatas, ids=ids)
+
+    def add_embeddings(
+        self,
+        texts: List[str],
+        embeddings: np.ndarray,
+        metadatas: Optional[List[dict]] = None,
+        *,
+        ids: Optional[List[str]] = None,
+    ) -> List[str]:
+        """
+        Add texts with precomputed embeddings, one row per text.
+        """
+        if not texts:
+            return []
+        if ids is None:
+            ids = [str(uuid.uuid4()) for _ in texts]
+        if len(set(ids)) != len(ids):
+            raise ValueError("Duplicate ids in one call to add.")
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = normalize(embeddings)
+        with self._lock.write():
+            self._remove([doc_id for doc_id in ids if doc_id in self._documents])
+            if self.index is None:
+                self.index = self._build(vectors)
+            labels = np.arange(self._next_label, self._next_label + len(ids))
+            self._next_label += len(ids)
+            if len(ids):
+                self.index.add_with_ids(vectors, labels)
+            for doc_id, label, text, metadata in zip(ids, labels, texts, metadatas):
+                label = int(label)
+                self._documents[doc_id] = Document(
+                    id=doc_id, page_content=text, metadata=metadata
+                )
+                self._labels[doc_id] = label
+                self._ids[label] = doc_id
+            self._maybe_compact()
+        return ids
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        """
+        Delete documents by id; unknown ids are ignored.
+        """
+        if ids is None:
+            raise ValueError("No ids provided to delete.")
+        with self._lock.write():
+            self._remove([doc_id for doc_id in ids if doc_id in self._documents])
+            self._maybe_compact()
+        return True
+
+    def get_by_ids(self, ids: Sequence[str], /) -> List[Document]:
+        return [self._documents[i] for i in ids if i in self._documents]
+
+    def similarity_search(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        """
+        Documents most similar to the query, with their cosine similarity.
+        """
+        embedding = self.embedding.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k, **kwargs)
+
+    def similarity_search_by_vector(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        return [
+            doc
+            for doc, _ in self.similarity_search_with_score_by_vector(
+                embedding, k, **kwargs
+            )
+        ]
+
+    def similarity_search_with_score_by_vector(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        return self.batch_similarity_search_with_score_by_vector(
+            [embedding], k, **kwargs
+        )[0]
+
+    def batch_similarity_search(
+        self, queries: List[str], k: int = 4, **kwargs: Any
+    ) -> List[List[Document]]:
+        """
+        Search for many queries at once, embedding them in one batch.
+        """
+        vectors = embed_queries(self.embedding, queries)
+        return self.batch_similarity_search_by_vector(vectors, k, **kwargs)
+
+    def batch_similarity_search_by_vector(
+        self, embeddings: Sequence[Sequence[float]], k: int = 4, **kwargs: Any
+    ) -> List[List[Document]]:
+        return [
+            [doc for doc, _ in results]
+            for results in self.batch_similarity_search_with_score_by_vector(
+                embeddings, k, **kwargs
+            )
+        ]
+
+    def batch_similarity_search_with_score_by_vector(
+        self,
+        embeddings: Sequence[Sequence[float]],
+        k: int = 4,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        **kwargs: Any,
+    ) -> List[List[Tuple[Document, float]]]:
+        """
+        Search for many query vectors in one call to the index, which spreads
+        the queries over its threads.
+
+        Args:
+            embeddings: Query vectors, one per row.
+            k: Number of documents per query.
+            nprobe: IVF lists visited, overriding the store's default.
+            ef_search: HNSW candidate list size, overriding the store's default.
+
+        Returns:
+            For each query, the documents and their cosine similarity, best
+            first.
+        """
+        if not len(embeddings):
+            return []
+        if k <= 0:
+            return [[] for _ in range(len(embeddings))]
+        queries = normalize(embeddings)
+        with self._lock.read():
+            if self.index is None or not self._documents:
+                return [[] for _ in range(len(queries))]
+            params = self._search_parameters(
+                nprobe or self.nprobe, ef_search or self.ef_search
+            )
+            scores, labels = self.index.search(
+                queries, min(k, len(self._documents)), params=params
+            )
+            return [
+                [
+                    (self._documents[self._ids[label]], float(score))
+                    for score, label in zip(row_scores, row_labels)
+                    if label >= 0
+                ]
+                for row_scores, row_labels in zip(scores.tolist(), labels.tolist())
+            ]
+
+    def rebuild(self, index_type: Optional[str] = None) -> None:
+        """
+        Rebuild the index from the stored vectors, e.g. to retrain IVF lists
+        on the grown corpus, switch type, or purge HNSW deletions. The vectors
+        are read back from the index, so an IVF-PQ index is rebuilt from its
+        quantized vectors.
+        """
+        with self._lock.write():
+            if index_type is not None:
+                if index_type != "auto" and index_type not in INDEX_TYPES:
+                    raise ValueError(f"Unknown index_type {index_type!r}")
+                self.index_type = index_type
+            self._rebuild()
+
+    def save(self, path: str) -> None:
+        """
+        Save the index and the documents to the directory `path`.
+        """
+        os.makedirs(path, exist_ok=True)
+        index_path = os.path.join(path, "index.faiss")
+        with self._lock.read():
+            if self.index is not None:
+                faiss.write_index(self.index, index_path)
+            elif os.path.exists(index_path):
+                # an older save's index would bring deleted vectors back
+                os.remove(index_path)
+            store = {
+                "params": {
+                    "index_type": self.index_type,
+                    "nlist": self.nlist,
+                    "pq_m": self.pq_m,
+                    "hnsw_m": self.hnsw_m,
+                    "ef_construction": self.ef_construction,
+                    "nprobe": self.nprobe,
+                    "ef_search": self.ef_search,
+                    "compaction_threshold": self.compaction_threshold,
+                },
+                "documents": [
+                    {
+                        "id": doc_id,
+                        "label": self._labels[doc_id],
+                        "page_content": doc.page_content,
+                        "metadata": doc.metadata,
+                    }
+                    for doc_id, doc in self._documents.items()
+                ],
+                "deleted": sorted(self._deleted),
+                "next_label": self._next_label,
+            }
+        with open(os.path.join(path, "store.json"), "w", encoding="utf-8") as f:
+            json.dump(store, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str, embedding: Embeddings) -> PAFaissVectorStore:
+        """
+        Load a store saved by `save`.
+        """
+        with open(os.path.join(path, "store.json"), encoding="utf-8") as f:
+            store = json.load(f)
+        instance = cls(embedding, **store["params"])
+        index_path = os.path.join(path, "index.faiss")
+        if os.path.exists(index_path):
+            instance.index = faiss.read_index(index_path)
+        for doc in store["documents"]:
+            instance._documents[doc["id"]] = Document(
+                id=doc["id"], page_content=doc["page_content"], metadata=doc["metadata"]
+            )
+            instance._labels[doc["id"]] = doc["label"]
+            instance._ids[doc["label"]] = doc["id"]
+        instance._deleted = set(store["deleted"])
+        instance._selector = instance._deleted_selector()
+        instance._next_label = store["next_label"]
+        return instance
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        return cosine_relevance
+
+    def _build(self, vectors: np.ndarray) -> faiss.Index:
+        """
+        A new index of the configured type, trained on `vectors` if needed.
+        """
+        n, dim = vectors.shape
+        index_type = self.index_type
+        if index_type == "auto":
+            index_type = choose_index_type(n)
+        if index_type == "flat":
+            return faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+        if index_type == "hnsw":
+            hnsw = faiss.IndexHNSWFlat(dim, self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+            hnsw.hnsw.efConstruction = self.ef_construction
+            return faiss.IndexIDMap2(hnsw)
+
+        nlist = self.nlist or max(
+            1, min(round(4 * math.sqrt(n)), n // _MIN_POINTS_PER_LIST)
+        )
+        quantizer = faiss.IndexFlatIP(dim)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(
+                quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT
+            )
+        else:
+            if n < 256:
+                raise ValueError("ivf_pq needs at least 256 vectors to train on.")
+            pq_m = self.pq_m or max(m for m in range(1, 65) if dim % m == 0)
+            index = faiss.IndexIVFPQ(
+                quantizer, dim, nlist, pq_m, 8, faiss.METRIC_INNER_PRODUCT
+            )
+        index.train(vectors)
+        # map labels to list entries, to support removal and reconstruction
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        return index
+
+    def _search_parameters(
+        self, nprobe: int, ef_search: int
+    ) -> Optional[faiss.SearchParameters]:
+        selector = self._selector
+        index = self.index
+        if isinstance(index, faiss.IndexIDMap2):
+            index = faiss.downcast_index(index.index)
+        if isinstance(index, faiss.IndexIVF):
+            params = faiss.SearchParametersIVF(nprobe=nprobe)
+        elif isinstance(index, faiss.IndexHNSW):
+            params = faiss.SearchParametersHNSW(efSearch=ef_search)
+        elif selector is not None:
+            params = faiss.SearchParameters()
+        else:
+            return None
+        if selector is not None:
+            params.sel = selector
+            # keep the selector alive as long as the parameters
+            params._selector = selector
+        return params
+
+    def _remove(self, ids: List[str]) -> None:
+        if not ids:
+            return
+        labels = np.array([self._labels.pop(doc_id) for doc_id in ids], np.int64)
+        for doc_id, label in zip(ids, labels.tolist()):
+            del self._documents[doc_id]
+            del self._ids[label]
+        if self._is_hnsw():
+            self._deleted.update(labels.tolist())
+            self._selector = self._deleted_selector()
+        else:
+            self.index.remove_ids(labels)
+
+    def _deleted_selector(self) -> Optional[faiss.IDSelector]:
+        if not self._deleted:
+            return None
+        return faiss.IDSelectorNot(
+            faiss.IDSelectorBatch(np.array(sorted(self._deleted), np.int64))
+        )
+
+    def _rebuild(self) -> None:
+        if self.index is None:
+            return
+        self._deleted.clear()
+        self._selector = None
+        if not self._documents:
+            self.index = None
+            return
+        labels = np.array([self._labels[i] for i in self._documents], np.int64)
+        vectors = normalize(self.index.reconstruct_batch(labels))
+        self.index = self._build(vectors)
+        self.index.add_with_ids(vectors, labels)
+
+    def _maybe_compact(self) -> None:
+        deleted = len(self._deleted)
+        if deleted and deleted >= self.compaction_threshold * self.index.ntotal:
+            self._rebuild()
+
+    def _is_hnsw(self) -> bool:
+        index = self.index
+        if isinstance(index, faiss.IndexIDMap2):
+            index = faiss.downcast_index(index.index)
+        return isinstance(index, faiss.IndexHNSW)
@@ -0,0 +1,34 @@
+from typing import Any, List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+def embed_documents(embedding: Embeddings, texts: List[str]) -> np.ndarray:
+    """Document embeddings as a float32 array, without a detour through Python
+    floats when the embeddings support it."""
+    if hasattr(embedding, "embed_documents_array"):
+        return embedding.embed_documents_array(texts)
+    return np.asarray(embedding.embed_documents(texts), dtype=np.float32)
+
+
+def embed_queries(embedding: Embeddings, queries: List[str]) -> np.ndarray:
+    """Query embeddings as a float32 array, in one batch when supported."""
+    if hasattr(embedding, "embed_queries_array"):
+        return embedding.embed_queries_array(queries)
+    return np.asarray([embedding.embed_query(q) for q in queries], dtype=np.float32)
+
+
+def normalize(vectors: Any) -> np.ndarray:
+    """Rows of `vectors` scaled to unit length, as a contiguous float32 matrix."""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def cosine_relevance(score: float) -> float:
+    """Cosine similarity in [-1, 1] to a relevance in [0, 1], clipped as
+    approximate scores can overshoot."""
+    return min(max((score + 1) / 2, 0.0), 1.0)